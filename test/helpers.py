@@ -327,6 +327,12 @@ def skiplive_condition() -> bool:
 
 skip_live = mark.skipif( skiplive_condition(), reason="live test not enabled as configuration is missing" )
 
+def skipbenchmark_condition() -> bool:
+	from os import getenv
+	return not getenv( 'TRACS_BENCHMARK' )
+
+skip_benchmark = mark.skipif( skipbenchmark_condition(), reason="benchmark not enabled, set TRACS_BENCHMARK to run it" )
+
 # mock gpx resource
 
 gpx_resource = '''
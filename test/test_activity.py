@@ -2,11 +2,13 @@
 from datetime import datetime, time, timedelta
 from logging import getLogger
 
+from orjson import loads
 from pytest import mark, raises
 
 from tracs.activity import Activities, Activity, ActivityPart, groups
 from tracs.activity_types import ActivityTypes
 from tracs.core import Metadata, VirtualField
+from tracs.fsio import serialize_activity
 from tracs.pluginmgr import virtualfield
 from tracs.resources import Resource, Resources
 from tracs.uid import UID
@@ -217,6 +219,18 @@ def test_add():
 	assert target.heartrate_max == 180
 	assert target.heartrate_min == 80
 
+def test_slots():
+	assert not hasattr( Activity( uid='a:1' ), '__dict__' )
+	assert not hasattr( Resource( path='test.gpx', type='application/gpx+xml' ), '__dict__' )
+
+def test_serialization_roundtrip():
+	serialized = serialize_activity( Activity( id=1, uid='polar:101', metadata=Metadata( favourite=True ) ) )
+	activity = Activity.from_dict( loads( serialized ) )
+	assert activity.metadata.favourite is True
+
+	activity.__dirty__ = True
+	assert serialize_activity( activity ) == serialized and b'"favourite": true' in serialized
+
 def test_activities():
 	activities = Activities()
 	a1 = Activity( name='a1', uid='a:1' )
@@ -240,6 +254,13 @@ def test_activities():
 	unchecked = Activities( Activity( id=10 ), skip_checks=True )
 	assert unchecked[0].id is 10 and unchecked[0].uid is None
 
+	# batches are validated as a whole
+	with raises( KeyError ):
+		activities.add( Activity( uid='a:5' ), Activity( uid='a:5' ) )
+	with raises( KeyError ):
+		activities.add( Activity( uid='a:5' ), Activity( uid='a:1' ) )
+	assert len( activities ) == 4 and UID( 'a:5' ) not in activities
+
 	# get
 	assert activities.get_by_id( 1 ) == a1
 	assert activities.get_by_id( 999 ) is None
@@ -275,6 +296,10 @@ def test_activities():
 	activities.remove( a2.uid )
 	assert activities.get_by_id( 2 ) is None
 
+	# ids of removed activities are reused
+	assert activities.add( Activity( uid='a:5' ), Activity( uid='a:6' ), Activity( uid='a:7' ) ) == [2, 3, 4]
+	assert activities.get_by_uid( 'a:6' ).id == 3
+
 	# # replace based on old activity
 	# activities.replace( Activity( name='a2', uid='a:2' ), a1 )
 	# assert len( activities ) == 1 and activities.idget( 1 ).name == 'a2'
@@ -408,6 +433,24 @@ def test_virtual_activity_fields( registry ):
 	with raises( AttributeError ):
 		assert a.getattr( 'does_not_exist' ) is None
 
+def test_memoised_activity_fields( registry ):
+	calls = []
+	Activity.__vf__['memo_year'] = VirtualField( 'memo_year', int, factory=lambda a: calls.append( a ) or a.starttime_local.year, memo=True, sources=[ 'starttime_local' ] )
+
+	a = Activity( name='Morning run', starttime_local=datetime( 2022, 5, 1, 8, 0 ) )
+	assert a.memo_year == 2022 and a.vf.memo_year == 2022 and len( calls ) == 1
+
+	# unrelated changes keep the memo, changes of the source field clear it
+	a.name = 'Evening run'
+	assert a.memo_year == 2022 and len( calls ) == 1
+	a.starttime_local = datetime( 2023, 5, 1, 8, 0 )
+	assert a.memo_year == 2023 and len( calls ) == 2
+
+	# materialising computes columns and fills the memo, values which cannot be computed are None
+	b = Activity( name='Run without time' )
+	assert Activity.materialize( [ a, b ], 'memo_year', 'name' ) == { 'memo_year': [ 2023, None ], 'name': [ 'Evening run', 'Run without time' ] }
+	assert len( calls ) == 3 and b.__memo__ == {}
+
 @virtualfield
 def name( a: Activity ) -> str:
 	return 'override attempt for run'
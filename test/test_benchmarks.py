@@ -0,0 +1,160 @@
+from datetime import datetime, timedelta
+from gc import collect
+from time import perf_counter
+from tracemalloc import get_traced_memory, start, stop
+from typing import Callable, Tuple
+
+from dateutil.tz import UTC
+from fs.memoryfs import MemoryFS
+from orjson import dumps, OPT_INDENT_2, OPT_SORT_KEYS
+from pytest import mark
+
+from tracs.activity import Activity
+from tracs.db import ActivityDb
+from tracs.uid import UID
+import tracs.uid
+from .helpers import skip_benchmark
+
+SIZES = [ 1000, 10000, 100000 ]
+
+@skip_benchmark
+@mark.parametrize( 'size', SIZES )
+def test_load( size: int ):
+	fs = create_fs( size )
+
+	json_time, db = measure( lambda: ActivityDb( fs=fs ) )
+	assert len( db.activities ) == size
+
+	ActivityDb( fs=fs, snapshot=True ).save() # creates the snapshot
+	assert fs.exists( '/activities.snapshot' )
+	snapshot_time, db = measure( lambda: ActivityDb( fs=fs, snapshot=True ) )
+	assert len( db.activities ) == size and db._snapshot_key is not None
+
+	lazy_time, db = measure( lambda: ActivityDb( fs=fs, lazy=True ) )
+	assert len( db.activities ) == size
+	assert lazy_time < json_time
+
+	print( f'\nloading {size} activities: json = {json_time:.3f}s, snapshot = {snapshot_time:.3f}s, lazy = {lazy_time:.3f}s' )
+
+@skip_benchmark
+@mark.parametrize( 'size', SIZES[:2] )
+def test_uid_interning( size: int, monkeypatch ):
+	fs = create_fs( size )
+	uids = [ ( f'polar:{1000 + i}', f'{1000 + i}.gpx' ) for i in range( 1, size + 1 ) ]
+
+	tracs.uid._intern.cache_clear()
+	interned_load, db = measure( lambda: ActivityDb( fs=fs ) )
+	interned_contains, result = measure( lambda: [ db.contains_resource( uid, path ) for uid, path in uids ] )
+	assert all( result )
+
+	monkeypatch.setattr( tracs.uid, '_intern', UID ) # creates a new uid on every call
+	plain_load, db = measure( lambda: ActivityDb( fs=fs ) )
+	plain_contains, result = measure( lambda: [ db.contains_resource( uid, path ) for uid, path in uids ] )
+	assert all( result )
+
+	print( f'\nuids for {size} activities: load = {plain_load:.3f}s -> {interned_load:.3f}s (interned), contains_resource = {plain_contains:.3f}s -> {interned_contains:.3f}s (interned)' )
+
+@skip_benchmark
+def test_memory( monkeypatch ):
+	size = 50000
+	fs = create_fs( size )
+
+	tracs.uid._intern.cache_clear()
+	interned, persisted = memory( lambda: ActivityDb( fs=fs ) )
+
+	monkeypatch.setattr( tracs.uid, '_intern', UID ) # creates a new uid on every call, like a build without interning
+	plain, _ = memory( lambda: ActivityDb( fs=fs ) )
+
+	print( f'\nmemory for {size} activities: {plain / size:.0f} -> {interned / size:.0f} bytes per activity (interned), persisted form: {persisted / size:.0f} bytes per activity' )
+	assert interned < plain and interned / size < 4096
+
+@skip_benchmark
+@mark.parametrize( 'size', SIZES[:2] )
+def test_converter_throughput( size: int, monkeypatch ):
+	fs = create_fs( size )
+	records = [ create_activity( i ) for i in range( 1, size + 1 ) ]
+
+	structure_time, activities = measure( lambda: [ Activity.from_dict( r ) for r in records ] )
+	load_time, db = measure( lambda: ActivityDb( fs=fs ) )
+	assert len( activities ) == len( db.activities ) == size
+
+	commit_all( db ) # warm up, the first commit folds the journal
+	with monkeypatch.context() as m:
+		m.setattr( Activity, 'json_converter', Activity.converter ) # datetimes formatted by the converter
+		string_time, _ = measure( lambda: commit_all( db ) )
+	native_time, _ = measure( lambda: commit_all( db ) )
+
+	print( f'\nconverter for {size} activities: structure = {size / structure_time:.0f} rec/s, load = {size / load_time:.0f} rec/s, '
+	       f'commit = {size / string_time:.0f} rec/s -> {size / native_time:.0f} rec/s (native datetimes)' )
+
+@skip_benchmark
+@mark.parametrize( 'resources', [ False, True ] )
+def test_commit_throughput( resources: bool ):
+	rates = {}
+	for size in SIZES[:2]:
+		db = ActivityDb( fs=create_fs( size, resources=resources ) )
+		commit_all( db ) # warm up, the first commit folds the journal
+		commit_time, _ = measure( lambda: commit_all( db ) )
+		rates[size] = size / commit_time
+
+	# commits of all activities scale linearly: re-indexing an activity does not depend on the size of index buckets
+	small, large = SIZES[:2]
+	print( f'\ncommit throughput (resources = {resources}): {small} activities = {rates[small]:.0f} rec/s, {large} activities = {rates[large]:.0f} rec/s' )
+	assert rates[large] > rates[small] / 3
+
+# helper
+
+def commit_all( db: ActivityDb ) -> None:
+	for a in db.activities:
+		a.__dirty__ = True
+	db.commit()
+
+
+def create_fs( size: int, resources: bool = True ) -> MemoryFS:
+	fs = MemoryFS()
+	activities = [ create_activity( i ) for i in range( 1, size + 1 ) ]
+	if not resources:
+		activities = [ { k: v for k, v in a.items() if k != 'resources' } for a in activities ]
+	fs.writebytes( '/activities.json', dumps( activities, option=OPT_INDENT_2 | OPT_SORT_KEYS ) )
+	fs.writebytes( '/schema.json', dumps( { 'version': 14 } ) )
+	return fs
+
+def create_activity( id: int ) -> dict:
+	starttime = datetime( 2020, 1, 1, 10, 0, 0, tzinfo=UTC ) + timedelta( hours=id )
+	return {
+		'id': id,
+		'uid': f'polar:{1000 + id}',
+		'name': f'Activity {id}',
+		'type': 'run',
+		'tags': [ 'morning', 'benchmark' ],
+		'starttime': starttime.isoformat(),
+		'endtime': ( starttime + timedelta( hours=1 ) ).isoformat(),
+		'duration': '01:00:00',
+		'distance': 10000.0 + id,
+		'heartrate': 140,
+		'metadata': { 'created': starttime.isoformat(), 'favourite': id % 10 == 0 },
+		'resources': [
+			{ 'name': 'Polar GPX Track', 'type': 'application/gpx+xml', 'path': f'polar/{1000 + id}/{1000 + id}.gpx', 'uid': f'polar:{1000 + id}' },
+			{ 'name': 'Polar Activity Data', 'type': 'application/vnd.polar+json', 'path': f'polar/{1000 + id}/{1000 + id}.json', 'uid': f'polar:{1000 + id}' },
+		],
+	}
+
+def memory( fn: Callable[[], ActivityDb] ) -> Tuple[int, int]:
+	"""
+	Returns the memory allocated by the activities of the db created by fn and by the cached persisted form of them.
+	"""
+	start()
+	before, _ = get_traced_memory()
+	db = fn()
+	loaded, _ = get_traced_memory()
+	for a in db.activities:
+		a.__serialized__ = None
+	collect()
+	after, _ = get_traced_memory()
+	stop()
+	return after - before, loaded - after
+
+def measure( fn: Callable ) -> Tuple[float, object]:
+	start = perf_counter()
+	result = fn()
+	return perf_counter() - start, result
@@ -29,6 +29,8 @@ cmd_list_1_tags = 'list -l "id tags" 1'
 
 cmd_tag = 'tag -t one 1'
 
+cmd_inspect_plan = 'inspect --plan 1 thisyear'
+
 cmd_version = 'version'
 
 # no command
@@ -101,3 +103,10 @@ def test_version( ctx: Context ):
 @mark.context( env='default', persist='clone', cleanup=True, json=True )
 def test_version_json( ctx: Context ):
 	assert invoke( ctx, cmd_version ).json == { 'version': '0.1.0' }
+
+# inspect
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_inspect_plan( ctx: Context ):
+	i = invoke( ctx, cmd_inspect_plan )
+	assert i.out.contains_all( 'lookup', 'id == 1', 'starttime_local >=' )
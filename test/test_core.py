@@ -4,7 +4,7 @@ from attrs import define, field
 from babel.numbers import format_decimal
 from pytest import mark, raises
 
-from tracs.core import FieldFormatter, FieldFormatters, FormattedFieldsBase, Metadata, VirtualField, VirtualFieldsBase
+from tracs.core import FieldFormatter, FieldFormatters, FormattedFieldsBase, IdAllocator, Metadata, VirtualField, VirtualFieldsBase
 from uid import UID
 
 def test_virtual_field():
@@ -209,3 +209,36 @@ def test_metadata():
 		'f2': 'two',
 		'f3': 'three',
 	}
+
+	# fields are slots, unknown fields go into the supplementary dict, which is created on demand
+	assert not hasattr( md, '__dict__' )
+	assert md.supplementary == { 'f1': 'one', 'f2': 'two', 'f3': 'three' }
+	assert Metadata().supplementary is None and Metadata().unknown is None
+
+def test_id_allocator():
+	allocator = IdAllocator()
+	assert allocator.next() == 1
+	allocator.add( 1 )
+	allocator.add( 2 )
+	assert allocator.next() == 3
+
+	# gaps are filled first, lowest id first
+	allocator = IdAllocator( used={ 1, 2, 5, 7 } )
+	assert allocator.high == 7 and allocator.next() == 3
+	allocator.add( 3 )
+	assert allocator.next() == 4
+	allocator.add( 4 )
+	assert allocator.next() == 6
+	allocator.add( 6 )
+	assert allocator.next() == 8
+
+	# released ids are reused
+	allocator.remove( 2 )
+	allocator.remove( 8 ) # never used
+	assert allocator.next() == 2
+
+	# adding beyond the high-water mark creates new gaps
+	allocator.add( 2 )
+	allocator.add( 10 )
+	assert allocator.next() == 8
+
@@ -1,19 +1,29 @@
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from pathlib import Path
 from typing import List, Union
 
 from fs.memoryfs import MemoryFS
 from fs.osfs import OSFS
-from dateutil.tz import UTC
-from pytest import mark
+from dateutil.tz import tzoffset, UTC
+from orjson import dumps, loads, OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_SORT_KEYS
+from pytest import fail as pytest_fail, mark, raises
+from rule_engine import EvaluationError, Rule
 
 from objects import DEFAULT_ONE
 from tracs.activity import Activity
-from tracs.db import ActivityDb
+from tracs.columns import columnar_available
+from tracs.core import Metadata
+from tracs.fsio import compress, decompress, GZIP, load_schema, mapped, pretty_dump, shard_key, ZSTD, ZstdCompressor
+from tracs.errors import StaleDatabaseException
+from tracs.migrate import _stage_index, migrate_db, migrate_schema, Migration, PROGRESS_NAME
+from tracs.db import ActivityDb, json_to_shards, json_to_sqlite, ShardedActivityDb, shards_to_json, SqliteActivityDb, sqlite_to_json
 from tracs.plugins.gpx import GPX_TYPE
 from tracs.plugins.polar import POLAR_FLOW_TYPE
 from tracs.plugins.strava import STRAVA_TYPE
 from tracs.plugins.tcx import TCX_TYPE
 from tracs.resources import Resource
+from tracs.rules import CONTEXT
 from tracs.uid import UID
 
 def test_new_db_without_path():
@@ -44,14 +54,14 @@ def test_new_db_with_fs():
 def test_new_db_with_writable_path( db_path ):
 	db = ActivityDb( path=db_path, read_only=False )
 	assert db.fs is not None and type( db.underlay_fs ) is OSFS and type( db.overlay_fs ) is MemoryFS
-	assert db.fs.listdir( '/' ) == ['activities.json', 'schema.json']
+	assert sorted( db.fs.listdir( '/' ) ) == ['activities.json', 'activities.lock', 'schema.json']
 	assert db.schema.version == 14
 
 @mark.context( env='empty', persist='clone', cleanup=True )
 def test_new_db_with_readonly_path( db_path ):
 	db = ActivityDb( path=db_path, read_only=True )
-	assert db.fs is not None and type( db.underlay_fs ) is MemoryFS and type( db.overlay_fs ) is MemoryFS
-	assert db.fs.listdir( '/' ) == ['activities.json', 'schema.json']
+	assert db.fs is not None and type( db.underlay_fs ) is OSFS and type( db.overlay_fs ) is MemoryFS
+	assert sorted( db.fs.listdir( '/' ) ) == ['activities.json', 'activities.lock', 'schema.json']
 	assert db.schema.version == 14
 
 @mark.xfail( reason='comparison of activities does not yet work correctly' )
@@ -104,6 +114,48 @@ def test_insert_upsert_remove( db ):
 	a = db.get_by_id( 4 )
 	assert a.name == 'group' and a.uid == 'group:101' and a.calories == 100 and a.starttime == dt
 
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_upsert_many( db ):
+	dt = datetime( 2024, 3, 1, 10, 0, 0, tzinfo=UTC )
+	assert db.upsert_many( [ Activity( uid='a:1' ), Activity( uid='a:2' ) ] ) == [1, 2]
+
+	# existing activities are merged, new ones are inserted, duplicates within the batch are merged as well
+	ids = db.upsert_many( [
+		Activity( uid='a:2', name='two', starttime=dt ),
+		Activity( uid='a:3', name='three' ),
+		Activity( uid='a:3', calories=100 ),
+	] )
+	assert ids == [2, 3, 3] and db.activity_keys == [1, 2, 3]
+	assert db.get_by_id( 2 ).name == 'two' and db.get_by_id( 2 ).starttime == dt
+	assert db.get_by_id( 3 ).name == 'three' and db.get_by_id( 3 ).calories == 100
+
+	# members of groups are resolved to their group
+	db.insert( Activity( uid='group:1', metadata=Metadata( members=[ UID( 'b:1' ) ] ) ) )
+	assert db.upsert_many( [ Activity( uid='b:1', name='member' ) ] ) == [4]
+	assert db.activity_keys == [1, 2, 3, 4]
+
+	# activities without uid are not merged into each other, but rejected like on insert
+	one, two = Activity( name='one' ), Activity( name='two' )
+	with raises( KeyError ):
+		db.upsert_many( [ one, two ] )
+	assert one.name == 'one' and db.activity_keys == [1, 2, 3, 4]
+
+def test_update_uid():
+	db = ActivityDb( path=None )
+	db.insert( a := Activity( uid='x:1' ) )
+	a.uid = 'x:2'
+	db.update( a )
+
+	# the new uid is taken, the old one is free again
+	with raises( KeyError ):
+		db.insert( Activity( uid='x:2' ) )
+	db.insert( Activity( uid='x:1' ) )
+	assert [ str( a.uid ) for a in db.activities ] == [ 'x:2', 'x:1' ]
+
+	# uids changed without update are picked up by uid lookups of the activity list
+	a.uid = 'x:3'
+	assert db._activities.get_by_uid( 'x:2' ) is None and db._activities.get_by_uid( 'x:3' ) is a
+
 @mark.context( env='default', persist='clone', cleanup=True )
 def test_contains( db ):
 	assert db.contains( 'polar:1001' )
@@ -197,7 +249,618 @@ def test_find( db ):
 	recordings = db.find_recordings( 'polar:1001', 'strava:1001' )
 	assert [r.path for r in recordings] == ['polar/1/0/0/1001/1001.gpx', 'strava/1/0/0/1001/1001.gpx']
 
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_index( db ):
+	def assert_consistent():
+		assert len( db._index ) == len( db.activities )
+		for a in db.activities:
+			assert db.get_by_id( a.id ) is a
+			assert db.get_by_uid( a.uid ) is a
+			assert db.contains_activity( a.uid )
+			for m in a.metadata.members:
+				assert a in db.find_groups_for_uid( m )
+		assert db.activity_ids == sorted( [ a.id for a in db.activities ] )
+
+	assert_consistent()
+	assert db.find_groups_for_uid( 'polar:1001' ) == [ a for a in db.activities if 'polar:1001' in a.metadata.members ]
+
+	# insert
+	a = Activity( uid='index:1', resources=[ Resource( path='index.gpx', uid='index:1', type=GPX_TYPE, source='takeouts/index.zip' ) ] )
+	db.insert( a )
+	assert_consistent()
+	assert db.contains_resource( uid='index:1', path='index.gpx' )
+	assert db.get_resource_by_uid_path( 'index:1', 'index.gpx' ) is a.resources[0]
+
+	# resource catalogue
+	assert db.find_resources( 'index:1' ) == db.find_resources( 'index:1', 'index.gpx' ) == [ a.resources[0] ]
+	b = Activity( uid='index:3', resources=[ Resource( path='index.tcx', type=TCX_TYPE ) ] ) # resource without uid
+	db.insert( b )
+	assert db.find_resources( 'index:3' ) == [ b.resources[0] ]
+	db.remove_activity( b )
+	assert db.find_resources_by_path( 'index.gpx' ) == [ a.resources[0] ]
+	assert db.find_resources_by_source( 'takeouts/index.zip' ) == [ a.resources[0] ] and 'takeouts/index.zip' in db.resource_sources
+	assert db.find_resources_of_type( GPX_TYPE ) == [ r for r in db.resources if r.type == GPX_TYPE ]
+	assert db.find_resources_of_type( GPX_TYPE, TCX_TYPE ) == [ r for a in sorted( db.activities, key=lambda a: a.id ) for r in a.resources if r.type in [ GPX_TYPE, TCX_TYPE ] ]
+
+	# changes announced via update
+	a.uid = 'index:2'
+	db.update( a )
+	assert_consistent()
+	assert db.get_by_uid( 'index:1' ) is None and db.get_by_uid( 'index:2' ) is a
+
+	# remove
+	db.remove_activity( a )
+	assert_consistent()
+	assert not db.contains_activity( 'index:2' ) and not db.contains_resource( uid='index:1', path='index.gpx' )
+	assert db.find_resources_by_path( 'index.gpx' ) == [] and 'takeouts/index.zip' not in db.resource_sources
+
+def test_journal():
+	fs = MemoryFS()
+	db = ActivityDb( fs=fs )
+	db.insert( Activity( uid='a:1', name='one' ), Activity( uid='a:2', name='two' ) )
+	db.commit()
+
+	# commit appends to the journal, activities.json is untouched
+	assert fs.exists( '/activities.journal' ) and fs.readbytes( '/activities.json' ) == b'[]'
+	assert [ a.name for a in ActivityDb( fs=fs ).activities ] == [ 'one', 'two' ]
+
+	# commits without changes do not write anything
+	size = fs.getsize( '/activities.journal' )
+	db.commit()
+	assert fs.getsize( '/activities.journal' ) == size
+
+	db.get_by_id( 1 ).name = 'one and a half'
+	db.remove_activity( db.get_by_id( 2 ) )
+	db.commit()
+	assert [ a.name for a in ActivityDb( fs=fs ).activities ] == [ 'one and a half' ]
+
+	# compaction
+	db.compact()
+	assert not fs.exists( '/activities.journal' )
+	assert [ a.name for a in ActivityDb( fs=fs ).activities ] == [ 'one and a half' ]
+
+	# threshold of 0 always compacts
+	db = ActivityDb( fs=fs, journal_threshold=0 )
+	db.insert( Activity( uid='a:3', name='three' ) )
+	db.commit()
+	assert not fs.exists( '/activities.journal' )
+	assert [ a.name for a in ActivityDb( fs=fs ).activities ] == [ 'one and a half', 'three' ]
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_dirty( db ):
+	assert not any( a.__dirty__ for a in db.activities )
+
+	a, b = db.get_by_id( 2 ), db.get_by_id( 3 )
+	a.name = 'dirty'
+	b.tag( 'dirty' )
+	assert a.__dirty__ and b.__dirty__ and not db.get_by_id( 1 ).__dirty__
+
+	# only dirty activities end up in the journal
+	db.commit()
+	assert not a.__dirty__ and not b.__dirty__
+	entries = [ loads( line ) for line in db.overlay_fs.readbytes( '/activities.journal' ).splitlines() ]
+	assert [ ( e['op'], e['activity']['id'] ) for e in entries ] == [ ( 'update', 2 ), ( 'update', 3 ) ]
+
+	# writing activities.json from cached fragments results in the same file as a full serialization
+	db = ActivityDb( fs=MemoryFS() )
+	db.insert( Activity( uid='a:1', name='one', tags=[ 'tag' ] ), Activity( uid='a:2', starttime=datetime( 2024, 3, 1, 10, 0, 0, tzinfo=UTC ) ) )
+	db.compact()
+	db.get_by_id( 2 ).name = 'two'
+	db.compact()
+	expected = dumps( [ a.to_dict() for a in db.activities ], option=OPT_APPEND_NEWLINE | OPT_INDENT_2 | OPT_SORT_KEYS )
+	assert db.overlay_fs.readbytes( '/activities.json' ) == expected
+
+	# loading keeps the persisted form without encoding it, unchanged dirty activities do not end up in the journal
+	db = ActivityDb( fs=db.overlay_fs )
+	assert isinstance( ( a := db.get_by_id( 1 ) ).__serialized__, dict )
+	a.__dirty__ = True
+	db.commit()
+	assert not db.overlay_fs.exists( '/activities.journal' ) or not db.overlay_fs.readbytes( '/activities.journal' )
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_snapshot( db_path, monkeypatch ):
+	db = ActivityDb( path=db_path, snapshot=True )
+	assert not Path( db_path, 'activities.snapshot' ).exists() # loading does not write to the db directory
+	db.get_by_id( 2 ).name = 'uncommitted'
+	db.save()
+	assert not Path( db_path, 'activities.snapshot' ).exists() # the snapshot must not contain uncommitted changes
+
+	db = ActivityDb( path=db_path, snapshot=True )
+	db.save()
+	assert Path( db_path, 'activities.snapshot' ).exists()
+	activities = db.activities
+
+	# fresh snapshot: activities.json is not parsed at all
+	with monkeypatch.context() as m:
+		m.setattr( 'tracs.db.read_activities', lambda fs: pytest_fail( 'snapshot has not been used' ) )
+		db = ActivityDb( path=db_path, snapshot=True )
+		assert db.activities == activities and not any( a.__dirty__ for a in db.activities )
+		assert db.get_by_uid( 'polar:1001' ).id == 2
+
+	# changes make the snapshot stale
+	db.get_by_id( 2 ).name = 'changed'
+	db.commit()
+	db.save()
+	assert ActivityDb( path=db_path, snapshot=True ).get_by_id( 2 ).name == 'changed'
+	assert ActivityDb( path=db_path, snapshot=True ).get_by_id( 2 ).name == 'changed'
+
+	# dbs on a provided file system write their snapshot as well
+	ActivityDb( fs=( fs := MemoryFS() ), snapshot=True ).save()
+	assert fs.exists( '/activities.snapshot' ) and ActivityDb( fs=fs, snapshot=True )._snapshot_key is not None
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_lazy( db_path ):
+	db = ActivityDb( path=db_path, lazy=True )
+	assert all( a.lazy for a in db.activities )
+
+	# index lookups do not structure activities
+	assert db.get_by_uid( 'polar:1001' ).id == 2
+	assert ids( db.find_for_uid( 'polar:1001' ) ) == [1, 2]
+	assert db._index._resources is None # resources are indexed on first use
+	assert db.contains_resource( uid='polar:1001', path='1001.gpx' )
+	assert all( a.lazy for a in db.activities )
+
+	# first access of a regular field structures the activity
+	a = db.get_by_id( 1 )
+	assert a.name == 'Somewhere in the Forest' and not a.lazy
+	assert a == ActivityDb( path=db_path ).get_by_id( 1 )
+
+	db.get_by_id( 2 ).name = 'changed'
+	db.commit()
+	db.compact()
+	eager = ActivityDb( path=db_path )
+	eager.get_by_id( 2 ).name = 'changed'
+	eager.compact()
+	assert db.overlay_fs.readbytes( '/activities.json' ) == eager.overlay_fs.readbytes( '/activities.json' )
+	assert sum( 1 for a in db.activities if a.lazy ) == len( db.activities ) - 2
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_journal_save( db_path ):
+	db = ActivityDb( path=db_path )
+	db.get_by_id( 1 ).name = 'journaled'
+	db.commit()
+	db.save()
+	assert Path( db_path, 'activities.journal' ).exists()
+	assert ActivityDb( path=db_path ).get_by_id( 1 ).name == 'journaled'
+	assert ActivityDb( path=db_path, read_only=True ).get_by_id( 1 ).name == 'journaled'
+
+	db.compact()
+	db.save()
+	assert not Path( db_path, 'activities.journal' ).exists()
+	assert ActivityDb( path=db_path ).get_by_id( 1 ).name == 'journaled'
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_read_only( db_path ):
+	original = Path( db_path, 'activities.json' ).read_bytes()
+	db = ActivityDb( path=db_path, read_only=True, snapshot=True )
+	assert db.activities == ActivityDb( path=db_path ).activities
+
+	# db files are mapped from disk instead of being copied into memory, the snapshot is not written
+	assert not db.overlay_fs.exists( '/activities.json' ) and not Path( db_path, 'activities.snapshot' ).exists()
+	with mapped( '/activities.json', db.fs ) as content:
+		assert type( content ) is memoryview and content == original
+
+	# changes are not persisted
+	db.get_by_id( 1 ).name = 'pretend'
+	db.commit()
+	db.compact()
+	db.save()
+	assert db.get_by_id( 1 ).name == 'pretend' and db.overlay_fs.exists( '/activities.json' )
+	assert Path( db_path, 'activities.json' ).read_bytes() == original
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_generation( db_path ):
+	db, other = ActivityDb( path=db_path ), ActivityDb( path=db_path )
+	assert db.schema.generation == other.schema.generation == 0
+
+	db.insert( Activity( uid='a:1' ) )
+	db.commit()
+	db.save()
+	assert db.schema.generation == 1 and ActivityDb( path=db_path ).schema.generation == 1
+
+	# saving changes on top of an outdated generation fails, unchanged dbs can be closed
+	other.insert( Activity( uid='a:2' ) )
+	other.commit()
+	with raises( StaleDatabaseException ):
+		other.save()
+	other.close()
+	assert [ a.uid for a in ActivityDb( path=db_path ).activities ] == [ 'a:1' ]
+	ActivityDb( path=db_path ).close()
+
+	# direct writes are checked as well
+	db = ActivityDb( path=db_path, staging=False, journal_threshold=0 )
+	db.insert( Activity( uid='a:3' ) )
+	db.commit()
+	assert db.schema.generation == 2 and len( ActivityDb( path=db_path ).activities ) == 2
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_concurrent_processes( db_path ):
+	workers, count = 4, 5
+	with ProcessPoolExecutor( max_workers=workers + 2 ) as executor:
+		readers = [ executor.submit( read_concurrently, str( db_path ), 20 ) for _ in range( 2 ) ]
+		writers = [ executor.submit( write_concurrently, str( db_path ), w, count ) for w in range( workers ) ]
+		[ w.result() for w in writers ]
+
+		# readers always see a consistent state, which only grows
+		for r in readers:
+			assert ( counts := r.result() ) == sorted( counts )
+
+	# no insert is lost
+	db = ActivityDb( path=db_path )
+	assert len( db.activities ) == workers * count and sorted( db.activity_ids ) == list( range( 1, workers * count + 1 ) )
+	assert db.schema.generation == workers * count
+
+def test_sqlite_insert_upsert_remove():
+	db = SqliteActivityDb()
+	assert db.insert( Activity( uid='a:1' ), Activity( uid='a:2' ), Activity( uid='a:3' ) ) == [1, 2, 3]
+	assert db.activity_keys == [1, 2, 3]
+
+	dt = datetime( 2024, 3, 1, 10, 0, 0, tzinfo=UTC )
+	assert db.upsert( Activity( name='one', uid='one:101', starttime=dt ) ) == 4
+	assert db.upsert( Activity( name='two', uid='one:101', calories=100, starttime=dt ) ) == 4
+	a = db.get_by_id( 4 )
+	assert a.name == 'two' and a.uid == 'one:101' and a.calories == 100 and a.starttime == dt
+
+	db.remove_activity( db.get_by_uid( 'a:2' ) )
+	assert db.activity_keys == [1, 3, 4] and not db.contains_activity( 'a:2' )
+
+	# resources without uid belong to the uid of their activity
+	db.insert( b := Activity( uid='c:1', resources=[ Resource( path='c.gpx', type=GPX_TYPE ) ] ) )
+	assert db.find_resources( 'c:1' ) == db.find_resources( 'c:1', 'c.gpx' ) == [ b.resources[0] ]
+	db.remove_activity( b )
+
+	# duplicates within a batch are rejected as well
+	with raises( KeyError ):
+		db.insert( Activity( uid='b:1' ), Activity( uid='b:1' ) )
+	assert db.activity_keys == [1, 3, 4]
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_sqlite( db_path ):
+	json_to_sqlite( db_path )
+	assert Path( db_path, 'activities.sqlite' ).exists()
+
+	json_db = ActivityDb( path=db_path, summary_types=[POLAR_FLOW_TYPE, STRAVA_TYPE], recording_types=[GPX_TYPE, TCX_TYPE] )
+	db = SqliteActivityDb( path=db_path, summary_types=[POLAR_FLOW_TYPE, STRAVA_TYPE], recording_types=[GPX_TYPE, TCX_TYPE] )
+
+	# sqlite lookups return the same results as the json db
+	assert db.activities == json_db.activities
+	assert db.get_by_id( 2 ) == json_db.get_by_id( 2 ) and db.get_by_id( 2 ) is db.get_by_id( 2 )
+	assert ids( db.find_for_uid( 'polar:1001' ) ) == ids( json_db.find_for_uid( 'polar:1001' ) ) == [1, 2]
+	assert ids( db.find_groups_for_uid( 'strava:1001' ) ) == [1]
+	assert ids( db.find_by_classifier( 'waze' ) ) == ids( json_db.find_by_classifier( 'waze' ) )
+	assert db.contains_activity( 'polar:1001' ) and not db.contains_activity( 'polar:999' )
+	assert db.contains_resource( uid='polar:1001', path='1001.gpx' ) and not db.contains_resource( uid='polar:999', path='999.gpx' )
+	assert db.get_resource_by_uid_path( 'polar:1001', 'polar/1/0/0/1001/1001.gpx' ) == json_db.get_resource_by_uid_path( 'polar:1001', 'polar/1/0/0/1001/1001.gpx' )
+	assert db.find_resources_of_type( GPX_TYPE ) == json_db.find_resources_of_type( GPX_TYPE )
+	assert db.find_recordings() == json_db.find_recordings()
+
+	# changes are written on commit
+	db.get_by_id( 2 ).name = 'changed'
+	db.commit()
+	assert SqliteActivityDb( path=db_path ).get_by_id( 2 ).name == 'changed'
+
+	# back to json, written in the configured format
+	sqlite_to_json( db_path, format='compact', compression='gzip' )
+	assert Path( db_path, 'activities.json' ).read_bytes().startswith( b'\x1f\x8b' )
+	assert ActivityDb( path=db_path ).get_by_id( 2 ).name == 'changed'
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_sqlite_files( db_path ):
+	db = SqliteActivityDb( path=db_path )
+	db.insert( Activity( uid='a:1' ) )
+	db.commit()
+	db.close()
+	assert Path( db_path, 'activities.sqlite' ).exists() and not Path( db_path, 'activities.json' ).exists()
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_sqlite_stale( db_path ):
+	first, second = SqliteActivityDb( path=db_path ), SqliteActivityDb( path=db_path )
+	first.insert( Activity( uid='a:1' ) )
+	first.commit()
+
+	# commits are checked against the generation of the db, the transaction of a stale db is discarded
+	second.insert( Activity( uid='b:1' ) )
+	with raises( StaleDatabaseException ):
+		second.commit()
+	assert [ str( a.uid ) for a in SqliteActivityDb( path=db_path ).activities ] == [ 'a:1' ]
+
+	# reloading picks up the new generation
+	second = SqliteActivityDb( path=db_path )
+	second.insert( Activity( uid='b:1' ) )
+	second.commit()
+	assert [ str( a.uid ) for a in SqliteActivityDb( path=db_path ).activities ] == [ 'a:1', 'b:1' ]
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_save( db_path ):
+	db = ActivityDb( path=db_path, journal_threshold=0 )
+	assert not db.overlay_fs.exists( '/activities.json' ) # db files are not staged until they are written
+
+	# unchanged files are not written
+	modified = Path( db_path, 'activities.json' ).stat().st_mtime_ns
+	db.commit()
+	db.save()
+	assert Path( db_path, 'activities.json' ).stat().st_mtime_ns == modified
+
+	# changed files are replaced, no temporary files are left over
+	db.get_by_id( 1 ).name = 'saved'
+	db.commit()
+	assert ActivityDb( path=db_path ).get_by_id( 1 ).name != 'saved'
+	db.save()
+	assert ActivityDb( path=db_path ).get_by_id( 1 ).name == 'saved'
+	assert sorted( p.name for p in Path( db_path ).iterdir() if p.name.startswith( '.' ) ) == []
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_save_without_staging( db_path ):
+	db = ActivityDb( path=db_path, journal_threshold=0, staging=False )
+	assert type( db.fs ) is OSFS and db.overlay_fs is db.underlay_fs
+
+	db.get_by_id( 1 ).name = 'direct'
+	db.commit()
+	assert ActivityDb( path=db_path ).get_by_id( 1 ).name == 'direct'
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_sharded( db_path ):
+	json_to_shards( db_path )
+	assert Path( db_path, 'activities/manifest.json' ).exists() and Path( db_path, 'activities/2012.json' ).exists()
+
+	json_db = ActivityDb( path=db_path )
+	db = ShardedActivityDb( path=db_path )
+	assert db.manifest['2012']['count'] == 4 and db.loaded_shards == []
+
+	# date ranges only load overlapping shards
+	rule = Rule( 'starttime >= d"2017-04-01T00:00:00+00:00" and starttime < d"2017-07-01T00:00:00+00:00"', CONTEXT )
+	assert ids( db.find( [rule] ) ) == ids( json_db.find( [rule] ) ) == [1998, 1999, 2001]
+	assert db.loaded_shards == [ '2017' ]
+
+	# only the shard of a changed activity is rewritten
+	modified = { key: db.underlay_fs.getinfo( f'/activities/{key}.json', namespaces=['details'] ).modified for key in db.manifest }
+	db.get_by_id( 1998 ).name = 'changed'
+	db.commit()
+	assert db.overlay_fs.exists( '/activities/2017.json' ) and not db.overlay_fs.exists( '/activities/2012.json' )
+	db.save()
+	assert ShardedActivityDb( path=db_path ).get_by_id( 1998 ).name == 'changed'
+	assert all( db.underlay_fs.getinfo( f'/activities/{key}.json', namespaces=['details'] ).modified == m for key, m in modified.items() if key != '2017' )
+
+	# all activities are available
+	assert ids( ShardedActivityDb( path=db_path ).activities ) == ids( json_db.activities )
+
+	# shards are keyed by the utc year of the start time
+	assert shard_key( Activity( starttime=datetime( 2024, 1, 1, 0, 30, tzinfo=tzoffset( None, 7200 ) ) ) ) == '2023'
+
+	# back to json
+	shards_to_json( db_path )
+	assert ActivityDb( path=db_path ).get_by_id( 1998 ).name == 'changed'
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_query_plan( db_path ):
+	json_to_shards( db_path )
+	json_to_sqlite( db_path )
+	json_db = ActivityDb( path=db_path )
+
+	plan = json_db.plan( [ Rule( 'id >= 20 and id < 25 and name != null', CONTEXT ), Rule( 'type.name == "run"', CONTEXT ) ] )
+	assert plan.describe() == [ ( 'lookup', 'id >= 20 and id < 25' ), ( 'filter', 'type.name == "run"' ), ( 'rule', 'name != null' ) ]
+	assert json_db.plan( [ Rule( 'name == "x" or id == 1', CONTEXT ) ] ).describe() == [ ( 'scan', 'all activities' ), ( 'rule', 'name == "x" or id == 1' ) ]
+
+	# planned queries return the same activities as evaluating the rules against all activities
+	for text in [ 'id == 1', 'id in [1, 2, 3, 999]', 'id >= 20 and id < 25', 'id > 30 and starttime >= d"2017-01-01T00:00:00+00:00"', 'name != null and id <= 5' ]:
+		expected = ids( Rule( text, CONTEXT ).filter( json_db.activities ) )
+		for db in [ json_db, ShardedActivityDb( path=db_path ), SqliteActivityDb( path=db_path ) ]:
+			assert ids( db.find( [ Rule( text, CONTEXT ) ] ) ) == expected, f'{text} failed for {db.__class__.__name__}'
+
+	# uids and classifiers are looked up, classifiers of multiparts do not exist
+	assert ids( json_db.find( [ Rule( 'uid == "polar:1001"', CONTEXT ) ] ) ) == [ 2 ]
+	polar = [ a.id for a in json_db.activities if a.classifiers and 'polar' in a.classifiers ]
+	assert ids( json_db.find( [ Rule( '"polar" in classifiers', CONTEXT ) ] ) ) == polar and 1 in polar
+	assert ids( ActivityDb( path=db_path, lazy=True ).find( [ Rule( '"polar" in classifiers', CONTEXT ) ] ) ) == polar
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_time_index( db_path ):
+	json_to_shards( db_path )
+	json_to_sqlite( db_path )
+	json_db = ActivityDb( path=db_path )
+	timed = lambda activities, name='starttime': [ a.id for a in sorted( [ a for a in activities if getattr( a, name ) ], key=lambda a: ( getattr( a, name ), a.id ) ) ]
+	order_of = lambda activities: [ a.id for a in activities ]
+
+	# date ranges are looked up and results are emitted in time order
+	text = 'starttime >= d"2012-01-01T00:00:00+00:00" and starttime < d"2023-01-01T00:00:00+00:00"'
+	assert json_db.plan( [ Rule( text, CONTEXT ) ] ).describe() == [ ( 'lookup', text ) ]
+	expected = list( Rule( text, CONTEXT ).filter( json_db.activities ) )
+	for db in [ json_db, ShardedActivityDb( path=db_path ), SqliteActivityDb( path=db_path ), ActivityDb( path=db_path, lazy=True ) ]:
+		assert ids( db.find( [ Rule( text, CONTEXT ) ] ) ) == ids( expected ), f'failed for {db.__class__.__name__}'
+		assert order_of( db.find( [ Rule( text, CONTEXT ) ], order='starttime' ) ) == timed( expected ), f'failed for {db.__class__.__name__}'
+
+	# unbounded queries are ordered as well, activities without start time come last
+	ordered = json_db.find( [], order='starttime_local' )
+	assert order_of( ordered ) == timed( json_db.activities, 'starttime_local' ) + [ a.id for a in json_db.activities if not a.starttime_local ]
+
+	# lazy activities are not structured by looking them up
+	lazy_db = ActivityDb( path=db_path, lazy=True )
+	lazy_db.find( [ Rule( text, CONTEXT ) ], order='starttime' )
+	assert all( a.lazy for a in lazy_db.activities )
+
+	# changed start times are picked up before and on commit
+	a = json_db.find( [ Rule( text, CONTEXT ) ], order='starttime' )[0]
+	a.starttime = datetime( 2024, 6, 1, tzinfo=UTC )
+	json_db.commit()
+	assert a.id not in order_of( json_db.find( [ Rule( text, CONTEXT ) ] ) )
+	a.starttime = datetime( 2015, 6, 1, tzinfo=UTC ) # moved back into the range, not committed yet
+	assert a.id in order_of( json_db.find( [ Rule( text, CONTEXT ) ] ) )
+	assert order_of( json_db.find( [ Rule( text, CONTEXT ) ], order='starttime' ) ) == timed( Rule( text, CONTEXT ).filter( json_db.activities ) )
+	json_db.commit()
+	assert order_of( json_db.find( [], order='starttime' ) )[:len( timed( json_db.activities ) )] == timed( json_db.activities )
+
+@mark.skipif( not columnar_available(), reason='columnar evaluation requires numpy' )
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_columnar( db_path ):
+	json_to_sqlite( db_path )
+	rules = [
+		'distance != null and distance > 5000', 'heartrate == null or heartrate < 140', 'not ( starttime > d"2020-01-01T00:00:00+00:00" )',
+		'type != null and type.name == "run"', 'id in [1, 2, 3, 999]', 'duration != null and duration > t"PT1H"', 'name != null and distance == null',
+	]
+	plain = ActivityDb( path=db_path )
+	for db in [ ActivityDb( path=db_path, columnar=True ), ActivityDb( path=db_path, columnar=True, lazy=True ), SqliteActivityDb( path=db_path, columnar=True ) ]:
+		for text in rules:
+			assert ids( db.find( [ Rule( text, CONTEXT ) ] ) ) == ids( plain.find( [ Rule( text, CONTEXT ) ] ) ), f'{text} failed for {db.__class__.__name__}'
+
+	# errors of rule engine are kept, as undecided rows are evaluated per activity
+	with raises( EvaluationError ):
+		ActivityDb( path=db_path, columnar=True ).find( [ Rule( 'distance > 5000', CONTEXT ) ] )
+
+	# changes are visible before and after commit
+	db, rule = ActivityDb( path=db_path, columnar=True ), Rule( 'distance != null and distance > 100000', CONTEXT )
+	assert ids( db.find( [ rule ] ) ) == []
+	db.get_by_id( 1 ).distance = 200000.0
+	assert ids( db.find( [ rule ] ) ) == [ 1 ]
+	db.commit()
+	assert ids( db.find( [ rule ] ) ) == [ 1 ] and not db.get_by_id( 1 ).__dirty__
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_format( db_path ):
+	pretty, original = ActivityDb( path=db_path ), Path( db_path, 'activities.json' ).read_bytes()
+	db = ActivityDb( path=db_path, format='compact', compression='gzip', lazy=True )
+	assert db.format.name == 'compact' and db.format.compression == 'gzip'
+
+	# compact files are minified and compressed, reading does not depend on the format
+	db.get_by_id( 1 ) # hydrates the activity, which is written in its persisted form
+	db.compact()
+	db.save()
+	content = Path( db_path, 'activities.json' ).read_bytes()
+	assert content.startswith( b'\x1f\x8b' ) and b'\n  ' not in decompress( content )
+	assert ActivityDb( path=db_path ).activities == pretty.activities
+	assert ActivityDb( path=db_path, snapshot=True ).activities == pretty.activities
+
+	# pretty dump provides a readable copy
+	pretty_dump( db.activities, OSFS( db_path ) )
+	assert loads( Path( db_path, 'activities.pretty.json' ).read_bytes() ) == loads( original )
+
+	# back to pretty
+	db = ActivityDb( path=db_path )
+	db.compact()
+	db.save()
+	content = Path( db_path, 'activities.json' ).read_bytes()
+	assert content.startswith( b'[\n  {\n    "' ) and loads( content ) == loads( original )
+
+	# serialized activities in a snapshot depend on the format, switching the format does not mix formats
+	db = ActivityDb( path=db_path, snapshot=True )
+	db.get_by_id( 1 ).name = 'changed'
+	db.commit()
+	db.save()
+	assert Path( db_path, 'activities.snapshot' ).exists()
+	db = ActivityDb( path=db_path, snapshot=True, format='compact' )
+	db.compact()
+	db.save()
+	content = Path( db_path, 'activities.json' ).read_bytes()
+	assert b'\n  ' not in content and loads( content )[0]['name'] == 'changed'
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_migrate_schema( ctx ):
+	fs = ctx.db_fs
+	activities = loads( fs.readbytes( 'activities.json' ) )
+	version = migrate_schema( ctx, fs, steps=[ Migration( version=15, name='mark', transform=_mark ) ] )
+
+	assert version == load_schema( fs ).version == 15
+	migrated = loads( fs.readbytes( 'activities.json' ) )
+	assert migrated == [ { **a, 'migrated': 1 } for a in activities ]
+	assert fs.readbytes( 'activities.json' ) == dumps( migrated, option=OPT_APPEND_NEWLINE | OPT_INDENT_2 | OPT_SORT_KEYS ) # format is kept
+	assert not fs.exists( PROGRESS_NAME ) and not fs.exists( '.activities.json.migrating' )
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_migrate_resume( ctx, monkeypatch ):
+	fs = ctx.db_fs
+	fs.writebytes( 'activities.json', compress( fs.readbytes( 'activities.json' ), GZIP ) )
+	count, calls = len( loads( decompress( fs.readbytes( 'activities.json' ) ) ) ), []
+
+	def interrupt( a, index, ctx ):
+		if len( calls ) == 5:
+			raise KeyboardInterrupt
+		calls.append( a['id'] )
+		return _mark( a, index, ctx )
+
+	monkeypatch.setattr( 'tracs.migrate.CHECKPOINT_INTERVAL', 2 )
+	with raises( KeyboardInterrupt ):
+		migrate_schema( ctx, fs, steps=[ Migration( version=15, name='mark', transform=interrupt ) ] )
+	assert fs.exists( PROGRESS_NAME ) and load_schema( fs ).version == 14
+	assert loads( fs.readbytes( PROGRESS_NAME ) )['records'] == 4
+
+	calls.clear()
+	migrate_schema( ctx, fs, steps=[ Migration( version=15, name='mark', transform=lambda a, index, ctx: calls.append( a['id'] ) or _mark( a, index, ctx ) ) ] )
+	assert len( calls ) == count - 4 # records before the last checkpoint are not migrated again
+	migrated = loads( decompress( fs.readbytes( 'activities.json' ) ) )
+	assert fs.readbytes( 'activities.json' ).startswith( b'\x1f\x8b' ) and len( migrated ) == count
+	assert all( a['migrated'] == 1 for a in migrated )
+	assert load_schema( fs ).version == 15 and not fs.exists( PROGRESS_NAME )
+
+@mark.context( env='empty', persist='clone', cleanup=True )
+def test_consolidate_activity_ids( ctx ):
+	ctx.db = ActivityDb( path=ctx.db_dir_path )
+	dt = datetime( 2024, 3, 1, 10, 0, 0, tzinfo=UTC )
+	ctx.db.insert( Activity( uid='a:1' ), Activity( uid='a:2', starttime=dt ), Activity( uid='a:3', starttime=dt.replace( year=2023 ) ) )
+	ctx.db.remove_activity( ctx.db.get_by_uid( 'a:1' ) )
+
+	migrate_db( ctx, 'consolidate_activity_ids' )
+	ctx.db.save()
+	db = ActivityDb( path=ctx.db_dir_path )
+	assert [ ( a.id, str( a.uid ) ) for a in db.activities ] == [ ( 1, 'a:3' ), ( 2, 'a:2' ) ]
+	assert db.get_by_uid( 'a:3' ).id == 1 and db.get_by_id( 2 ).uid == 'a:2'
+
+@mark.skipif( ZstdCompressor is None, reason='zstandard is not installed' )
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_migrate_zstd( ctx ):
+	fs = ctx.db_fs
+	activities = ActivityDb( fs=fs ).activities
+	fs.writebytes( 'activities.json', compress( fs.readbytes( 'activities.json' ), ZSTD ) )
+	migrate_schema( ctx, fs, steps=[ Migration( version=15, name='mark', transform=_mark ) ] )
+
+	assert fs.readbytes( 'activities.json' ).startswith( b'\x28\xb5\x2f\xfd' )
+	assert all( a['migrated'] == 1 for a in loads( decompress( fs.readbytes( 'activities.json' ) ) ) )
+	assert [ a.id for a in ActivityDb( fs=fs ).activities ] == [ a.id for a in activities ]
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_migrate_groups( ctx ):
+	fs, dt = ctx.db_fs, '2024-03-01T10:00:00+00:00'
+	fs.writebytes( 'activities.json', dumps( [ { 'id': 1, 'uids': [ 'polar:1' ] }, { 'id': 2, 'uids': [ 'polar:2', 'strava:2' ], 'starttime': dt } ] ) )
+	original, schema = fs.readbytes( 'activities.json' ), load_schema( fs )
+
+	# migrated activities are written to a separate file, the db is left untouched
+	migrate_db( ctx, 'groups' )
+	assert loads( fs.readbytes( 'activities2.json' ) ) == [ { 'id': 1, 'uid': 'polar:1' }, { 'id': 2, 'uid': 'group:240301100000', 'uids': [ 'polar:2', 'strava:2' ], 'starttime': dt } ]
+	assert fs.readbytes( 'activities.json' ) == original and load_schema( fs ) == schema
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_stage_index( ctx, registry ):
+	ctx.registry = registry
+	# both stages contain the same resource, the first one wins
+	stages = [
+		{ 'uid': 'group:1', 'uids': [ 'polar:1/1.gpx' ], 'resources': [], 'starttime': '2024-03-01T10:00:00+00:00' },
+		{ 'uid': 'polar:1/1.gpx', 'resources': [], 'starttime': '2024-03-01T11:00:00+00:00' },
+	]
+	assert list( _stage_index( iter( stages ), ctx ).values() ) == [ 'polar:240301100000' ]
+
 # helper
 
+def read_concurrently( path: str, rounds: int ) -> List[int]:
+	counts = []
+	for _ in range( rounds ):
+		db = ActivityDb( path=Path( path ), read_only=True )
+		assert len( { str( a.uid ) for a in db.activities } ) == len( db.activities )
+		counts.append( len( db.activities ) )
+	return counts
+
+def write_concurrently( path: str, worker: int, count: int ) -> None:
+	for i in range( count ):
+		while True:
+			db = ActivityDb( path=Path( path ) )
+			db.insert( Activity( uid=f'worker{worker}:{i}' ) )
+			db.commit()
+			try:
+				db.save()
+				break
+			except StaleDatabaseException: # another process has saved in between, reload and retry
+				pass
+
 def ids( elements: List[Union[Activity,Resource]] ) -> List[int]:
 	return sorted( [e.id for e in elements] )
+
+def _mark( a, index, ctx ):
+	a['migrated'] = a.get( 'migrated', 0 ) + 1
+	return a
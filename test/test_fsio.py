@@ -1,12 +1,16 @@
 from datetime import datetime, timedelta
+from hashlib import blake2b
 from json import loads
+from os import stat, urandom
+from pathlib import Path
 
 from dateutil.tz import UTC
 from pytest import mark
 
 from activity import Activities, ActivityPart
 from core import Metadata
-from fsio import load_activities, load_schema, write_activities
+from config import ApplicationContext
+from fsio import backup_db, list_backups, load_activities, load_schema, read_backup_manifest, restore_db, write_activities, write_atomic
 from resources import Resources
 from test.objects import COMPLETE_ACTIVITY as A, COMPLETE_ACTIVITY_DICT as AD, COMPLETE_ACTIVITY_WITH_RESOURCE_DATA as AC
 from uid import UID
@@ -67,3 +71,65 @@ def test_activities( dbfs ):
 
 	assert a1.metadata.created == datetime( 2024, 1, 4, 10, 0, 0, tzinfo=UTC )
 	assert a1.metadata.favourite
+
+@mark.context( env='default', persist='clone', cleanup=True )
+def test_backup_restore( ctx: ApplicationContext ):
+	db_path, backup_path = Path( ctx.db_fs.getsyspath( '/' ) ), Path( ctx.backup_fs.getsyspath( '/' ) )
+	activities = Path( db_path, 'activities.json' )
+	original = activities.read_bytes()
+
+	first = backup_db( ctx.db_fs, ctx.backup_fs )
+	files = read_backup_manifest( ctx.backup_fs, first )['files']
+	assert 'activities.json' in files and any( '/' in f for f in files ) # resources are included
+	objects = set( backup_path.glob( 'objects/*/*' ) )
+	assert len( objects ) == len( { e['hash'] for e in files.values() } )
+
+	# second backup only stores the changed file
+	activities.write_bytes( b'[]' )
+	second = backup_db( ctx.db_fs, ctx.backup_fs )
+	assert list_backups( ctx.backup_fs ) == [ first, second ]
+	assert len( set( backup_path.glob( 'objects/*/*' ) ) - objects ) == 1
+
+	# restore latest, then the first backup
+	restore_db( ctx.db_fs, ctx.backup_fs, force=True )
+	assert activities.read_bytes() == b'[]'
+	restore_db( ctx.db_fs, ctx.backup_fs, force=True, name=first )
+	assert activities.read_bytes() == original
+	assert stat( activities ).st_mtime_ns == files['activities.json']['mtime']
+
+	# uncompressed db files are restored as hard links, resources are restored as writable copies
+	db_file = next( k for k, e in files.items() if '/' not in k and Path( backup_path, 'objects', e['hash'][:2], e['hash'] ).exists() )
+	resource = next( k for k in files if '/' in k )
+	content = Path( db_path, resource ).read_bytes()
+	Path( db_path, db_file ).unlink()
+	Path( db_path, resource ).unlink()
+	restore_db( ctx.db_fs, ctx.backup_fs, force=True, name=first )
+	assert stat( Path( db_path, db_file ) ).st_nlink > 1
+	assert Path( db_path, resource ).read_bytes() == content
+	assert stat( Path( db_path, resource ) ).st_nlink == 1 and stat( Path( db_path, resource ) ).st_mode & 0o200
+
+	# hard linked db files are writable, so files saved later on are writable as well and do not touch the stored object
+	stored = Path( backup_path, 'objects', files[db_file]['hash'][:2], files[db_file]['hash'] )
+	assert stat( Path( db_path, db_file ) ).st_mode & 0o200
+	write_atomic( f'/{db_file}', b'saved', ctx.db_fs )
+	assert stat( Path( db_path, db_file ) ).st_mode & 0o200 and stat( Path( db_path, db_file ) ).st_nlink == 1
+	assert blake2b( stored.read_bytes(), digest_size=20 ).hexdigest() == files[db_file]['hash']
+
+	# db files created after the backup are removed, resources created after the backup are kept
+	Path( db_path, 'activities' ).mkdir( exist_ok=True )
+	Path( db_path, 'activities', '2024.json' ).write_bytes( b'[]' )
+	Path( db_path, 'polar', 'later.gpx' ).write_bytes( b'<gpx/>' )
+	restore_db( ctx.db_fs, ctx.backup_fs, force=True, name=first )
+	assert not Path( db_path, 'activities', '2024.json' ).exists() and Path( db_path, 'polar', 'later.gpx' ).exists()
+
+	# the journal is appended to, so it is restored as a copy as well and appending does not change the stored object
+	journal = Path( db_path, 'activities.journal' )
+	journal.write_bytes( urandom( 1024 ) ) # incompressible, so it is stored uncompressed
+	entry = read_backup_manifest( ctx.backup_fs, backup_db( ctx.db_fs, ctx.backup_fs ) )['files']['activities.journal']
+	journal.unlink()
+	restore_db( ctx.db_fs, ctx.backup_fs, force=True )
+	assert stat( journal ).st_nlink == 1
+	with open( journal, 'ab' ) as f:
+		f.write( b'appended' )
+	stored = Path( backup_path, 'objects', entry['hash'][:2], entry['hash'] )
+	assert blake2b( stored.read_bytes(), digest_size=20 ).hexdigest() == entry['hash']
@@ -11,8 +11,8 @@ from tracs.core import Metadata
 from tracs.activity import Activity, ActivityPart
 from tracs.activity_types import ActivityTypes
 from tracs.plugins.rule_extensions import TIME_FRAMES as TIME_FRAMES_EXT
-from tracs.rules import DATE_PATTERN, DATE_RANGE_PATTERN, FUZZY_DATE_PATTERN, FUZZY_TIME_PATTERN, INT_LIST, INT_PATTERN, KEYWORD_PATTERN, LIST_PATTERN, \
-	parse_date_range_as_str, RANGE_PATTERN, RULE_PATTERN, TIME_PATTERN, TIME_RANGE_PATTERN
+from tracs.rules import date_range, DATE_PATTERN, DATE_RANGE_PATTERN, FUZZY_DATE_PATTERN, FUZZY_TIME_PATTERN, INT_LIST, INT_PATTERN, KEYWORD_PATTERN, LIST_PATTERN, \
+	parse_date_range_as_str, RANGE_PATTERN, resolve_custom_attribute, RULE_PATTERN, RuleParser, TIME_PATTERN, TIME_RANGE_PATTERN
 from uid import UID
 
 log = getLogger( __name__ )
@@ -386,3 +386,40 @@ def test_parse_date_range():
 	assert parse_date_range_as_str( '2022-03-15..2022-03-16' ) == ('2022-03-15T00:00:00+00:00', '2022-03-16T23:59:59.999999+00:00')
 	assert parse_date_range_as_str( '..2022-03-16' ) == ('0001-01-01T00:00:00+00:00', '2022-03-16T23:59:59.999999+00:00')
 	assert parse_date_range_as_str( '2022-03-15..' ) == ('2022-03-15T00:00:00+00:00', '9999-12-31T00:00:00+00:00')
+
+def test_date_range( rule_parser ):
+	p = rule_parser
+
+	assert date_range( p.parse_rule( 'date:2022..2023' ) ) == (datetime( 2022, 1, 1, tzinfo=UTC ), datetime( 2023, 12, 31, 23, 59, 59, 999999, tzinfo=UTC ))
+	assert date_range( p.parse_rule( 'year=2022' ) ) == (datetime( 2022, 1, 1, tzinfo=UTC ), datetime( 2022, 12, 31, 23, 59, 59, tzinfo=UTC ))
+	assert date_range( p.parse_rule( 'date:2022..' ), p.parse_rule( 'date:..2023' ) ) == (datetime( 2022, 1, 1, tzinfo=UTC ), datetime( 2023, 12, 31, 23, 59, 59, 999999, tzinfo=UTC ))
+	assert date_range( p.parse_rule( 'name:berlin' ) ) == (None, None)
+	assert date_range() == (None, None)
+
+def test_rule_cache( rule_parser, monkeypatch ):
+	p = rule_parser
+	assert p.parse_rule( 'id=1000' ) is p.parse_rule( 'id=1000' )
+	assert p.parse_rule( 'id=1000' ) is p.parse_rule( 'id==1000' ) # compiled rules are shared by normalized rules
+	assert p.parse_rule( 'thisyear' ) is p.parse_rule( 'thisyear' )
+
+	# time-relative keywords are expanded again on the next day
+	normalized = []
+	monkeypatch.setattr( RuleParser, 'normalize', lambda self, rule, fn=RuleParser.normalize: normalized.append( rule ) or fn( self, rule ) )
+	p.parse_rule( 'thisyear' )
+	assert normalized == []
+	p._day = datetime( 2000, 1, 1 ).date()
+	p.parse_rule( 'thisyear' )
+	assert normalized == [ 'thisyear' ]
+
+def test_resolve_custom_attribute( rule_parser ):
+	a = Activity( id=1, name='Berlin', starttime_local=datetime( 2023, 6, 1, 10, tzinfo=UTC ) )
+	assert resolve_custom_attribute( a, 'name' ) == 'Berlin'
+	assert resolve_custom_attribute( a, 'year' ) == 2023 and resolve_custom_attribute( a, 'hour' ) == 10
+	assert resolve_custom_attribute( ActivityTypes.run, 'name' ) == 'run' # not an attrs class
+	with raises( SymbolResolutionError ):
+		resolve_custom_attribute( a, 'unknown' )
+
+	# virtual fields are bound to their parent without touching shared state
+	b = Activity( id=2, starttime_local=datetime( 2022, 1, 1, 10, tzinfo=UTC ) )
+	vf_a, vf_b = a.vf, b.vf
+	assert vf_a.year == 2023 and vf_b.year == 2022
@@ -1,21 +1,24 @@
 
 from __future__ import annotations
 
+from collections import Counter
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import cached_property
 from inspect import isfunction
 from itertools import chain
 from logging import getLogger
-from typing import Any, Callable, ClassVar, Dict, List, Optional, TypeVar, Union
+from typing import Any, Callable, ClassVar, Dict, get_type_hints, List, Optional, TypeVar, Union
 
-from attrs import define, evolve, Factory, field
+from attrs import Attribute, define, evolve, Factory, field, fields, setters
 from cattrs import Converter, GenConverter
+from cattrs.gen import make_dict_structure_fn, make_dict_unstructure_fn, override
 from dateutil.tz import UTC
 from more_itertools import first, first_true, last, unique
 from tzlocal import get_localzone_name
 
 from tracs.activity_types import ActivityTypes
-from tracs.core import FormattedFieldsBase, Metadata, VirtualFieldsBase
+from tracs.core import FormattedFieldsBase, IdAllocator, Metadata, TrackedList, VirtualField, VirtualFieldsBase
 from tracs.resources import Resource, Resources
 from tracs.ui.utils import fmt_datetime, fmt_decimal, fmt_default, fmt_timedelta
 from tracs.uid import UID
@@ -25,6 +28,24 @@ log = getLogger( __name__ )
 
 T = TypeVar('T')
 
+INDEX_FIELDS = [ 'id', 'uid' ]
+"""fields which are always structured, even for lazily loaded activities"""
+PARTIAL_FIELDS = { 'resources': Resources }
+"""fields of lazily loaded activities which are structured on their own on first access, without the other fields"""
+
+_MISSING = object()
+
+def _mark_dirty( instance: Activity, attribute: Attribute, value: Any ) -> Any:
+	if not attribute.name.startswith( '__' ):
+		instance.__dirty__ = True
+	return value
+
+def _clear_memo( instance: Activity, attribute: Attribute, value: Any ) -> Any:
+	if instance.__memo__ and not attribute.name.startswith( '__' ):
+		for name in [ n for n in instance.__memo__ if not ( sources := Activity.__vf__[n].sources ) or attribute.name in sources ]:
+			del instance.__memo__[name]
+	return value
+
 @define( eq=True )
 class ActivityPart:
 
@@ -63,10 +84,11 @@ class ActivityPart:
 	def to_dict( self ) -> Dict[str, Any]:
 		return ActivityPart.converter.unstructure( self )
 
-@define( eq=True, repr=False ) # todo: mark fields with proper eq attributes
+@define( eq=True, repr=False, on_setattr=[ setters.convert, setters.validate, _mark_dirty, _clear_memo ] ) # todo: mark fields with proper eq attributes
 class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 
 	converter: ClassVar[Converter] = GenConverter( omit_if_default=True )
+	json_converter: ClassVar[Converter] = None # converter for writing activities.json, datetimes are left to orjson
 
 	# fields
 	id: int = field( default=None, metadata={ 'protected': True } )
@@ -142,9 +164,15 @@ class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 	other_parts = field( default=None )
 
 	## internal fields
-	__dirty__: bool = field( init=False, default=False, repr=False, alias='__dirty__' )
+	__dirty__: bool = field( init=False, default=False, eq=False, repr=False, alias='__dirty__' )
+	__serialized__: Optional[bytes|Dict[str, Any]] = field( init=False, default=None, eq=False, repr=False, alias='__serialized__' )
+	"""cached serialized form of this activity, only valid as long as the activity is not dirty (raw dict after hydration)"""
 	__parent__: Activity = field( init=False, default=None, alias='__parent__' )
 	__parent_id__: int = field( init=False, default=0, alias='__parent_id__' )
+	__raw__: Optional[Dict[str, Any]] = field( init=False, default=None, eq=False, repr=False, alias='__raw__' )
+	"""raw data of a lazily loaded activity, all fields except the index fields are structured on first access"""
+	__memo__: Optional[Dict[str, Any]] = field( init=False, default=None, eq=False, repr=False, alias='__memo__' )
+	"""cached values of memoised virtual fields"""
 
 	# additional properties
 
@@ -207,6 +235,41 @@ class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 	def __repr__( self ) -> str:
 		return f'{self.name} [{self.uid}] [{self.starttime}]'
 
+	def __getattr__( self, name: str ) -> Any:
+		# only called when an attribute is not set, for lazy activities this is the case for all non-index fields
+		if name in PARTIAL_FIELDS and self.__raw__ is not None:
+			value = Activity.converter.structure( self.__raw__[name], PARTIAL_FIELDS[name] ) if name in self.__raw__ else PARTIAL_FIELDS[name]()
+			object.__setattr__( self, name, value ) # kept on hydration
+			return value
+		elif name in LAZY_FIELDS and self.__raw__ is not None:
+			self.__hydrate__()
+			return getattr( self, name )
+		return super().__getattr__( name )
+
+	def vf_value( self, vf: VirtualField ) -> Any:
+		if not vf.memo:
+			return super().vf_value( vf )
+		if self.__memo__ is None:
+			self.__memo__ = {}
+		if ( value := self.__memo__.get( vf.name, _MISSING ) ) is _MISSING:
+			value = self.__memo__[vf.name] = super().vf_value( vf )
+		return value
+
+	def __hydrate__( self ) -> None:
+		raw, self.__raw__ = self.__raw__, None
+		if not self.__dirty__ and self.__serialized__ is None:
+			self.__serialized__ = raw # hydration does not change anything, so keep the persisted form (serialized on commit)
+		activity = Activity.from_dict( raw )
+		for name in LAZY_FIELDS:
+			try:
+				object.__getattribute__( self, name ) # keep values which have been set before hydration
+			except AttributeError:
+				object.__setattr__( self, name, getattr( activity, name ) )
+
+	@property
+	def lazy( self ) -> bool:
+		return self.__raw__ is not None
+
 	# additional methods
 
 	# def union( self, others: List[Activity], strategy: Literal['first', 'last'] = 'first' ) -> Activity: # todo: are different strategies useful?
@@ -291,8 +354,8 @@ class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 		return this
 
 	def add_resource( self, resource: Resource ) -> None:
-		self.__resources__.append( resource )
-		resource.__parent_activity__ = self
+		self.resources.append( resource )
+		self.__dirty__ = True
 
 	def resource_of_type( self, resource_type: str ) -> Optional[Resource]:
 		return first_true( self.resources.iter(), default=None, pred=lambda r: r.type == resource_type )
@@ -308,11 +371,11 @@ class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 
 	def tag( self, tag: str ):
 		if tag not in self.tags:
-			self.tags.append( tag )
-			self.tags = sorted( self.tags )
+			self.tags = sorted( [ *self.tags, tag ] )
 
 	def untag( self, tag: str ):
 		self.tags.remove( tag )
+		self.__dirty__ = True
 
 	@classmethod
 	def union_of( cls, *activities: Activity, ignored_fields: List[str] = None, force: bool = False, target: Activity = None ) -> Activity:
@@ -362,6 +425,7 @@ class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 		if not target.metadata.created:
 			target.metadata.created = target.metadata.modified
 
+		target.__dirty__ = True
 		return target
 
 	@classmethod
@@ -375,6 +439,7 @@ class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 		# update members + resources
 		target.metadata.members = sorted( [ a.uid for a in activities ] )
 		target.resources = Resources( lst=sorted( [ r for a in activities for r in a.resources ], key=lambda r: r.path ) )
+		target.__dirty__ = True
 
 		return target
 
@@ -428,13 +493,27 @@ class Activity( VirtualFieldsBase, FormattedFieldsBase ):
 	# serialization
 
 	@classmethod
-	def from_dict( cls, obj: Dict[str, Any] ) -> Activity:
-		return Activity.converter.structure( obj, Activity )
+	def from_dict( cls, obj: Dict[str, Any], lazy: bool = False ) -> Activity:
+		"""
+		Structures an activity from the provided dict.
+
+		:param obj: dict to structure
+		:param lazy: only structure the index fields, all other fields are structured on first access
+		:return: activity
+		"""
+		if not lazy:
+			return Activity.converter.structure( obj, Activity )
+
+		activity = Activity.converter.structure( { k: v for k, v in obj.items() if k in INDEX_FIELDS }, Activity )
+		for name in LAZY_FIELDS:
+			object.__delattr__( activity, name )
+		activity.__raw__ = obj
+		return activity
 
 	def to_dict( self ) -> Dict[str, Any]:
 		return Activity.converter.unstructure( self )
 
-class Activities( list[Activity] ):
+class Activities( TrackedList, list[Activity] ):
 	"""
 	Extended list of activities.
 	"""
@@ -443,13 +522,24 @@ class Activities( list[Activity] ):
 
 	def __init__( self, *activities: Activity, lst: Optional[List[Activity]] = None, skip_checks: bool = False ):
 		super().__init__()
+		self.__allocator__ = IdAllocator()
+		self.__uids__: Dict[UID, Activity] = {}
+		self.__keys__: Dict[int, UID] = {} # uid each activity is keyed under, key is the object id of the activity
+		self.__synced__ = self.__version__
 		self.add( *activities, lst=lst, skip_checks=skip_checks )
 
+	# id allocator and uid map are maintained by add()/remove()/rekey(), other list modifications cause a rebuild
+	def __sync__( self ) -> None:
+		if getattr( self, '__synced__', None ) != self.__version__:
+			self.__allocator__ = IdAllocator( used={ a.id for a in self if a.id is not None } )
+			self.__uids__ = { a.uid: a for a in self if a.uid is not None }
+			self.__keys__ = { id( a ): a.uid for a in self if a.uid is not None }
+			self.__synced__ = self.__version__
+
 	# calculation of next id
 	def __next_id__( self ) -> int:
-		existing_ids = [a.id for a in self]
-		id_range = range( 1, max( existing_ids ) + 2 ) if len( existing_ids ) > 0 else [1]
-		return set( id_range ).difference( set( existing_ids ) ).pop()
+		self.__sync__()
+		return self.__allocator__.next()
 
 	def __contains__( self, item: Activity|UID ) -> bool:
 		if isinstance( item, Activity ):
@@ -460,7 +550,7 @@ class Activities( list[Activity] ):
 			return False
 
 	def __contains_uid__( self, uid: UID ):
-		return any( [a.uid == uid for a in self] )
+		return self.get_by_uid( uid ) is not None
 
 	# def replace( self, new: Activity, old: Activity = None, id: int = None, uid = None ) -> None:
 	# 	if not new:
@@ -481,16 +571,27 @@ class Activities( list[Activity] ):
 
 	def add( self, *activities: Activity, lst: Optional[List[Activity]] = None, skip_checks: bool = False ) -> List[int]:
 		activities = [ *activities, *(lst if lst else []) ]
+		self.__sync__()
+
+		if not skip_checks:
+			uids = [ a.uid for a in activities ]
+			if None in uids:
+				raise KeyError( f'activity must have a valid UID to be added (UID = None)' )
+			if len( set( uids ) ) < len( uids ) or not self.__uids__.keys().isdisjoint( uids ):
+				counts = Counter( uids )
+				duplicate = next( uid for uid in uids if uid in self.__uids__ or counts[uid] > 1 )
+				raise KeyError( f'activity with UID {duplicate} already contained in activities' )
+
 		for a in activities:
 			if not skip_checks:
-				if a.uid is None:
-					raise KeyError( f'activity must have a valid UID to be added (UID = {a.uid})' )
-				if self.__contains_uid__( a.uid ):
-					raise KeyError( f'activity with UID {a.uid} already contained in activities' )
-
-				a.id = self.__next_id__()
+				a.id = self.__allocator__.next()
+			self.__allocator__.add( a.id )
+			if a.uid is not None:
+				self.__uids__[a.uid] = a
+				self.__keys__[id( a )] = a.uid
 
-			self.append( a )
+		self.extend( activities )
+		self.__synced__ = self.__version__
 
 		return [a.id for a in activities]
 
@@ -499,7 +600,26 @@ class Activities( list[Activity] ):
 			if a:= self.get_by_uid( item ):
 				self.remove( a )
 		else:
+			self.__sync__()
 			super().remove( item )
+			self.__allocator__.remove( item.id )
+			self._unkey( item )
+			self.__synced__ = self.__version__
+
+	def rekey( self, *activities: Activity ) -> None:
+		"""
+		Updates the uid map after the uids of the provided activities have been changed.
+		"""
+		self.__sync__()
+		for a in activities:
+			self._unkey( a )
+			if a.uid is not None:
+				self.__uids__[a.uid] = a
+				self.__keys__[id( a )] = a.uid
+
+	def _unkey( self, activity: Activity ) -> None:
+		if ( uid := self.__keys__.pop( id( activity ), None ) ) is not None and self.__uids__.get( uid ) is activity:
+			del self.__uids__[uid]
 
 	def all( self, sort: bool|Callable = False, reverse: bool = False ) -> List[Activity]:
 		if sort is True:
@@ -530,7 +650,12 @@ class Activities( list[Activity] ):
 		return first_true( self, pred=lambda a: a.id == id )
 
 	def get_by_uid( self, uid: UID|str ) -> Optional[Activity]:
-		return first_true( self, pred=lambda a: a.uid == uid )
+		self.__sync__()
+		if ( a := self.__uids__.get( uid ) ) is not None and a.uid != uid: # uid has been changed without rekey()
+			self.__synced__ = None
+			self.__sync__()
+			a = self.__uids__.get( uid )
+		return a
 
 	def idget( self, id: int ) -> Optional[Activity]:
 		return self.get_by_id( id )
@@ -550,8 +675,8 @@ class Activities( list[Activity] ):
 	# serialization
 
 	@classmethod
-	def from_dict( cls, obj: List[Dict] ) -> Activities:
-		return Activities( *[Activity.from_dict( o ) for o in obj], skip_checks=True )
+	def from_dict( cls, obj: List[Dict], lazy: bool = False ) -> Activities:
+		return Activities( *[Activity.from_dict( o, lazy ) for o in obj], skip_checks=True )
 
 	def to_dict( self ) -> List[Dict]:
 		return [ Activity.to_dict( a ) for a in self.all( sort=True ) ]
@@ -580,29 +705,85 @@ def _sum( activities: List[Activity], name: str ) -> Any:
 def _stream( activities: List[Activity], name: str ) -> List:
 	return [ v for a in activities if ( v := getattr( a, name, None ) ) ]
 
+LAZY_FIELDS = frozenset( f.name for f in fields( Activity ) if not f.name.startswith( '__' ) and f.name not in INDEX_FIELDS )
+"""fields which are structured on first access for lazily loaded activities"""
+
 # configure converters
 
-ActivityPart.converter.register_unstructure_hook( timedelta, timedelta_to_str )
-ActivityPart.converter.register_unstructure_hook( UID, lambda uid: uid.to_str() )
-
-ActivityPart.converter.register_structure_hook( timedelta, lambda obj, cls: str_to_timedelta( obj ) )
-ActivityPart.converter.register_structure_hook( UID, lambda obj, cls: UID.from_str( obj ) )
-
-Activity.converter.register_unstructure_hook( datetime, toisoformat )
-Activity.converter.register_unstructure_hook( timedelta, timedelta_to_str )
-Activity.converter.register_unstructure_hook( UID|str, lambda uid: uid.to_str() )
-Activity.converter.register_unstructure_hook( ActivityTypes, ActivityTypes.to_str )
-Activity.converter.register_unstructure_hook( ActivityPart, lambda ap: ap.to_dict() )
-Activity.converter.register_unstructure_hook( Metadata, lambda md: md.to_dict() )
-Activity.converter.register_unstructure_hook( Resources, lambda rl: rl.to_dict() )
-
-Activity.converter.register_structure_hook( int, lambda obj, cls: int( obj ) if obj is not None else None )
-Activity.converter.register_structure_hook( datetime, lambda obj, cls: fromisoformat( obj ) )
-Activity.converter.register_structure_hook( timedelta, lambda obj, cls: str_to_timedelta( obj ) )
-Activity.converter.register_structure_hook( ActivityTypes, lambda obj, cls: ActivityTypes.from_str( obj ) )
-Activity.converter.register_structure_hook( ActivityPart, lambda obj, cls: ActivityPart.from_dict( obj ) )
-Activity.converter.register_structure_hook( Metadata, lambda obj, cls: Metadata.from_dict( obj ) )
-Activity.converter.register_structure_hook( Resources, lambda obj, cls: Resources.from_dict( obj ) )
+def _structure_datetime( obj: Any, cls: Any ) -> Optional[datetime]:
+	try:
+		return datetime.fromisoformat( obj )
+	except (TypeError, ValueError): # not produced by isoformat(), try harder
+		return fromisoformat( obj )
+
+@contextmanager
+def _resolved_types( *classes: Any ):
+	# generated functions need resolved types, but rules and field_type() rely on the declared annotations, so restore them
+	declared = { cls: { f.name: f.type for f in fields( cls ) } for cls in classes }
+	try:
+		for cls in classes:
+			hints = get_type_hints( cls )
+			for f in fields( cls ):
+				object.__setattr__( f, 'type', hints.get( f.name, f.type ) )
+		yield
+	finally:
+		for cls, types in declared.items():
+			for f in fields( cls ):
+				object.__setattr__( f, 'type', types[f.name] )
+
+def configure_converter( converter: Converter, native: bool = False ) -> Converter:
+	"""
+	Configures a converter for the complete activity graph: structure/unstructure functions for activities, parts,
+	metadata and resources are generated once and registered on the same converter, so nested values are handled without
+	going through other converters.
+
+	:param converter: converter to configure
+	:param native: keep datetimes when unstructuring, as orjson is able to serialize them natively
+	:return: the configured converter
+	"""
+	converter.register_unstructure_hook( datetime, ( lambda dt: dt ) if native else toisoformat )
+	converter.register_unstructure_hook( timedelta, timedelta_to_str )
+	converter.register_unstructure_hook( UID, lambda uid: uid.to_str() )
+	converter.register_unstructure_hook( UID|str, lambda uid: uid.to_str() )
+	converter.register_unstructure_hook( ActivityTypes, ActivityTypes.to_str )
+
+	converter.register_structure_hook( int, lambda obj, cls: int( obj ) if obj is not None else None )
+	converter.register_structure_hook( bool, lambda obj, cls: bool( obj ) if obj is not None else None ) # bool is a subclass of int
+	converter.register_structure_hook( datetime, _structure_datetime )
+	converter.register_structure_hook( timedelta, lambda obj, cls: str_to_timedelta( obj ) )
+	converter.register_structure_hook( UID, lambda obj, cls: UID.from_str( obj ) )
+	converter.register_structure_hook( ActivityTypes, lambda obj, cls: ActivityTypes.from_str( obj ) )
+
+	with _resolved_types( Metadata, Resource, ActivityPart, Activity ):
+		for cls in [ Metadata, Resource, ActivityPart ]:
+			converter.register_structure_hook( cls, make_dict_structure_fn( cls, converter ) )
+
+		converter.register_unstructure_hook( Metadata, make_dict_unstructure_fn( Metadata, converter, _cattrs_omit_if_default=True ) )
+		converter.register_unstructure_hook( ActivityPart, make_dict_unstructure_fn( ActivityPart, converter, _cattrs_omit_if_default=True ) )
+		converter.register_unstructure_hook( Resource, make_dict_unstructure_fn(
+			Resource,
+			converter,
+			_cattrs_omit_if_default=True,
+			content=override( omit=True ),
+			data=override( omit=True ),
+			raw=override( omit=True ),
+			status=override( omit=True ),
+			text=override( omit=True ),
+		) )
+
+		structure_resource, unstructure_resource = converter.get_structure_hook( Resource ), converter.get_unstructure_hook( Resource )
+		converter.register_structure_hook( Resources, lambda obj, cls: Resources( *[ structure_resource( r, Resource ) for r in obj ] ) )
+		converter.register_unstructure_hook( Resources, lambda rl: [ unstructure_resource( r ) for r in rl ] )
+
+		converter.register_structure_hook( Activity, make_dict_structure_fn( Activity, converter ) )
+		converter.register_unstructure_hook( Activity, make_dict_unstructure_fn( Activity, converter, _cattrs_omit_if_default=True ) )
+
+	return converter
+
+configure_converter( Activity.converter )
+ActivityPart.converter = Activity.converter
+
+Activity.json_converter = configure_converter( GenConverter( omit_if_default=True ), native=True )
 
 # configure formatting
 # todo: don't like that as field names are already pinned down here
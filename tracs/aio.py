@@ -112,6 +112,7 @@ def reimport_activities(
 	if ctx.force:
 		ctx.start( f'reimporting activity data', total=len( activities ) )
 
+	reimported = []
 	for a in activities:
 		ctx.advance( f'{a.uids}' )
 
@@ -135,8 +136,9 @@ def reimport_activities(
 			new_activity.starttime_local = new_activity.starttime.astimezone( gettz( a.timezone ) )
 
 		if ctx.force or _confirm_init( a, new_activity, ignore_fields, ctx ):
-			ctx.db.upsert_activity( new_activity )
+			reimported.append( new_activity )
 
+	ctx.db.upsert_many( reimported )
 	ctx.db.commit()
 	ctx.complete( 'done' )
 
@@ -10,8 +10,9 @@ from dynaconf import Dynaconf as Configuration
 from tracs import setup_console_logging, setup_file_logging
 from tracs.activity import configure_formatters as configure_activity_formatters
 from tracs.config import ApplicationContext, set_current_ctx
-from tracs.db import ActivityDb
+from tracs.db import ActivityDb, db_settings, ShardedActivityDb, SqliteActivityDb
 from tracs.pluginmgr import PluginManager
+from tracs.plugins.json import JSONHandler
 from tracs.registry import Registry
 from tracs.rules import RuleParser
 from tracs.utils import UCFG
@@ -105,10 +106,11 @@ class Application:
 		)
 
 		# open db from config_dir
-		self._db = ActivityDb(
+		db_class = { 'sharded': ShardedActivityDb, 'sqlite': SqliteActivityDb }.get( self.ctx.config.db.backend, ActivityDb )
+		self._db = db_class(
 			path=self._ctx.db_dir_path,
 			read_only=self._ctx.pretend,
-			enable_index=self.ctx.config.db.index,
+			**db_settings( self.ctx ),
 			summary_types=[ t.type for t in self._registry.summary_types() ],
 			recording_types=[ t.type for t in self._registry.recording_types() ],
 		)
@@ -123,6 +125,7 @@ class Application:
 		# ---- announce context/configuration to utils module + configure formatters ----
 		UCFG.reconfigure( self._ctx.config )
 		configure_activity_formatters( self._ctx.config.formats )
+		JSONHandler.OPTIONS = self._db.format.options # json resources (i.e. service summaries) follow the db format
 
 		# ---- register cleanup functions ----
 		register_atexit( self._ctx.db.close )
@@ -16,9 +16,10 @@ from tracs.edit import edit_activities, equip_activities, modify_activities, ren
 	untag_activities
 from tracs.fsio import backup_db, restore_db
 from tracs.group import group_activities, part_activities, ungroup_activities, unpart_activities
-from tracs.inspct import inspect_activities, inspect_keywords, inspect_plugins, inspect_registry, inspect_resources
+from tracs.inspct import inspect_activities, inspect_keywords, inspect_plan, inspect_plugins, inspect_registry, inspect_resources
 from tracs.link import link_activities
 from tracs.list import list_activities, show_config, show_fields, show_filters
+from tracs.rules import DATE_RANGE_FIELDS
 from tracs.setup import setup as setup_application
 from tracs.show import show_activities, show_aggregate, show_equipments, show_keywords, show_resources, show_tags, show_types
 from tracs.validate import validate_activities
@@ -68,16 +69,16 @@ def cli( ctx: ClickContext, configuration, library, force, verbose, pretend, deb
 @cli.command( hidden=True )
 @option( '-b', '--backup', is_flag=True, required=False, help='creates a backup of the internal database' )
 @option( '-m', '--maintenance', is_flag=False, flag_value='__show_maintenance_functions__', required=False, type=str, help='executes database maintenance', metavar='FUNCTION' )
-@option( '-r', '--restore', is_flag=True, required=False, help='restores the last version of the database from the backup' )
+@option( '-r', '--restore', is_flag=False, flag_value='__latest_backup__', required=False, type=str, metavar='BACKUP', help='restores the database from the backup with the provided name or from the latest backup' )
 @option( '-s', '--status', is_flag=True, required=False, help='prints some db status information' )
 @pass_obj
-def db( ctx: ApplicationContext, backup: bool, maintenance: str, restore: bool, status: bool ):
+def db( ctx: ApplicationContext, backup: bool, maintenance: str, restore: str, status: bool ):
 	if backup:
 		backup_db( ctx.db_fs, ctx.backup_fs )
 	elif maintenance:
 		maintain_db( ctx, maintenance=maintenance if maintenance != '__show_maintenance_functions__' else None )
 	elif restore:
-		restore_db( ctx.db_fs, ctx.backup_fs, ctx.force )
+		restore_db( ctx.db_fs, ctx.backup_fs, ctx.force, None if restore == '__latest_backup__' else restore )
 	elif status:
 		status_db( ctx )
 
@@ -144,7 +145,9 @@ def link( ctx: ApplicationContext, filters ):
 @argument('filters', nargs=-1)
 @pass_obj
 def ls( ctx: ApplicationContext, sort, reverse, format_name, fields, filters ):
-	list_activities( _flt( *filters ), sort=sort, reverse=reverse, format_name=format_name, fields=fields, ctx=ctx )
+	order = sort or 'starttime'
+	presorted = order in DATE_RANGE_FIELDS # the db emits activities in time order already
+	list_activities( _flt( *filters, order=order if presorted else None ), sort=sort, reverse=reverse, format_name=format_name, fields=fields, presorted=presorted, ctx=ctx )
 
 @cli.command( help='shows details about activities and resources' )
 @option( '-f', '--format', 'format_name', is_flag=False, required=False, type=str, hidden=True, help='uses the format with the provided name when printing', metavar='FORMAT' )
@@ -316,12 +319,18 @@ def aggregate( ctx: ApplicationContext, filters ):
 @option( '-j', '--json', is_flag=True, required=False, default=False, help='outputs json instead of text' )
 @option( '-k', '--keywords', is_flag=True, required=False, help='inspects keywords (filters are ignored)' )
 @option( '-p', '--plugins', is_flag=True, required=False, help='inspects all discoverable plugins (filter will be ignored)' )
+@option( '--plan', is_flag=True, required=False, help='shows how activities matching the filters are found' )
 @option( '-rg', '--registry', is_flag=True, required=False, help='inspects the internal registry (filter will be ignored)' )
 @option( '-rs', '--resource', is_flag=True, required=False, help='inspects resources of activities' )
 @argument( 'filters', nargs=-1 )
 @pass_obj
-def inspect( ctx: ApplicationContext, filters, json: bool, keywords: bool, plugins: bool, registry: bool, resource: bool ):
-	if keywords:
+def inspect( ctx: ApplicationContext, filters, json: bool, keywords: bool, plugins: bool, plan: bool, registry: bool, resource: bool ):
+	if plan:
+		try:
+			inspect_plan( ctx, APPLICATION_INSTANCE.db.plan( APPLICATION_INSTANCE.parser.parse_rules( *filters ) ) )
+		except RuleSyntaxError as rse:
+			ctx.console.print( rse )
+	elif keywords:
 		inspect_keywords( ctx, json )
 	elif plugins:
 		inspect_plugins( ctx )
@@ -376,13 +385,9 @@ if __name__ == '__main__':
 
 # helper
 
-def _flt( *rules: str ) -> List[Activity]:
+def _flt( *rules: str, order: Optional[str] = None ) -> List[Activity]:
 	try:
-		rules = APPLICATION_INSTANCE.parser.parse_rules( *rules )
-		activities = APPLICATION_INSTANCE.db.activities
-		for r in rules:
-			activities = r.filter( activities )
-		return list( activities )
+		return APPLICATION_INSTANCE.db.find( APPLICATION_INSTANCE.parser.parse_rules( *rules ), order=order )
 
 	except RuleSyntaxError as rse:
 		APPLICATION_INSTANCE.ctx.console.print( rse )
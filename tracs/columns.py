@@ -0,0 +1,257 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+from functools import partial
+from logging import getLogger
+from operator import eq, ge, gt, le, lt, ne
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from attrs import define, field
+from dateutil.tz import UTC
+from rule_engine import Rule
+from rule_engine.ast import ArithmeticComparisonExpression, ArrayExpression, BooleanExpression, ComparisonExpression, ContainsExpression
+from rule_engine.ast import DatetimeExpression, FloatExpression, GetAttributeExpression, LogicExpression, NullExpression, StringExpression
+from rule_engine.ast import SymbolExpression, TimedeltaExpression, UnaryExpression
+
+from tracs.activity import Activity
+from tracs.activity_types import ActivityTypes
+from tracs.rules import starttime_of
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+log = getLogger( __name__ )
+
+# kinds of columns and how their values are stored: numbers as float64, times and durations as int64 microseconds
+# (times relative to the epoch), activity types as int64 codes
+NUMBER, TIME, DURATION, CATEGORY = 'number', 'time', 'duration', 'category'
+
+EPOCH = datetime( 1970, 1, 1, tzinfo=UTC )
+MICROSECOND = timedelta( microseconds=1 )
+TYPE_CODES: Dict[str, int] = { t.name: i for i, t in enumerate( ActivityTypes ) }
+
+OPERATORS = { 'eq': eq, 'ne': ne, 'lt': lt, 'le': le, 'gt': gt, 'ge': ge }
+MIRRORED = { 'eq': 'eq', 'ne': 'ne', 'lt': 'gt', 'le': 'ge', 'gt': 'lt', 'ge': 'le' }
+
+@define
+class Column:
+
+	name: str = field( default=None )
+	kind: str = field( default=NUMBER )
+	value: Callable[[Activity], Any] = field( default=None )
+	virtual: bool = field( default=False ) # column of a virtual field, only used when the virtual field is registered
+
+def _field( name: str, cls: type ) -> Callable[[Activity], Any]:
+	def value( activity: Activity ) -> Any:
+		try:
+			return object.__getattribute__( activity, name ) # bypasses hydration
+		except AttributeError: # field of a lazy activity: structure this field only
+			return None if ( raw := activity.__raw__.get( name ) ) is None else Activity.converter.structure( raw, cls )
+	return value
+
+def _local( name: str ) -> Callable[[Activity], Any]:
+	return lambda activity: getattr( starttime_of( activity, 'starttime_local' ), name, None ) # same as the virtual fields year, month ...
+
+COLUMNS: Dict[str, Column] = { c.name: c for c in [
+	Column( 'id', NUMBER, _field( 'id', int ) ),
+	Column( 'type', CATEGORY, _field( 'type', ActivityTypes ) ),
+	Column( 'starttime', TIME, partial( starttime_of, name='starttime' ) ),
+	Column( 'starttime_local', TIME, partial( starttime_of, name='starttime_local' ) ),
+	Column( 'year', NUMBER, _local( 'year' ), virtual=True ),
+	Column( 'month', NUMBER, _local( 'month' ), virtual=True ),
+	Column( 'day', NUMBER, _local( 'day' ), virtual=True ),
+	Column( 'hour', NUMBER, _local( 'hour' ), virtual=True ),
+	Column( 'duration', DURATION, _field( 'duration', timedelta ) ),
+	Column( 'distance', NUMBER, _field( 'distance', float ) ),
+	Column( 'ascent', NUMBER, _field( 'ascent', float ) ),
+	Column( 'descent', NUMBER, _field( 'descent', float ) ),
+	Column( 'speed', NUMBER, _field( 'speed', float ) ),
+	Column( 'heartrate', NUMBER, _field( 'heartrate', int ) ),
+	Column( 'heartrate_max', NUMBER, _field( 'heartrate_max', int ) ),
+	Column( 'calories', NUMBER, _field( 'calories', int ) ),
+] }
+"""columns of the activity table, the names are the symbols used in rules"""
+
+Mask = Tuple[Any, Any]
+"""result of evaluating an expression: rows which match and rows which need to be evaluated per object"""
+
+def columnar_available() -> bool:
+	return np is not None
+
+class ActivityTable:
+	"""
+	Columnar mirror of the numeric and time fields of activities, allows to evaluate rules with vectorised numpy operations.
+	Rules are compiled into boolean masks as far as possible: comparisons, and/or/not and 'in' with literal arrays.
+	Everything else, null values (if these cause errors in rule engine) and dirty activities are evaluated per object.
+	Rows of dirty activities are recomputed by refresh(), which needs to be called before dirty flags are reset (on commit).
+	"""
+
+	def __init__( self, activities: Iterable[Activity] = () ):
+		if np is None:
+			raise ValueError( 'columnar evaluation requires the numpy package to be installed' )
+
+		self.activities: List[Activity] = [] # keeps references, so object ids of removed activities are not reused
+		self.rows: Dict[int, int] = {} # key is the object id of the activity
+		self.values: Dict[str, Any] = { name: np.zeros( 0, dtype=_dtype( c.kind ) ) for name, c in COLUMNS.items() }
+		self.nulls: Dict[str, Any] = { name: np.zeros( 0, dtype=bool ) for name in COLUMNS }
+		self.invalid: Dict[str, Any] = { name: np.zeros( 0, dtype=bool ) for name in COLUMNS } # values of unexpected type
+		self.extend( activities )
+
+	def __len__( self ) -> int:
+		return len( self.activities )
+
+	def __contains__( self, activity: Activity ) -> bool:
+		return id( activity ) in self.rows
+
+	def extend( self, activities: Iterable[Activity] ) -> None:
+		if not ( activities := [ a for a in activities if id( a ) not in self.rows ] ):
+			return
+
+		for a in activities:
+			self.rows[id( a )] = len( self.activities )
+			self.activities.append( a )
+		for name, c in COLUMNS.items():
+			values, nulls, invalid = _encode_all( c, activities )
+			self.values[name] = np.concatenate( [ self.values[name], values ] )
+			self.nulls[name] = np.concatenate( [ self.nulls[name], nulls ] )
+			self.invalid[name] = np.concatenate( [ self.invalid[name], invalid ] )
+
+	def refresh( self ) -> None:
+		"""
+		Recomputes the rows of dirty activities.
+		"""
+		if not ( dirty := [ a for a in self.activities if a.__dirty__ ] ):
+			return
+
+		rows = [ self.rows[id( a )] for a in dirty ]
+		for name, c in COLUMNS.items():
+			self.values[name][rows], self.nulls[name][rows], self.invalid[name][rows] = _encode_all( c, dirty )
+
+	def filter( self, rule: Rule, activities: Iterable[Activity] ) -> List[Activity]:
+		"""
+		Returns the activities matching the provided rule, activities unknown to this table are added.
+		"""
+		self.extend( activities := list( activities ) )
+		matches, undecided = ( m.tolist() for m in self.evaluate( rule ) )
+		result = []
+		for a in activities:
+			i = self.rows[id( a )]
+			if undecided[i] or a.__dirty__:
+				if rule.matches( a ):
+					result.append( a )
+			elif matches[i]:
+				result.append( a )
+		return result
+
+	def evaluate( self, rule: Rule ) -> Mask:
+		"""
+		Evaluates a rule for all rows, returns the matching rows and the rows which need to be evaluated per object.
+		"""
+		return self._evaluate( rule.statement.expression )
+
+	def _evaluate( self, e: Any ) -> Mask:
+		if isinstance( e, LogicExpression ) and e.type in [ 'and', 'or' ]:
+			# mirrors short-circuit evaluation: the right side only matters if the left side does not decide already
+			( left, left_undecided ), ( right, right_undecided ) = self._evaluate( e.left ), self._evaluate( e.right )
+			if e.type == 'and':
+				return left & right, left_undecided | ( left & right_undecided )
+			else:
+				return left | right, left_undecided | ( ~left & right_undecided )
+		elif isinstance( e, UnaryExpression ) and e.type == 'not':
+			matches, undecided = self._evaluate( e.right )
+			return ~matches, undecided
+		elif isinstance( e, BooleanExpression ):
+			return np.full( len( self ), bool( e.value ) ), np.zeros( len( self ), dtype=bool )
+		elif isinstance( e, ( ComparisonExpression, ArithmeticComparisonExpression ) ) and e.type in OPERATORS:
+			if ( mask := self._compare( e.type, e.left, e.right ) ) or ( mask := self._compare( MIRRORED[e.type], e.right, e.left ) ):
+				return mask
+		elif isinstance( e, ContainsExpression ) and ( mask := self._contains( e.container, e.member ) ):
+			return mask
+		return self._undecided()
+
+	def _compare( self, op: str, left: Any, right: Any ) -> Optional[Mask]:
+		if isinstance( left, GetAttributeExpression ) and _is_symbol( left.object, 'type' ) and left.name == 'name':
+			if not isinstance( right, StringExpression ) or op not in [ 'eq', 'ne' ]:
+				return None
+			code = TYPE_CODES.get( right.value, -1 )
+			matches = OPERATORS[op]( self.values['type'], code )
+			return matches, self.nulls['type'] | self.invalid['type'] # type.name fails for activities without type
+
+		if not isinstance( left, SymbolExpression ) or left.scope is not None or ( column := _column( left.name ) ) is None:
+			return None
+		values, nulls, invalid = self.values[column.name], self.nulls[column.name], self.invalid[column.name]
+
+		if isinstance( right, NullExpression ) and op in [ 'eq', 'ne' ]:
+			return ( nulls if op == 'eq' else ~nulls ), invalid
+		elif ( literal := _literal( right, column.kind ) ) is None:
+			return None
+		elif op in [ 'eq', 'ne' ]:
+			matches = OPERATORS[op]( values, literal )
+			return ( matches & ~nulls if op == 'eq' else matches | nulls ), invalid
+		else:
+			return OPERATORS[op]( values, literal ) & ~nulls, nulls | invalid # ordering null values fails in rule engine
+
+	def _contains( self, container: Any, member: Any ) -> Optional[Mask]:
+		if not isinstance( container, ArrayExpression ) or not isinstance( member, SymbolExpression ) or member.scope is not None:
+			return None
+		if ( column := _column( member.name ) ) is None or column.kind == CATEGORY:
+			return None
+		literals = [ _literal( e, column.kind ) for e in container.value ]
+		if any( literal is None for literal in literals ):
+			return None
+		return np.isin( self.values[column.name], literals ) & ~self.nulls[column.name], self.invalid[column.name]
+
+	def _undecided( self ) -> Mask:
+		return np.zeros( len( self ), dtype=bool ), np.ones( len( self ), dtype=bool )
+
+# helpers
+
+def _column( name: str ) -> Optional[Column]:
+	if ( column := COLUMNS.get( name ) ) and column.virtual and name not in Activity.__vf__:
+		return None
+	return column
+
+def _dtype( kind: str ) -> Any:
+	return np.float64 if kind == NUMBER else np.int64
+
+def _encode_all( column: Column, activities: List[Activity] ) -> Tuple[Any, Any, Any]:
+	encoded = [ _encode( column.kind, column.value( a ) ) for a in activities ]
+	return (
+		np.array( [ v for v, n, i in encoded ], dtype=_dtype( column.kind ) ),
+		np.array( [ n for v, n, i in encoded ], dtype=bool ),
+		np.array( [ i for v, n, i in encoded ], dtype=bool ),
+	)
+
+def _encode( kind: str, value: Any ) -> Tuple[Any, bool, bool]:
+	"""
+	Encodes a value as column value, returns the encoded value and whether the value is null or invalid.
+	"""
+	if value is None:
+		return 0, True, False
+	elif kind == NUMBER and isinstance( value, ( int, float ) ) and not isinstance( value, bool ) and value == value:
+		return value, False, False
+	elif kind == TIME and isinstance( value, datetime ):
+		return ( value - EPOCH ) // MICROSECOND, False, False
+	elif kind == DURATION and isinstance( value, timedelta ):
+		return value // MICROSECOND, False, False
+	elif kind == CATEGORY and isinstance( value, ActivityTypes ):
+		return TYPE_CODES[value.name], False, False
+	return 0, False, True
+
+def _literal( e: Any, kind: str ) -> Optional[Any]:
+	"""
+	Returns the column value of a literal expression or None if the literal cannot be compared to a column of this kind.
+	"""
+	if kind == NUMBER and isinstance( e, FloatExpression ) and Decimal( repr( value := float( e.value ) ) ) == e.value:
+		return value # only literals which survive the round trip to float compare like the decimals in rule engine
+	elif kind == TIME and isinstance( e, DatetimeExpression ):
+		return _encode( TIME, e.value )[0]
+	elif kind == DURATION and isinstance( e, TimedeltaExpression ):
+		return _encode( DURATION, e.value )[0]
+	return None
+
+def _is_symbol( e: Any, name: str ) -> bool:
+	return isinstance( e, SymbolExpression ) and e.name == name and e.scope is None
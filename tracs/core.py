@@ -1,13 +1,12 @@
 from __future__ import annotations
 
 from datetime import datetime
-from functools import cached_property
+from heapq import heappop, heappush
 from inspect import getmembers, signature
 from sys import version_info
 from types import MappingProxyType
-from typing import Any, Callable, ClassVar, Dict, Generic, Iterator, List, Mapping, Optional, Tuple, Type, TypeVar, Union
+from typing import Any, Callable, ClassVar, Dict, FrozenSet, Generic, Iterator, KeysView, List, Mapping, Optional, Set, Tuple, Type, TypeVar, Union
 
-from attr import AttrsInstance
 from attrs import Attribute, define, field, fields
 from cattrs import Converter, GenConverter
 
@@ -25,14 +24,75 @@ FIELD_KWARGS = FIELD_KWARGS if version_info.minor < 10 else { **FIELD_KWARGS, 'k
 
 T = TypeVar('T')
 
+@define
+class IdAllocator:
+	"""
+	Hands out the lowest unused id > 0. Keeps the set of used ids, a high-water mark and a heap of free ids below that
+	mark, so allocating and releasing ids does not require scanning all existing ids.
+	"""
+
+	used: Set[int] = field( factory=set )
+	high: int = field( default=0 )
+	free: Optional[List[int]] = field( default=None ) # None means gaps below the high-water mark need to be computed
+
+	def __attrs_post_init__( self ):
+		self.high = max( self.used, default=0 )
+
+	def next( self ) -> int:
+		"""
+		Returns the next free id without reserving it, use add() to mark it as used.
+		"""
+		if self.free is None:
+			self.free = sorted( set( range( 1, self.high + 1 ) ).difference( self.used ) ) # a sorted list is a valid heap
+		while self.free:
+			if ( id := self.free[0] ) not in self.used:
+				return id
+			heappop( self.free )
+		return self.high + 1
+
+	def add( self, id: Optional[int] ) -> None:
+		if id is None:
+			return
+		self.used.add( id )
+		if id > self.high:
+			if id > self.high + 1:
+				self.free = None # new gaps appeared, recalculate on demand
+			self.high = id
+
+	def remove( self, id: Optional[int] ) -> None:
+		if id is None or id not in self.used:
+			return
+		self.used.discard( id )
+		if self.free is not None:
+			heappush( self.free, id )
+
+class TrackedList( list ):
+	"""
+	List which counts its modifications, allows indexes derived from its content to notice that they need a rebuild.
+	"""
+
+	__version__: int = 0
+
+def _tracked( name: str ) -> Callable:
+	method = getattr( list, name )
+	def tracked( self: TrackedList, *args, **kwargs ):
+		self.__version__ += 1
+		return method( self, *args, **kwargs )
+	return tracked
+
+for _name in [ '__setitem__', '__delitem__', '__iadd__', '__imul__', 'append', 'clear', 'extend', 'insert', 'pop', 'remove' ]:
+	setattr( TrackedList, _name, _tracked( _name ) )
+
 @define
 class Container( Generic[T] ):
 	"""
 	Dict-like container for activities/resources and the like. Super class to put common methods into.
 	"""
 
-	data: List[T] = field( factory=list )
+	data: List[T] = field( factory=TrackedList, converter=TrackedList )
 
+	__allocator__: Optional[IdAllocator] = field( default=None, init=False, eq=False, repr=False, alias='__allocator__' )
+	__synced__: Optional[Tuple[TrackedList, int]] = field( default=None, init=False, eq=False, repr=False, alias='__synced__' ) # data list and version the allocator was built from
 	__id_map__: Dict[int, T] = field( factory=dict, init=False, alias='__id_map__' )
 	__uid_map__: Dict[str, T] = field( factory=dict, init=False, alias='__uid_map__' )
 	__it__: Iterator = field( default=None, init=False, alias='__it__' )
@@ -43,9 +103,10 @@ class Container( Generic[T] ):
 
 	# calculation of next id
 	def __next_id__( self ) -> int:
-		existing_ids = [r.id for r in self.data]
-		id_range = range( 1, max( existing_ids ) + 2 ) if len( existing_ids ) > 0 else [1]
-		return set( id_range ).difference( set( existing_ids ) ).pop()
+		if not self.__synced__ or self.__synced__[0] is not self.data or self.__synced__[1] != self.data.__version__:
+			self.__allocator__ = IdAllocator( used={ r.id for r in self.data } )
+			self.__synced__ = ( self.data, self.data.__version__ )
+		return self.__allocator__.next()
 
 	# len() support
 
@@ -121,9 +182,16 @@ class Container( Generic[T] ):
 
 @define( init=False )
 class Metadata:
+	"""
+	Metadata of an activity. Known fields are kept in slots, everything else goes into the supplementary dict, which is
+	only created when needed.
+	"""
 
 	converter: ClassVar[Converter] = GenConverter( omit_if_default=True )
 
+	__fieldnames__: ClassVar[FrozenSet[str]] = frozenset()
+	__regular_fieldnames__: ClassVar[Tuple[str, ...]] = ()
+
 	created: Optional[datetime] = field( default=None )
 	modified: Optional[datetime] = field( default=None )
 
@@ -135,37 +203,29 @@ class Metadata:
 	# part: List[UID] = field( factory=list ) # indicator that an activity is part of one or multiple others, not used yet
 	# parts: List = field( factory=list ) # indicates parts of a multipart activity
 
-	supplementary: Dict[str, Any] = field( factory=dict )
+	supplementary: Optional[Dict[str, Any]] = field( default=None ) # overflow for unknown fields
 	# __kwargs__: Dict[str, Any] = field( factory=dict, alias='__kwargs__' )
 
-	@cached_property
-	def __fieldnames( self ) -> List[str]:
-		return [f.name for f in fields( self.__class__ )]
-
-	@cached_property
-	def __regular_fieldnames( self ) -> List[str]:
-		return [f.name for f in fields( self.__class__ ) if not f.name == 'supplementary']
-
 	# noinspection PyUnresolvedReferences
 	def __init__( self, *args, **kwargs ):
-		self.__attrs_init__( *args, **{ k: v for k, v in kwargs.items() if k in self.__fieldnames } )
-		self.supplementary = { k: v for k, v in kwargs.items() if k not in self.__fieldnames } | self.supplementary
+		self.__attrs_init__( *args, **{ k: v for k, v in kwargs.items() if k in Metadata.__fieldnames__ } )
+		if overflow := { k: v for k, v in kwargs.items() if k not in Metadata.__fieldnames__ }:
+			self.supplementary = overflow | ( self.supplementary or {} )
 
 	# len() support
 
 	def __len__( self ) -> int:
-		return len( self.supplementary ) + len( self.__regular_fieldnames )
+		return len( self.supplementary or {} ) + len( Metadata.__regular_fieldnames__ )
 
-	# getter
+	# getter, only called for names which are not slots
 
 	def __getattr__( self, key: str ) -> Any:
-		if key in self.__fieldnames:
-			return super().__getattribute__( key )
-		else:
-			return self.supplementary.get( key )
+		if key.startswith( '__' ):
+			raise AttributeError( key )
+		return self.supplementary.get( key ) if self.supplementary else None
 
 	def __getitem__( self, key: str ):
-		return self.__getattr__( key )
+		return getattr( self, key )
 
 	# setter
 
@@ -173,24 +233,26 @@ class Metadata:
 		self.__setattr__( key, value )
 
 	def __setattr__( self, key, value ):
-		if key in self.__fieldnames:
+		if key in Metadata.__fieldnames__:
 			super().__setattr__( key, value )
+		elif self.supplementary is None:
+			self.supplementary = { key: value }
 		else:
 			self.supplementary[key] = value
 
 	# dict-like methods
 
 	def keys( self ) -> List[str]:
-		return [*self.__regular_fieldnames, *self.supplementary.keys()]
+		return [*Metadata.__regular_fieldnames__, *( self.supplementary or {} ).keys()]
 
 	def values( self ) -> List[Any]:
-		return [*[self.__getattr__( f ) for f in self.__regular_fieldnames], *self.supplementary.values()]
+		return [*[getattr( self, f ) for f in Metadata.__regular_fieldnames__], *( self.supplementary or {} ).values()]
 
 	def items( self ) -> List[Tuple[str, Any]]:
-		return [*[( f, self.__getattr__( f ) ) for f in self.__regular_fieldnames ], *self.supplementary.items()]
+		return [*[( f, getattr( self, f ) ) for f in Metadata.__regular_fieldnames__ ], *( self.supplementary or {} ).items()]
 
 	def as_dict( self ) -> Dict[str, Any]:
-		d = { f: self.__getattr__( f ) for f in self.__regular_fieldnames } | self.supplementary
+		d = { f: getattr( self, f ) for f in Metadata.__regular_fieldnames__ } | ( self.supplementary or {} )
 		return { k: v for k, v in d.items() if v is not None }
 
 	# serialization
@@ -212,6 +274,8 @@ class VirtualField:
 	description: str = field( default=None )
 	display_name: str = field( default=None )
 	expose: bool = field( default=True ) # expose field as regular property
+	memo: bool = field( default=False ) # cache the value per instance, requires the instance to provide a __memo__ field
+	sources: List[str] = field( factory=list ) # fields the value is derived from, a cached value is dropped when one of them is set
 
 	# enclosing: Type = field( default=None )
 
@@ -228,23 +292,12 @@ class VirtualField:
 
 class VirtualFields( dict[str, VirtualField] ):
 
-	def __init__( self ):
-		super().__init__()
-		self.__parent__ = None
-
-	def __getattr__( self, name: str ) -> Any:
+	def __getattr__( self, name: str ) -> VirtualField:
 		try:
 			return self.__getitem__( name )
 		except KeyError:
 			raise AttributeError
 
-	def __contains__( self, item ) -> bool:
-		return super().__contains__( item )
-
-	def __getitem__( self, key: str ) -> VirtualField:
-		vf = super().__getitem__( key )
-		return vf.factory( self.__parent__ ) if vf.factory else vf.default
-
 	def __setitem__( self, key: str, vf: VirtualField ) -> None:
 		if not isinstance( vf, VirtualField ):
 			raise ValueError( f'value must be of type {VirtualField}' )
@@ -257,12 +310,34 @@ class VirtualFields( dict[str, VirtualField] ):
 	def set_field( self, name: str, vf: VirtualField ) -> None:
 		self[name or vf.name] = vf
 
-	def proxy( self, parent: Any ) -> VirtualFields:
+class BoundVirtualFields:
+	"""
+	Virtual fields bound to a parent object, provides the values of all virtual fields (exposed or not) as attributes or items.
+	"""
+
+	__slots__ = ( '__fields__', '__parent__' )
+
+	def __init__( self, fields: VirtualFields, parent: Any ):
+		self.__fields__ = fields
 		self.__parent__ = parent
-		return self
+
+	def __getattr__( self, name: str ) -> Any:
+		try:
+			return self.__getitem__( name )
+		except KeyError:
+			raise AttributeError
+
+	def __contains__( self, item ) -> bool:
+		return item in self.__fields__
+
+	def __getitem__( self, key: str ) -> Any:
+		return self.__parent__.vf_value( self.__fields__[key] )
+
+	def keys( self ) -> KeysView[str]:
+		return self.__fields__.keys()
 
 @define
-class VirtualFieldsBase( AttrsInstance ):
+class VirtualFieldsBase:
 
 	__vf__: ClassVar[VirtualFields] = VirtualFields()
 
@@ -298,12 +373,33 @@ class VirtualFieldsBase( AttrsInstance ):
 	def add_field( cls, vf: VirtualField, name: str = None ) -> None:
 		cls.__vf__.set_field( name, vf )
 
+	@classmethod
+	def materialize( cls, things: List[VirtualFieldsBase], *names: str ) -> Dict[str, List[Any]]:
+		"""
+		Computes the values of the provided fields for a list of things at once and returns them as one column per field.
+		Values of memoised virtual fields are kept by each thing, so later access, i.e. by rules, comes for free.
+		Values which cannot be computed are None.
+		"""
+		columns = {}
+		for name in names:
+			if ( vf := cls.__vf__.get( name ) ) and not hasattr( cls, name ): # regular fields take precedence
+				columns[name] = [ _quiet( t.vf_value, vf ) for t in things ]
+			else:
+				columns[name] = [ getattr( t, name, None ) for t in things ]
+		return columns
+
 	def __getattr__( self, name: str ) -> Any:
 		if ( vf := self.__class__.__vf__.get( name ) ) and vf.expose:
-			return vf.factory( self ) if vf.factory else vf.default
+			return self.vf_value( vf )
 		else:
 			raise AttributeError
 
+	def vf_value( self, vf: VirtualField ) -> Any:
+		"""
+		Returns the value of the provided virtual field for this instance.
+		"""
+		return vf.factory( self ) if vf.factory else vf.default
+
 	def getattr( self, name: str, quiet: bool = False, default: Any = None ) -> Any:
 		try:
 			return getattr( self, name )
@@ -317,8 +413,14 @@ class VirtualFieldsBase( AttrsInstance ):
 		return [ self.getattr( f, quiet=True ) for f in field_names ]
 
 	@property
-	def vf( self ) -> VirtualFields:
-		return self.__class__.__vf__.proxy( self )
+	def vf( self ) -> BoundVirtualFields:
+		return BoundVirtualFields( self.__class__.__vf__, self )
+
+def _quiet( fn: Callable, *args ) -> Any:
+	try:
+		return fn( *args )
+	except AttributeError:
+		return None
 
 def vproperty( **kwargs ):
 	def inner( fn ):
@@ -371,7 +473,7 @@ class FieldFormatters( dict[str, FieldFormatter] ):
 		self[field.name] = field
 
 @define
-class FormattedFieldsBase( AttrsInstance ):
+class FormattedFieldsBase:
 
 	__fmf__: ClassVar[FieldFormatters] = FieldFormatters()
 
@@ -427,6 +529,9 @@ class Normalizer:
 
 # setup converters
 
+Metadata.__fieldnames__ = frozenset( f.name for f in fields( Metadata ) )
+Metadata.__regular_fieldnames__ = tuple( f.name for f in fields( Metadata ) if f.name != 'supplementary' )
+
 Metadata.converter.register_unstructure_hook( datetime, toisoformat )
 Metadata.converter.register_unstructure_hook( UID, lambda u: u.to_str() )
 
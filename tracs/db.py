@@ -1,31 +1,44 @@
 
 from __future__ import annotations
 
-from itertools import chain, groupby
+from bisect import bisect_left, bisect_right, insort
+from itertools import chain
 from logging import getLogger
+from contextlib import closing, contextmanager, nullcontext
+from datetime import datetime, timedelta
+from decimal import Decimal
 from pathlib import Path
-from typing import cast, Dict, List, Mapping, Optional, Tuple, Union
+from sys import maxsize
+from sqlite3 import connect, Connection
+from types import MappingProxyType
+from typing import Any, cast, ClassVar, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Tuple, Union
 
 from fs.base import FS
-from fs.copy import copy_file, copy_file_if
+from fs.copy import copy_file
 from fs.errors import ResourceNotFound
 from fs.memoryfs import MemoryFS
 from fs.multifs import MultiFS
 from fs.osfs import OSFS
 from fs.path import basename
-from more_itertools import first_true, unique
-from orjson import dumps, OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_SORT_KEYS
+from more_itertools import unique
+from orjson import dumps, loads, OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_SORT_KEYS
 from rich import box
 from rich.pretty import pretty_repr as pp
 from rich.table import Table as RichTable
 from rule_engine import Rule
 
 from tracs.activity import Activities, Activity
+from tracs.columns import ActivityTable, columnar_available
 from tracs.config import ApplicationContext
-from tracs.fsio import load_activities, load_schema, Schema, write_activities
+from tracs.errors import StaleDatabaseException
+from tracs.fsio import append_journal, differs, JsonFormat, journal_size, JOURNAL_NAME, load_schema, load_snapshot, lock, read_activities, remove_journal, Schema
+from tracs.fsio import read_manifest, read_shard, serialize_activity, serialize_dict, shard_key, shard_path, SHARDS_DIRNAME, SHARDS_PATH
+from tracs.fsio import snapshot_key, SNAPSHOT_NAME, write_activities, write_atomic, write_manifest, write_schema, write_shard, write_snapshot
 from tracs.migrate import migrate_db, migrate_db_functions
+from tracs.rules import classifiers_of, date_range, DATE_RANGE_FIELDS, Predicate, plan_query, QueryPlan, starttime_of
 from tracs.resources import Resource, Resources
 from tracs.uid import UID
+from tracs.utils import toisoformat
 
 log = getLogger( __name__ )
 
@@ -36,6 +49,23 @@ SCHEMA_NAME = 'schema.json'
 
 SCHEMA_VERSION = 14
 
+JOURNAL_THRESHOLD = 1024 * 1024 # journal size in bytes which triggers a compaction
+
+SQLITE_NAME = 'activities.sqlite'
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS activities ( id INTEGER PRIMARY KEY, uid TEXT NOT NULL UNIQUE, classifier TEXT, type TEXT, starttime TEXT, data BLOB NOT NULL );
+CREATE INDEX IF NOT EXISTS activities_classifier ON activities ( classifier );
+CREATE INDEX IF NOT EXISTS activities_type ON activities ( type );
+CREATE INDEX IF NOT EXISTS activities_starttime ON activities ( starttime );
+CREATE TABLE IF NOT EXISTS members ( uid TEXT NOT NULL, activity_id INTEGER NOT NULL );
+CREATE INDEX IF NOT EXISTS members_uid ON members ( uid );
+CREATE INDEX IF NOT EXISTS members_activity_id ON members ( activity_id );
+CREATE TABLE IF NOT EXISTS resources ( activity_id INTEGER NOT NULL, uid TEXT, base_uid TEXT NOT NULL, path TEXT, type TEXT );
+CREATE INDEX IF NOT EXISTS resources_activity_id ON resources ( activity_id );
+CREATE INDEX IF NOT EXISTS resources_base_uid ON resources ( base_uid );
+CREATE INDEX IF NOT EXISTS resources_type ON resources ( type );
+'''
+
 DB_FILES = {
 	ACTIVITIES_NAME: dumps( [] ),
 	SCHEMA_NAME: dumps( { "version": SCHEMA_VERSION } )
@@ -44,58 +74,309 @@ DB_FILES = {
 UNDERLAY = 'underlay'
 OVERLAY = 'overlay'
 
+class TimeIndex:
+	"""
+	Activities sorted by a time field and by id for equal times, allows to answer range queries via bisect. Activities
+	without a value for the field are not contained.
+	"""
+
+	def __init__( self, name: str, activities: Iterable[Activity] = () ):
+		self.name = name
+		entries = sorted( ( ( ( t, a.id or 0 ), a ) for a in activities if ( t := starttime_of( a, name ) ) ), key=lambda e: e[0] )
+		self.keys: List[Tuple[datetime, int]] = [ k for k, a in entries ]
+		self.activities: List[Activity] = [ a for k, a in entries ]
+		self._key_of: Dict[int, Tuple[datetime, int]] = { id( a ): k for k, a in entries } # key is the object id of the activity
+
+	def __len__( self ) -> int:
+		return len( self.keys )
+
+	def add( self, activity: Activity ) -> None:
+		if ( t := starttime_of( activity, self.name ) ) is None:
+			return
+		key = self._key_of[id( activity )] = ( t, activity.id or 0 )
+		i = bisect_right( self.keys, key )
+		self.keys.insert( i, key )
+		self.activities.insert( i, activity )
+
+	def remove( self, activity: Activity ) -> None:
+		if ( key := self._key_of.pop( id( activity ), None ) ) is None:
+			return
+		i = bisect_left( self.keys, key )
+		while self.activities[i] is not activity:
+			i += 1
+		del self.keys[i]
+		del self.activities[i]
+
+	def refresh( self, activities: Iterable[Activity] ) -> None:
+		"""
+		Moves the provided activities to their current position, in case their time has changed since they were added.
+		"""
+		for a in activities:
+			if self._key_of.get( id( a ) ) != ( ( t, a.id or 0 ) if ( t := starttime_of( a, self.name ) ) else None ):
+				self.remove( a )
+				self.add( a )
+
+	def range( self, lower: Optional[datetime], upper: Optional[datetime], lower_strict: bool = False, upper_strict: bool = False ) -> List[Activity]:
+		"""
+		Returns the activities between lower and upper bound in time order, None means unbounded.
+		"""
+		lo = 0 if lower is None else bisect_right( self.keys, ( lower, maxsize ) ) if lower_strict else bisect_left( self.keys, ( lower, -maxsize ) )
+		hi = len( self.keys ) if upper is None else bisect_left( self.keys, ( upper, -maxsize ) ) if upper_strict else bisect_right( self.keys, ( upper, maxsize ) )
+		return self.activities[lo:hi]
+
+	def ordered( self, activities: List[Activity] ) -> List[Activity]:
+		"""
+		Returns the provided activities in time order, activities without a time are appended in their original order.
+		"""
+		if len( activities ) * 8 < len( self.keys ): # cheaper to sort a few keys than to walk the whole index
+			ordered = sorted( ( a for a in activities if id( a ) in self._key_of ), key=lambda a: self._key_of[id( a )] )
+		else:
+			contained = { id( a ) for a in activities }
+			ordered = [ a for a in self.activities if id( a ) in contained ]
+		return ordered + [ a for a in activities if id( a ) not in self._key_of ]
+
+class ResourceIndex:
+	"""
+	Resources of activities by uid/path and base uid, catalogued by type, path, source and uid head as well. Buckets
+	are keyed by the object id of the resource, which allows removal in constant time.
+	"""
+
+	def __init__( self, activities: Iterable[Activity] = () ):
+		self.uid_path_to_resource: Dict[Tuple[str, str], Resource] = {}
+		self.base_uid_to_resources: Dict[str, Dict[int, Resource]] = {}
+		self.type_to_resources: Dict[str, Dict[int, Resource]] = {}
+		self.path_to_resources: Dict[str, Dict[int, Resource]] = {}
+		self.source_to_resources: Dict[str, Dict[int, Resource]] = {}
+		self.head_to_resources: Dict[str, Dict[int, Resource]] = {}
+		self.resource_to_activity: Dict[int, Activity] = {} # key is the object id of the resource
+
+		# keys under which the resources of an activity have been indexed, key is the object id of the activity
+		self._keys: Dict[int, List[Tuple[Tuple[str, str], str, Resource]]] = {}
+
+		for a in activities:
+			self.add( a )
+
+	def add( self, activity: Activity ) -> None:
+		uid = str( activity.uid ) if activity.uid else None
+		resources = [ ( (uid, r.path), _base_uid( activity, r ), r ) for r in activity.resources ]
+		for uid_path, base_uid, r in resources:
+			self.uid_path_to_resource.setdefault( uid_path, r )
+			_add_keyed( self.base_uid_to_resources, base_uid, r )
+			for catalogue, key in self._catalogue_keys( activity, r ):
+				_add_keyed( catalogue, key, r )
+			self.resource_to_activity[id( r )] = activity
+		self._keys[id( activity )] = resources
+
+	def remove( self, activity: Activity ) -> None:
+		for uid_path, base_uid, r in self._keys.pop( id( activity ), [] ):
+			if self.uid_path_to_resource.get( uid_path ) is r:
+				del self.uid_path_to_resource[uid_path]
+			_remove_keyed( self.base_uid_to_resources, base_uid, r )
+			for catalogue, key in self._catalogue_keys( activity, r ):
+				_remove_keyed( catalogue, key, r )
+			self.resource_to_activity.pop( id( r ), None )
+
+	def resources_of( self, catalogue: Dict[str, Dict[int, Resource]], *keys: str ) -> List[Resource]:
+		"""
+		Returns the resources of the provided catalogue stored under the provided keys, ordered by activity id.
+		"""
+		resources = [ r for k in unique( keys ) for r in catalogue.get( k, {} ).values() ]
+		if len( keys ) > 1:
+			resources.sort( key=lambda r: self._position( r ) )
+		return resources
+
+	def _position( self, resource: Resource ) -> Tuple[int, int]:
+		if ( activity := self.resource_to_activity.get( id( resource ) ) ) is None: # stale entry, sort it last
+			return maxsize, maxsize
+		return activity.id or 0, next( ( i for i, r in enumerate( activity.resources ) if r is resource ), maxsize )
+
+	# noinspection PyMethodMayBeStatic
+	def _catalogue_keys( self, activity: Activity, resource: Resource ) -> List[Tuple[Dict[str, Dict[int, Resource]], str]]:
+		keys = [ ( self.type_to_resources, resource.type ), ( self.path_to_resources, resource.path ), ( self.source_to_resources, resource.source ) ]
+		if uid := resource.uid or activity.uid:
+			keys.append( ( self.head_to_resources, uid.head if isinstance( uid, UID ) else UID( uid ).head ) )
+		return [ ( catalogue, key ) for catalogue, key in keys if key is not None ]
+
 class ActivityDbIndex:
+	"""
+	Index over the activities and resources of an activity db. Allows lookups by id, uid, group member uid, classifier
+	and resource uid/path in constant time. The resource index and time indexes on starttime and starttime_local are
+	created on first use.
+	The index needs to be updated whenever an activity is inserted, removed or changes its uid, members or resources.
+	Changes of start times of dirty activities are picked up before each use of a time index.
+	"""
+
+	def __init__( self, activities: Optional[Iterable[Activity]] = None ):
+		self.id_to_activity: Dict[int, Activity] = {}
+		self.uid_to_activity: Dict[str, Activity] = {}
+		self.member_to_groups: Dict[str, Dict[int, Activity]] = {} # buckets are keyed by object id, allows removal in constant time
+		self.classifier_to_activities: Dict[str, Dict[int, Activity]] = {}
+
+		# resource index and time indexes (key is the field name), both are created on first use
+		self._resources: Optional[ResourceIndex] = None
+		self.time_indexes: Dict[str, TimeIndex] = {}
+
+		# keys under which an activity has been indexed, key is the object id of the activity
+		self._keys: Dict[int, Tuple[int, str, List[str], List[str]]] = {}
+		self._activities: Dict[int, Activity] = {}
+
+		for a in activities or []:
+			self.add( a )
+
+	def __len__( self ) -> int:
+		return len( self._keys )
+
+	def __contains__( self, activity: Activity ) -> bool:
+		return id( activity ) in self._keys
+
+	def add( self, activity: Activity ) -> None:
+		if id( activity ) in self._keys:
+			self.remove( activity )
+
+		uid = str( activity.uid ) if activity.uid else None
+		members = _members( activity )
+		classifiers = list( unique( classifiers_of( activity ) ) )
+
+		if activity.id is not None:
+			self.id_to_activity.setdefault( activity.id, activity )
+		if uid:
+			self.uid_to_activity.setdefault( uid, activity )
+		for m in members:
+			_add_keyed( self.member_to_groups, m, activity )
+		for c in classifiers:
+			_add_keyed( self.classifier_to_activities, c, activity )
+
+		self._keys[id( activity )] = (activity.id, uid, members, classifiers)
+		self._activities[id( activity )] = activity
+		if self._resources is not None:
+			self._resources.add( activity )
+		for t in self.time_indexes.values():
+			t.add( activity )
+
+	def remove( self, activity: Activity ) -> None:
+		if ( keys := self._keys.pop( id( activity ), None ) ) is None:
+			return
 
-	UID_TO_ACTIVITY: Dict[str, Activity] = {}
-	UID_TO_RESOURCE: Dict[str, List[Resource]] = {}
-	UID_PATH_TO_RESOURCE: Dict[Tuple[str,str], Resource] = {}
+		activity_id, uid, members, classifiers = keys
+		del self._activities[id( activity )]
+		if self._resources is not None:
+			self._resources.remove( activity )
+		for t in self.time_indexes.values():
+			t.remove( activity )
+		if self.id_to_activity.get( activity_id ) is activity:
+			del self.id_to_activity[activity_id]
+		if self.uid_to_activity.get( uid ) is activity:
+			del self.uid_to_activity[uid]
+		for m in members:
+			_remove_keyed( self.member_to_groups, m, activity )
+		for c in classifiers:
+			_remove_keyed( self.classifier_to_activities, c, activity )
+
+	def update( self, activity: Activity ) -> None:
+		self.remove( activity )
+		self.add( activity )
+
+	def find( self, predicates: List[Predicate], order: Optional[str] = None ) -> List[Activity]:
+		"""
+		Returns the activities matching all provided predicates, ordered by id or by the provided time field. Only the
+		first predicate is looked up, the others are checked against its result.
+		"""
+		first, *others = sorted( predicates, key=lambda p: ( p.is_range, p.name != order ) ) # prefer lookups of single values over ranges
+		activities = [ a for a in self.lookup( first ) if all( p.matches( a ) for p in others ) ]
+		if order and first.name == order and first.is_range:
+			return activities # time lookups are already in order
+		activities.sort( key=lambda a: a.id or 0 )
+		return self.order( activities, order ) if order else activities
+
+	def lookup( self, predicate: Predicate ) -> List[Activity]:
+		if predicate.name == 'id' and predicate.values is not None:
+			return [ a for v in predicate.values if ( a := self.id_to_activity.get( v ) ) and predicate.accepts( a.id ) ]
+		elif predicate.name == 'id':
+			return [ a for id, a in self.id_to_activity.items() if predicate.accepts( id ) ]
+		elif predicate.name == 'uid':
+			return [ a for v in predicate.values if ( a := self.uid_to_activity.get( v ) ) ]
+		elif predicate.name == 'classifier':
+			return list( { id( a ): a for v in predicate.values for a in self.classifier_to_activities.get( v, {} ).values() }.values() )
+		elif predicate.name in DATE_RANGE_FIELDS:
+			index = self.time_index( predicate.name )
+			if predicate.values is not None:
+				activities = [ a for v in sorted( predicate.values ) for a in index.range( v, v ) ]
+			else:
+				activities = index.range( predicate.lower, predicate.upper, predicate.lower_strict, predicate.upper_strict )
+			return [ a for a in activities if predicate.matches( a ) ]
+		raise ValueError( f'unable to look up predicate {predicate}' )
 
-	def __init__( self, activity_map: Dict[int, Activity], resource_map: Dict[int, Resource] ):
-		self.__class__.UID_TO_ACTIVITY = { uid: a for a in activity_map.values() for uid in a.uids }
-		self.__class__.UID_TO_RESOURCE = { uid: list( it ) for uid, it in groupby( resource_map.values(), key=lambda r: r.uid ) }
-		self.__class__.UID_PATH_TO_RESOURCE = { (r.uid, r.path) for r in resource_map.values() }
+	def time_index( self, name: str ) -> TimeIndex:
+		if ( index := self.time_indexes.get( name ) ) is None:
+			index = self.time_indexes[name] = TimeIndex( name, self._activities.values() )
+		else:
+			index.refresh( a for a in self._activities.values() if a.__dirty__ ) # start times might have changed since the last commit
+		return index
 
-		self._relate_activities()
+	@property
+	def resources( self ) -> ResourceIndex:
+		if self._resources is None:
+			self._resources = ResourceIndex( self._activities.values() )
+		return self._resources
 
-	def _relate_activities( self ):
-		for uid, activity in self.UID_TO_ACTIVITY.items():
-			activity.__resources__ = self.UID_TO_RESOURCE.get( uid, [] )
-			for r in activity.__resources__:
-				r.__parent_activity__ = activity
+	def order( self, activities: List[Activity], name: str ) -> List[Activity]:
+		"""
+		Returns the provided activities ordered by the provided time field, other fields are not supported.
+		"""
+		return self.time_index( name ).ordered( activities ) if name in DATE_RANGE_FIELDS else activities
 
 class ActivityDb:
 
-	def __init__( self, path: Optional[Union[Path, str]] = None, fs: Optional[FS] = None, read_only: bool = False, enable_index: bool = False, **kwargs ):
+	_db_files: ClassVar[Dict[str, bytes]] = DB_FILES # files which are created when missing
+
+	def __init__( self, path: Optional[Union[Path, str]] = None, fs: Optional[FS] = None, read_only: bool = False, **kwargs ):
 		"""
 		Creates an activity db, consisting of tiny db instances (meta + activities + resources + schema).
 
 		:param path: directory containing db files, may be a Path or a string
 		:param fs: instead of providing a path, it's also possible to provide the internally used filesystem object
 		:param read_only: read-only mode - does not allow write operations
-		:param enable_index: experimental, not used at the moment
+		:param journal_threshold: size of the journal in bytes, which triggers a compaction into activities.json on commit
+		:param snapshot: load activities from a binary snapshot, which is rebuilt on save() when it is outdated
+		:param lazy: structure activities on first access only (not used when loading from a snapshot)
+		:param staging: keep changes in memory until save() is called, when false changes are written to disk on commit
+		:param format: format of written json files, pretty (indented, sorted keys) or compact (minified)
+		:param compression: compression of written activity files, gzip or zstd (requires the zstandard package)
+		:param columnar: evaluate rules on a columnar mirror of numeric and time fields (requires the numpy package)
+
+		Access to a db directory is guarded by advisory locks: loading happens under a shared lock, saving (resp. writing
+		when staging is disabled) under an exclusive lock. Saving fails with a StaleDatabaseException when another process
+		has saved the db since it has been loaded.
 		"""
 
 		self._path = path
 		self._fs = fs
 		self._read_only = read_only
-
-		# initialize db file system(s)
-		self._fs = self._init_fs()
-
-		# load content from disk
-		self._load_db()
+		self._journal_threshold = kwargs.get( 'journal_threshold' )
+		self._journal_threshold = JOURNAL_THRESHOLD if self._journal_threshold is None else self._journal_threshold
+		self._snapshot = kwargs.get( 'snapshot', False )
+		self._lazy = kwargs.get( 'lazy', False )
+		self._staging = kwargs.get( 'staging', True )
+		self._format = JsonFormat( kwargs.get( 'format' ) or 'pretty', kwargs.get( 'compression' ) or None )
+		self._columnar = kwargs.get( 'columnar', False )
+		if self._columnar and not columnar_available():
+			log.warning( 'columnar evaluation of rules requires the numpy package, falling back to evaluation per activity' )
+			self._columnar = False
+		self._columns: Optional[ActivityTable] = None # created on first use
+		self._locked_by_self, self._writing_by_self = False, False
+
+		with self._locked():
+			# initialize db file system(s)
+			self._fs = self._init_fs()
+
+			# load content from disk
+			self._load_db()
 
 		# sets of types in order to classify resources
 		self._summary_types, self._recording_types = set(), set()
 		self.register_summary_types( *( kwargs.get( 'summary_types' ) or set() ) )
 		self.register_recording_types( *( kwargs.get( 'recording_types') or set() ) )
 
-		# experimental: create index and setup relations between resources and activities, turned off for now
-		if enable_index:
-			pass
-			# log.debug( f'creating db index' )
-			# self._index = ActivityDbIndex( self.activity_map, self.resource_map )
-
 	def _init_fs( self ):
 		log.debug( f'initializing db file system from path = {self._path} and ready_only = {self._read_only}' )
 
@@ -112,18 +393,21 @@ class ActivityDb:
 				return self._init_inmemory_filesystem()
 
 	def _init_filesystem( self, path: Path ) -> FS:
+		if not self._staging:
+			return self._init_existing_fs( OSFS( root_path=str( self._path ), create=True ) )
+
 		fs = MultiFS()
 		fs.add_fs( UNDERLAY, OSFS( root_path=str( self._path ), create=True ), write=False )
 		fs.add_fs( OVERLAY, MemoryFS(), write=True )
 
-		for file, content in DB_FILES.items():
+		for file, content in self._db_files.items():
 			if not fs.get_fs( UNDERLAY ).exists( f'/{file}' ):
-				fs.get_fs( UNDERLAY ).writebytes( f'/{file}', content )
+				write_atomic( f'/{file}', content, fs.get_fs( UNDERLAY ) ) # concurrent readers must not see partial files
 			# copy_file_if( self.pkgfs, f'/{f}', self.underlay_fs, f'/{f}', 'not_exists', preserve_time=True )
 
-		# todo: this is probably not needed?
-		for f in DB_FILES.keys():
-			copy_file( fs.get_fs( UNDERLAY ), f'/{f}', fs.get_fs( OVERLAY ), f'/{f}', preserve_time=True )
+		# db files are read through from the underlay, only the journal needs to be in the overlay to be appendable
+		if fs.get_fs( UNDERLAY ).exists( f'/{JOURNAL_NAME}' ):
+			copy_file( fs.get_fs( UNDERLAY ), f'/{JOURNAL_NAME}', fs.get_fs( OVERLAY ), f'/{JOURNAL_NAME}', preserve_time=True )
 
 		return fs
 
@@ -132,22 +416,25 @@ class ActivityDb:
 			log.error( f'error opening db from {self._path} in read-only mode: path does not exist' )
 			raise ResourceNotFound( str( path ) )
 
-		osfs = OSFS( root_path=str( self._path ) )
-		fs = MemoryFS()
+		# db files are read (resp. mapped) directly from disk, changes only end up in the overlay and are never saved
+		fs = MultiFS()
+		fs.add_fs( UNDERLAY, OSFS( root_path=str( self._path ) ), write=False )
+		fs.add_fs( OVERLAY, MemoryFS(), write=True )
 
-		for f in DB_FILES.keys():
-			try:
-				copy_file( osfs, f'/{f}', fs, f'/{f}', preserve_time=True )
-			except ResourceNotFound:
-				fs.writebytes( f, DB_FILES.get( f ) )
+		for file, content in self._db_files.items():
+			if not fs.get_fs( UNDERLAY ).exists( f'/{file}' ):
+				fs.get_fs( OVERLAY ).writebytes( f'/{file}', content )
+
+		if fs.get_fs( UNDERLAY ).exists( f'/{JOURNAL_NAME}' ):
+			copy_file( fs.get_fs( UNDERLAY ), f'/{JOURNAL_NAME}', fs.get_fs( OVERLAY ), f'/{JOURNAL_NAME}', preserve_time=True )
 
 		return fs
 
 	# noinspection PyMethodMayBeStatic
 	def _init_existing_fs( self, fs: FS ) -> FS:
-		for file, content in DB_FILES.items():
+		for file, content in self._db_files.items():
 			if not fs.exists( file ):
-				fs.writebytes( file, content )
+				write_atomic( f'/{file}', content, fs )
 		return fs
 
 	# for development only ...
@@ -157,7 +444,24 @@ class ActivityDb:
 
 	def _load_db( self ):
 		self._schema = load_schema( self.fs )
-		self._activities: Activities = load_activities( self.fs )
+		key = snapshot_key( self.fs, SCHEMA_VERSION, self._format ) if self._snapshot else None
+		if not key or ( activities := load_snapshot( self.fs, key ) ) is None:
+			activities, key = self._load_activities(), None # a stale snapshot is rebuilt on save()
+		self._snapshot_key: Optional[Tuple] = key # key of the snapshot on disk, if it is up to date
+
+		self._activities: Activities = activities
+		self._index = ActivityDbIndex( self._activities )
+		# ids of all committed activities, used to calculate the journal entries on commit
+		self._committed: Set[int] = set( self._activities.ids() )
+
+	def _load_activities( self ) -> Activities:
+		raw = read_activities( self.fs )
+		activities = Activities.from_dict( raw, lazy=self._lazy )
+		if not self._lazy: # keep the persisted form, it is serialized when needed (lazy activities keep their raw data anyway)
+			for a, d in zip( activities, raw ):
+				a.__serialized__ = d
+		log.debug( f'loaded {len( activities )} activities from {ACTIVITIES_NAME}' )
+		return activities
 
 	def register_summary_types( self, *types: str ):
 		[ self._summary_types.add( t ) for t in types ]
@@ -167,18 +471,143 @@ class ActivityDb:
 
 	# todo: remove do_commit flag?
 	def commit( self, do_commit: bool = True ):
-		if do_commit:
-			write_activities( self._activities, self.overlay_fs )
+		"""
+		Commits all changes since the last commit by appending them to the journal. The journal is folded into
+		activities.json when it exceeds the journal threshold.
+		"""
+		if not do_commit:
+			return
+
+		self._refresh_columns()
+
+		# only dirty and new activities are serialized, clean activities are still in their persisted form
+		entries, committed = [], set()
+		for a in self._activities:
+			committed.add( a.id )
+			if not a.__dirty__ and a.id in self._committed:
+				continue
+			if a.__dirty__:
+				self._index.update( a ) # picks up changed start times
+			if isinstance( previous := a.__serialized__, dict ):
+				previous = serialize_dict( previous, self._format ) # the persisted form is encoded only when it is compared
+			serialized = serialize_activity( a, self._format )
+			if a.id not in self._committed:
+				entries.append( { 'op': 'insert', 'activity': loads( a.__serialized__ ) } )
+			elif serialized is not None and serialized != previous:
+				entries.append( { 'op': 'update', 'activity': loads( serialized ) } )
+		entries.extend( { 'op': 'remove', 'id': id } for id in sorted( self._committed - committed, key=lambda i: i or 0 ) )
+
+		with self._writing() if entries else nullcontext():
+			if entries:
+				append_journal( entries, self.overlay_fs )
+			self._committed = committed
+
+			if journal_size( self.overlay_fs ) > self._journal_threshold:
+				self.compact()
+
+	def compact( self ):
+		"""
+		Writes all activities to activities.json and removes the journal.
+		"""
+		self._refresh_columns()
+		with self._writing():
+			write_activities( self._activities, self.overlay_fs, self._format )
+			remove_journal( self.overlay_fs )
+		self._committed = set( self._activities.ids() )
 
 	def save( self ):
+		"""
+		Saves all staged changes to disk and increases the generation of the db. Only files which differ are written.
+		An outdated snapshot is rebuilt as well.
+		"""
 		if self._read_only or self.underlay_fs is None:
 			return
-		for f in DB_FILES:
-			copy_file_if( self.overlay_fs, f'/{f}', self.underlay_fs, f'/{f}', 'newer' )
+
+		with self._locked( exclusive=True ):
+			if self.underlay_fs is not self.overlay_fs and ( changes := self._changes() ): # without staging, changes are already on disk
+				self._check_generation()
+				for path in changes:
+					if self.overlay_fs.exists( path ):
+						write_atomic( path, self.overlay_fs.readbytes( path ), self.underlay_fs )
+					else:
+						self.underlay_fs.remove( path )
+					log.debug( f'saved {path}' )
+				self._next_generation()
+			self._save_snapshot()
+
+	def _save_snapshot( self ) -> None:
+		"""
+		Rebuilds an outdated snapshot, needs to run under the exclusive lock. The snapshot is only written when the
+		activities in memory are exactly what has been saved: no uncommitted changes and no saves of other processes.
+		"""
+		if not self._snapshot or self._read_only:
+			return
+		if any( a.__dirty__ for a in self._activities ) or self._committed != set( self._activities.ids() ):
+			return
+		if load_schema( self.underlay_fs ).generation != self._schema.generation:
+			return
+		if ( key := snapshot_key( self.underlay_fs, SCHEMA_VERSION, self._format ) ) != self._snapshot_key:
+			write_snapshot( self._activities, key, self.underlay_fs )
+			self._snapshot_key = key
+
+	def _changes( self ) -> List[str]:
+		"""
+		Returns the paths of all files which need to be saved, files which do not exist in the overlay need to be removed.
+		"""
+		changes = [ f'/{f}' for f in self._db_files if self.overlay_fs.exists( f'/{f}' ) and differs( f'/{f}', self.overlay_fs, self.underlay_fs ) ]
+		if self.overlay_fs.exists( f'/{JOURNAL_NAME}' ):
+			changes.extend( [ f'/{JOURNAL_NAME}' ] if differs( f'/{JOURNAL_NAME}', self.overlay_fs, self.underlay_fs ) else [] )
+		elif self.underlay_fs.exists( f'/{JOURNAL_NAME}' ):
+			changes.append( f'/{JOURNAL_NAME}' )
+		return changes
 
 	def close( self ):
 		# self.commit() # todo: really do auto-commit here?
-		self.save()
+		try:
+			self.save()
+		except StaleDatabaseException as e:
+			log.error( f'{e}, changes have not been saved' )
+
+	# ---- locking ----
+
+	@contextmanager
+	def _locked( self, exclusive: bool = False ) -> Iterator[None]:
+		if self._locked_by_self: # nested operations run under the lock of the outer operation
+			yield
+			return
+
+		with lock( self._path, exclusive ):
+			self._locked_by_self = True
+			try:
+				yield
+			finally:
+				self._locked_by_self = False
+
+	@contextmanager
+	def _writing( self ) -> Iterator[None]:
+		"""
+		Guards writes which go to disk directly, this is the case when staging is disabled.
+		"""
+		if not self._path or self._read_only or self.underlay_fs is not self.overlay_fs or self._writing_by_self:
+			yield
+			return
+
+		with self._locked( exclusive=True ):
+			self._check_generation()
+			self._writing_by_self = True
+			try:
+				yield
+			finally:
+				self._writing_by_self = False
+			self._next_generation()
+
+	def _check_generation( self ) -> None:
+		if ( current := load_schema( self.underlay_fs ).generation ) != self._schema.generation:
+			raise StaleDatabaseException( f'database in {self._path} has been changed by another process', self._schema.generation, current )
+
+	def _next_generation( self ) -> None:
+		self._schema.generation += 1
+		write_schema( self._schema, self.underlay_fs )
 
 	# ---- FS Properties ----
 
@@ -204,11 +633,15 @@ class ActivityDb:
 	def schema( self ) -> Schema:
 		return self._schema
 
+	@property
+	def format( self ) -> JsonFormat:
+		return self._format
+
 	# properties for content access
 
 	@property
 	def activity_map( self ) -> Mapping[int, Activity]:
-		return self._activities.id_map()
+		return MappingProxyType( self._index.id_to_activity )
 
 	@property
 	def activities( self ) -> List[Activity]:
@@ -220,7 +653,7 @@ class ActivityDb:
 
 	@property
 	def activity_ids( self ) -> List[int]:
-		return sorted( list( self._activities.id_keys() ) )
+		return sorted( self._index.id_to_activity.keys() )
 
 	@property
 	def resources( self ) -> Resources:
@@ -228,15 +661,13 @@ class ActivityDb:
 
 	# ---- DB Operations --------------------------------------------------------
 
-	# noinspection PyMethodMayBeStatic
-	def _next_id( self, d: Dict ) -> int:
-		key_range = range( 1, max( d.keys() ) + 2 ) if d.keys() else [1]
-		return set( key_range ).difference( set( d.keys() ) ).pop()
-
 	# insert/upsert activities
 
 	def insert( self, *activities ) -> List[int]:
-		return self._activities.add( *activities )
+		ids = self._activities.add( *activities )
+		for a in activities:
+			self._index.add( a )
+		return ids
 
 	def insert_activity( self, activity: Activity ) -> int:
 		return self.insert( activity )[0]
@@ -245,21 +676,60 @@ class ActivityDb:
 		return [ self.insert_activity( a ) for a in activities ]
 
 	def upsert( self, *activities ) -> int|List[int]:
-		return l[0] if len( l := [self.upsert_activity( a ) for a in activities] ) == 1 else l
+		return l[0] if len( l := self.upsert_many( activities ) ) == 1 else l
 
 	def upsert_activity( self, activity: Activity ) -> int:
-		#if existing := self.get_by_uid( activity.uid ):
-		if existing := self.get_for_uid( activity.uid ):
-			if existing.group:
-				Activity.group_of( existing, activity, target=existing )
-			else:
-				Activity.union_of( activity, target=existing, force=True )
-			return existing.id
-		else:
-			return self.insert_activity( activity )
+		return self.upsert_many( [ activity ] )[0]
 
 	def upsert_activities( self, activities: List[Activity] ) -> List[int]:
-		return [ self.upsert_activity( a ) for a in activities ]
+		return self.upsert_many( activities )
+
+	def upsert_many( self, activities: List[Activity] ) -> List[int]:
+		"""
+		Upserts a batch of activities: activities with an uid already known to the db (as activity or as group member)
+		are merged into the existing activity, all others are inserted in one go. Activities within the batch sharing
+		the same uid are merged as well. Activities without uid are never merged, so they are rejected like on insert.
+
+		:param activities: activities to upsert
+		:return: ids of the activities the provided activities ended up in, in the order of the provided activities
+		"""
+		targets, new, updated = [], {}, {}
+		for a in activities:
+			key = str( a.uid ) if a.uid else id( a ) # activities without uid are never merged
+			if pending := new.get( key ):
+				_merge( a, pending )
+				targets.append( pending )
+			elif a.uid and ( existing := self.get_for_uid( a.uid ) ):
+				_merge( a, existing )
+				updated[existing.id] = existing
+				targets.append( existing )
+			else:
+				new[key] = a
+				targets.append( a )
+
+		self.insert( *new.values() )
+		self.update( *updated.values() )
+		return [ a.id for a in targets ]
+
+	def update( self, *activities: Activity ) -> None:
+		"""
+		Announces changes of the provided activities to the db. This needs to be called after uid, group members
+		or resources of an activity have been changed outside of insert/upsert.
+		"""
+		self._activities.rekey( *activities )
+		for a in activities:
+			a.__dirty__ = True
+			self._index.update( a )
+
+	def replace_activities( self, activities: List[Activity] ) -> None:
+		"""
+		Replaces all activities of this db with the provided activities, keeping their ids.
+		"""
+		self._activities = Activities( lst=activities, skip_checks=True )
+		self._index = ActivityDbIndex( self._activities )
+		self._columns = None
+		for a in self._activities:
+			a.__dirty__ = True
 
 	# def replace_activity( self, new: Activity, old: Activity = None, id: int = None, uid = None ) -> None:
 	# 	self._activities.replace( new, old, id, uid )
@@ -267,7 +737,8 @@ class ActivityDb:
 	# remove items
 
 	def remove_activity( self, a: Activity ) -> None:
-		self._activities.remove( a.id )
+		self._index.remove( a )
+		self._activities.remove( a )
 
 	def remove_activities( self, activities: List[Activity], auto_commit: bool = False ) -> None:
 		[self.remove_activity( a ) for a in activities]
@@ -281,8 +752,7 @@ class ActivityDb:
 		Returns all resource of type summary.
 		:return: all summaries
 		"""
-		# return [r for r in self.resources if (rt := cast( ResourceType, Registry.instance().resource_types.get( r.type ) )) and rt.summary]
-		return [r for r in self.resources if r.type in self._summary_types ]
+		return list( self.find_resources_of_type( *self._summary_types ) )
 
 	@property
 	def recordings( self ) -> List[Resource]:
@@ -290,7 +760,7 @@ class ActivityDb:
 		Returns all resources of type recording.
 		:return: all recordings
 		"""
-		return [r for r in self.resources if r.type in self._recording_types]
+		return list( self.find_resources_of_type( *self._recording_types ) )
 
 	@property
 	def uids( self, classifier: str = None ) -> List[str]:
@@ -313,15 +783,11 @@ class ActivityDb:
 			return False
 
 	def contains_activity( self, uid: UID|str ) -> bool:
-		uid = uid if isinstance( uid, UID ) else UID.from_str( uid )
-		return any( u == uid for u in self._activities.iter_uids() )
+		uid = str( uid )
+		return uid in self._index.uid_to_activity or uid in self._index.member_to_groups
 
 	def contains_resource( self, uid: UID|str, path: Optional[str] ) -> bool:
-		if isinstance( uid, UID ):
-			uid = UID( uid.classifier, uid.local_id, path or uid.path )
-		else:
-			uid = UID( uid, path=path if path else None )
-		return any( (u == uid or u.base == uid.base) for u in self._activities.iter_resource_uids() )
+		return str( _resource_uid( uid, path ).base ) in self._index.resources.base_uid_to_resources
 
 	# get methods
 
@@ -340,7 +806,7 @@ class ActivityDb:
 		There should never be two activities with the same id.
 		:param id: id of the activity
 		"""
-		return first_true( self.activities, pred=lambda a: a.id == id )
+		return self._index.id_to_activity.get( id )
 
 	def get_by_uid( self, uid: UID|str ) -> Optional[Activity]:
 		"""
@@ -348,7 +814,7 @@ class ActivityDb:
 		This method does not treat any uids which appear as group members.
 		:param uid: uid of the activity
 		"""
-		return first_true( self.activities, pred=lambda a: a.uid == uid )
+		return self._index.uid_to_activity.get( str( uid ) ) if uid else None
 
 	def get_for_uid( self, uid: UID|str ) -> Optional[Activity]:
 		"""
@@ -358,7 +824,7 @@ class ActivityDb:
 		:param uid:
 		:return:
 		"""
-		return first_true( self._activities, pred=lambda a: uid in [ a.uid, *a.metadata.members ] )
+		return next( iter( self.find_for_uid( uid ) ), None )
 
 	def get_group_for_uid( self, uid: UID|str ) -> Optional[Activity]:
 		"""
@@ -367,7 +833,7 @@ class ActivityDb:
 		:param uid:
 		:return:
 		"""
-		return first_true( self._activities, pred=lambda a: uid in a.metadata.members )
+		return next( iter( self.find_groups_for_uid( uid ) ), None )
 
 	def get_resource_by_uid_path( self, uid: UID|str, path: str ) -> Optional[Resource]:
 		"""
@@ -376,18 +842,69 @@ class ActivityDb:
 		:param path:
 		:return:
 		"""
-		return next( (r for r in self.find_resources_by_uid( uid ) if r.path == path), None )
+		return self._index.resources.uid_path_to_resource.get( (str( uid ), path) ) if uid else None
 
 	# several find methods to make life easier
 
 	# find activities
 
-	def find( self, rules: List[Rule] = None ) -> List[Activity]:
-		all_activities = self.activities
-		for r in rules:
-			# all_activities = filter( r.evaluate, all_activities )
-			all_activities = r.filter( all_activities )
-		return list( all_activities )
+	def find( self, rules: List[Rule] = None, order: Optional[str] = None ) -> List[Activity]:
+		return self.execute( self.plan( rules ), order )
+
+	def plan( self, rules: List[Rule] = None ) -> QueryPlan:
+		"""
+		Creates the query plan for finding activities matching the provided rules.
+		"""
+		return plan_query( rules or [], indexed=self._indexed )
+
+	def execute( self, plan: QueryPlan, order: Optional[str] = None ) -> List[Activity]:
+		"""
+		Executes a query plan. Results are ordered by id or by the provided time field (starttime or starttime_local),
+		activities without a time come last then.
+		"""
+		if plan.lookups:
+			activities = self._lookup( plan, order )
+		else:
+			activities = self._candidates( plan.rules )
+		for p in plan.filters:
+			activities = [ a for a in activities if p.matches( a ) ]
+		for r in plan.residual:
+			activities = self._filter( r, activities )
+		activities = list( activities )
+		return self._order( activities, order ) if order and not plan.lookups else activities
+
+	# noinspection PyMethodMayBeStatic
+	def _indexed( self, predicate: Predicate ) -> bool:
+		"""
+		Tells whether a predicate can be answered by the index of this db.
+		"""
+		return predicate.name in [ 'id', 'uid', 'classifier', *DATE_RANGE_FIELDS ]
+
+	def _lookup( self, plan: QueryPlan, order: Optional[str] = None ) -> List[Activity]:
+		return self._index.find( plan.lookups, order )
+
+	def _order( self, activities: List[Activity], order: str ) -> List[Activity]:
+		return self._index.order( activities, order )
+
+	def _candidates( self, rules: List[Rule] ) -> List[Activity]:
+		"""
+		Returns the activities which need to be evaluated against the provided rules.
+		"""
+		return self.activities
+
+	def _filter( self, rule: Rule, activities: Iterable[Activity] ) -> Iterable[Activity]:
+		if not self._columnar:
+			return rule.filter( activities )
+		if self._columns is None:
+			self._columns = ActivityTable()
+		return self._columns.filter( rule, activities )
+
+	def _refresh_columns( self ) -> None:
+		"""
+		Updates the columnar mirror with changed activities, needs to happen before dirty flags are reset.
+		"""
+		if self._columns is not None:
+			self._columns.refresh()
 
 	def find_by_id( self, ids: List[int] ) -> List[Activity]:
 		"""
@@ -395,7 +912,7 @@ class ActivityDb:
 		:param ids:
 		:return:
 		"""
-		return [ a for a in self._activities if a.id in ( ids or [] ) ]
+		return [ a for id in sorted( set( ids or [] ) ) if ( a := self._index.id_to_activity.get( id ) ) ]
 
 	def find_by_uid( self, uids: List[str] ) -> List[Activity]:
 		"""
@@ -404,7 +921,8 @@ class ActivityDb:
 		:param uids:
 		:return:
 		"""
-		return [ a for a in self._activities if a.uid in ( uids or [] ) ]
+		activities = [ a for uid in unique( str( u ) for u in uids or [] ) if ( a := self._index.uid_to_activity.get( uid ) ) ]
+		return sorted( activities, key=lambda a: a.id or 0 )
 
 	def find_for_uid( self, uid: UID|str ) -> List[Activity]:
 		"""
@@ -414,7 +932,10 @@ class ActivityDb:
 		:param uid:
 		:return:
 		"""
-		return [ a for a in self._activities if ( uid in [ a.uid, *a.metadata.members ] ) ] if uid else []
+		if not uid:
+			return []
+		activities = [ a ] if ( a := self._index.uid_to_activity.get( str( uid ) ) ) else []
+		return sorted( [ *activities, *self._index.member_to_groups.get( str( uid ), {} ).values() ], key=lambda act: act.id or 0 )
 
 	def find_groups_for_uid( self, uid: Optional[str] ) -> List[Activity]:
 		"""
@@ -423,13 +944,13 @@ class ActivityDb:
 		:param uid:
 		:return:
 		"""
-		return [a for a in self._activities if uid in a.metadata.members ] if uid else []
+		return sorted( self._index.member_to_groups.get( str( uid ), {} ).values(), key=lambda a: a.id or 0 ) if uid else []
 
 	def find_by_classifier( self, classifier: str ) -> List[Activity]:
 		"""
 		Finds all activities, which have a certain classifier (originate from a certain service, i.e. polar).
 		"""
-		return [a for a in self._activities if any( uid.startswith( classifier ) for uid in a.iter_uid_heads )]
+		return [a for a in self._activities if any( str( uid ).startswith( f'{classifier}:' ) for uid in [ a.uid, *a.metadata.members ] )]
 
 	def find_first( self, classifier: Optional[str] = None ) -> Optional[Activity]:
 		"""
@@ -456,11 +977,34 @@ class ActivityDb:
 		"""
 		Finds resources having the given uid and optionally the given path.
 		"""
-		resources = [ r for r in self.resources if r.uid == uid ]
+		head = uid.head if isinstance( uid, UID ) else UID( uid ).head
+		index = self._index.resources
+		resources = [ r for r in index.resources_of( index.head_to_resources, head ) if ( r.uid or index.resource_to_activity[id( r )].uid ) == uid ]
 		if path:
 			resources = [ r for r in resources if r.path == path ]
 		return resources
 
+	def find_resources_by_path( self, path: str ) -> Resources:
+		"""
+		Finds all resources with the given path.
+		"""
+		index = self._index.resources
+		return Resources( *index.resources_of( index.path_to_resources, path ) )
+
+	def find_resources_by_source( self, source: str ) -> Resources:
+		"""
+		Finds all resources which have been imported from the given source.
+		"""
+		index = self._index.resources
+		return Resources( *index.resources_of( index.source_to_resources, source ) )
+
+	@property
+	def resource_sources( self ) -> List[str]:
+		"""
+		Returns the sources of all resources.
+		"""
+		return list( self._index.resources.source_to_resources.keys() )
+
 	def find_resources_by_uid( self, uid: UID|str ) -> Resources:
 		"""
 		Returns all resources of the activity with the provided uid.
@@ -481,7 +1025,8 @@ class ActivityDb:
 		"""
 		Finds all resources of the given type.
 		"""
-		return Resources( *[r for r in self._activities.iter_resources() if r.type in types] )
+		index = self._index.resources
+		return Resources( *index.resources_of( index.type_to_resources, *types ) )
 
 	def find_resources_for( self, uid: UID|str ) -> Resources:
 		"""
@@ -495,16 +1040,424 @@ class ActivityDb:
 		"""
 		Finds all recording resources. Optinally restricts the result to the provided UIDs.
 		"""
-		resources = Resources( *chain( *[self.find_resources_for( uid ) for uid in uids] ) ) if uids else self._activities.iter_resources()
+		if not uids:
+			return self.find_resources_of_type( *self._recording_types )
+		resources = Resources( *chain( *[self.find_resources_for( uid ) for uid in uids] ) )
 		return Resources( *[r for r in resources if r.type in self._recording_types] )
 
 	def find_summaries( self, *uids: Optional[UID|str] ) -> Resources:
 		"""
 		Finds all summary resources. Optinally restricts the result to the provided UIDs.
 		"""
-		resources = Resources( *chain( *[self.find_resources_for( uid ) for uid in uids] ) ) if uids else self._activities.iter_resources()
+		if not uids:
+			return self.find_resources_of_type( *self._summary_types )
+		resources = Resources( *chain( *[self.find_resources_for( uid ) for uid in uids] ) )
 		return Resources( *[r for r in resources if r.type in self._summary_types] )
 
+class SqliteActivityDb( ActivityDb ):
+	"""
+	Activity db keeping its activities in a SQLite database (activities.sqlite) instead of activities.json.
+	Activities are structured on first access only, lookups by id, uid, group member, classifier and resource are answered
+	by indexed SQLite queries. Dirty activities are written on commit, changes of uid, members or resources can be written
+	immediately via update().
+
+	Inserts, updates and removals go into an open SQLite transaction, which is committed to activities.sqlite on
+	commit(), regardless of staging. Commits follow the same protocol as saves of the json db: they run under the
+	exclusive lock and fail with a StaleDatabaseException (discarding the transaction) when another process has committed
+	since the db has been loaded.
+	"""
+
+	_db_files: ClassVar[Dict[str, bytes]] = { SCHEMA_NAME: DB_FILES[SCHEMA_NAME] } # activities live in activities.sqlite
+
+	def _load_db( self ):
+		self._schema = load_schema( self.fs )
+		self._snapshot = False # not used by the sqlite db
+		self._conn = self._connect()
+		self._conn.executescript( SQLITE_SCHEMA )
+		self._cache: Dict[int, Activity] = {}
+
+	def _connect( self ) -> Connection:
+		if not self._path:
+			return connect( ':memory:' )
+
+		path = Path( self._path, SQLITE_NAME )
+		if self._read_only: # work on an in-memory copy, similar to the json db
+			conn = connect( ':memory:' )
+			if path.exists():
+				with closing( connect( f'{path.as_uri()}?mode=ro', uri=True ) ) as source:
+					source.backup( conn )
+			return conn
+
+		return connect( path )
+
+	# noinspection PyMethodOverriding
+	def commit( self, do_commit: bool = True ):
+		if not do_commit:
+			return
+
+		self._refresh_columns()
+		dirty = [ a for a in self._cache.values() if a.__dirty__ ]
+		if not self._path or self._read_only: # in-memory database, nothing to guard
+			for a in dirty:
+				self._write( a )
+			self._conn.commit()
+			return
+
+		if not dirty and not self._conn.in_transaction:
+			return
+
+		with self._locked( exclusive=True ):
+			try:
+				self._check_generation()
+			except StaleDatabaseException:
+				self._conn.rollback()
+				self._cache.clear()
+				raise
+			for a in dirty:
+				self._write( a )
+			self._conn.commit()
+			self._next_generation()
+
+	def compact( self ):
+		self.commit()
+		self._conn.execute( 'VACUUM' )
+
+	def close( self ):
+		super().close()
+		self._conn.close()
+
+	# reading/writing rows
+
+	def _activity( self, id: int, data: bytes ) -> Activity:
+		if ( activity := self._cache.get( id ) ) is None:
+			activity = self._cache[id] = Activity.from_dict( loads( data ) )
+		return activity
+
+	def _select( self, where: str = None, *parameters: Any ) -> List[Activity]:
+		sql = f'SELECT id, data FROM activities WHERE {where} ORDER BY id' if where else 'SELECT id, data FROM activities ORDER BY id'
+		return [ self._activity( id, data ) for id, data in self._conn.execute( sql, parameters ) ]
+
+	def _exists( self, sql: str, *parameters: Any ) -> bool:
+		return self._conn.execute( sql, parameters ).fetchone() is not None
+
+	# query planning: ids and uids are pushed down to sqlite
+
+	def _indexed( self, predicate: Predicate ) -> bool:
+		return predicate.name in [ 'id', 'uid' ]
+
+	def _lookup( self, plan: QueryPlan, order: Optional[str] = None ) -> List[Activity]:
+		where, parameters = [], []
+		for p in plan.lookups:
+			if p.values is not None:
+				where.append( f'{p.name} IN ( {", ".join( "?" * len( p.values ) )} )' )
+				parameters.extend( _sql_value( v ) for v in p.values )
+			for bound, op in [ ( p.lower, '>' if p.lower_strict else '>=' ), ( p.upper, '<' if p.upper_strict else '<=' ) ]:
+				if bound is not None:
+					where.append( f'{p.name} {op} ?' )
+					parameters.append( _sql_value( bound ) )
+		activities = self._select( ' AND '.join( where ), *parameters )
+		return self._order( activities, order ) if order else activities
+
+	def _order( self, activities: List[Activity], order: str ) -> List[Activity]:
+		if order not in DATE_RANGE_FIELDS:
+			return activities
+		return sorted( activities, key=lambda a: ( ( t := starttime_of( a, order ) ) is None, t or datetime.min, a.id or 0 ) )
+
+	def _write( self, activity: Activity ) -> None:
+		id = activity.id
+		self._conn.execute(
+			'INSERT OR REPLACE INTO activities ( id, uid, classifier, type, starttime, data ) VALUES ( ?, ?, ?, ?, ?, ? )',
+			( id, str( activity.uid ), activity.uid.classifier, activity.type.name if activity.type else None, toisoformat( activity.starttime ), dumps( activity.to_dict() ) )
+		)
+		self._conn.execute( 'DELETE FROM members WHERE activity_id = ?', ( id, ) )
+		self._conn.executemany( 'INSERT INTO members ( uid, activity_id ) VALUES ( ?, ? )', [ ( m, id ) for m in _members( activity ) ] )
+		self._conn.execute( 'DELETE FROM resources WHERE activity_id = ?', ( id, ) )
+		self._conn.executemany(
+			'INSERT INTO resources ( activity_id, uid, base_uid, path, type ) VALUES ( ?, ?, ?, ?, ? )',
+			[ ( id, str( r.uid ) if r.uid else None, _base_uid( activity, r ), r.path, r.type ) for r in activity.resources ]
+		)
+		self._cache[id] = activity
+		activity.__dirty__ = False
+
+	def _delete( self, id: int ) -> None:
+		for table, column in [ ( 'activities', 'id' ), ( 'members', 'activity_id' ), ( 'resources', 'activity_id' ) ]:
+			self._conn.execute( f'DELETE FROM {table} WHERE {column} = ?', ( id, ) )
+		self._cache.pop( id, None )
+
+	# properties
+
+	@property
+	def activity_map( self ) -> Mapping[int, Activity]:
+		return MappingProxyType( { a.id: a for a in self.activities } )
+
+	@property
+	def activities( self ) -> List[Activity]:
+		return self._select()
+
+	@property
+	def activity_keys( self ) -> List[int]:
+		return [ id for id, in self._conn.execute( 'SELECT id FROM activities ORDER BY id' ) ]
+
+	@property
+	def activity_ids( self ) -> List[int]:
+		return self.activity_keys
+
+	# insert/update/remove
+
+	def insert( self, *activities ) -> List[int]:
+		uids = set()
+		for a in activities:
+			if a.uid is None:
+				raise KeyError( f'activity must have a valid UID to be added (UID = {a.uid})' )
+			if str( a.uid ) in uids or self._exists( 'SELECT 1 FROM activities WHERE uid = ?', str( a.uid ) ):
+				raise KeyError( f'activity with UID {a.uid} already contained in activities' )
+			uids.add( str( a.uid ) )
+
+		next_id = self._conn.execute( 'SELECT coalesce( max( id ), 0 ) + 1 FROM activities' ).fetchone()[0]
+		for a in activities:
+			a.id, next_id = next_id, next_id + 1
+			self._write( a )
+
+		return [ a.id for a in activities ]
+
+	def update( self, *activities: Activity ) -> None:
+		for a in activities:
+			self._write( a )
+
+	def replace_activities( self, activities: List[Activity] ) -> None:
+		for table in [ 'activities', 'members', 'resources' ]:
+			self._conn.execute( f'DELETE FROM {table}' )
+		self._cache.clear()
+		for a in activities:
+			self._write( a )
+
+	def remove_activity( self, a: Activity ) -> None:
+		self._delete( a.id )
+
+	# lookups
+
+	def contains_activity( self, uid: UID|str ) -> bool:
+		uid = str( uid )
+		return self._exists( 'SELECT 1 FROM activities WHERE uid = ? UNION SELECT 1 FROM members WHERE uid = ?', uid, uid )
+
+	def contains_resource( self, uid: UID|str, path: Optional[str] ) -> bool:
+		return self._exists( 'SELECT 1 FROM resources WHERE base_uid = ?', str( _resource_uid( uid, path ).base ) )
+
+	def get_by_id( self, id: int ) -> Optional[Activity]:
+		return next( iter( self._select( 'id = ?', id ) ), None )
+
+	def get_by_uid( self, uid: UID|str ) -> Optional[Activity]:
+		return next( iter( self._select( 'uid = ?', str( uid ) ) ), None ) if uid else None
+
+	def get_resource_by_uid_path( self, uid: UID|str, path: str ) -> Optional[Resource]:
+		return next( ( r for r in a.resources if r.path == path ), None ) if ( a := self.get_by_uid( uid ) ) else None
+
+	def find_by_id( self, ids: List[int] ) -> List[Activity]:
+		return [ a for id in sorted( set( ids or [] ) ) if ( a := self.get_by_id( id ) ) ]
+
+	def find_by_uid( self, uids: List[str] ) -> List[Activity]:
+		return sorted( [ a for uid in unique( str( u ) for u in uids or [] ) if ( a := self.get_by_uid( uid ) ) ], key=lambda a: a.id or 0 )
+
+	def find_for_uid( self, uid: UID|str ) -> List[Activity]:
+		return self._select( 'uid = ? OR id IN ( SELECT activity_id FROM members WHERE uid = ? )', str( uid ), str( uid ) ) if uid else []
+
+	def find_groups_for_uid( self, uid: Optional[str] ) -> List[Activity]:
+		return self._select( 'id IN ( SELECT activity_id FROM members WHERE uid = ? )', str( uid ) ) if uid else []
+
+	def find_by_classifier( self, classifier: str ) -> List[Activity]:
+		return self._select( 'classifier = ? OR id IN ( SELECT activity_id FROM members WHERE uid LIKE ? )', classifier, f'{classifier}:%' )
+
+	def find_resources_of_type( self, *types: str ) -> Resources:
+		where = f'id IN ( SELECT activity_id FROM resources WHERE type IN ( {", ".join( "?" * len( types ) )} ) )'
+		return Resources( *[ r for a in self._select( where, *types ) for r in a.resources if r.type in types ] )
+
+	def find_resources( self, uid: str, path: Optional[str] = None ) -> List[Resource]:
+		where = 'uid = ? OR id IN ( SELECT activity_id FROM resources WHERE uid = ? )' # resources without uid belong to the uid of their activity
+		resources = [ r for a in self._select( where, str( uid ), str( uid ) ) for r in a.resources if ( r.uid or a.uid ) == uid ]
+		return [ r for r in resources if r.path == path ] if path else resources
+
+	def find_resources_by_path( self, path: str ) -> Resources:
+		return Resources( *[ r for a in self._select( 'id IN ( SELECT activity_id FROM resources WHERE path = ? )', path ) for r in a.resources if r.path == path ] )
+
+	# sources are not part of the resources table, so these need to scan all activities
+	def find_resources_by_source( self, source: str ) -> Resources:
+		return Resources( *[ r for r in self.resources if r.source == source ] )
+
+	@property
+	def resource_sources( self ) -> List[str]:
+		return list( unique( r.source for r in self.resources if r.source is not None ) )
+
+class ShardedActivityDb( ActivityDb ):
+	"""
+	Activity db keeping its activities in yearly shards (activities/2023.json etc.) plus a manifest containing the time
+	bounds and number of activities per shard. Shards are loaded on demand: find() only loads the shards which
+	might contain activities matching the date range of its rules, all other methods load all shards. A commit only
+	rewrites shards containing changed activities. Sharded dbs do not use the journal or the snapshot.
+	"""
+
+	def _load_db( self ):
+		self._schema = load_schema( self.fs )
+		self._snapshot = False
+		self._manifest: Dict[str, Dict] = read_manifest( self.fs )
+		self._loaded_shards: Set[str] = set()
+		self._loaded_activities: Activities = Activities()
+		self._loaded_index: ActivityDbIndex = ActivityDbIndex()
+		self._shard_of: Dict[int, str] = {} # shard of each loaded activity as of the last commit
+		self._committed: Set[int] = set()
+
+	def _load_shards( self, keys: Optional[Iterable[str]] = None ) -> None:
+		if not ( keys := [ k for k in ( self._manifest.keys() if keys is None else keys ) if k in self._manifest and k not in self._loaded_shards ] ):
+			return
+
+		with self._locked():
+			self._check_generation() # shards loaded on demand need to belong to the loaded generation
+			for key in keys:
+				self._load_shard( key )
+
+	def _load_shard( self, key: str ) -> None:
+		raw = read_shard( key, self.fs )
+		activities = Activities.from_dict( raw, lazy=self._lazy )
+		for a, d in zip( activities, raw ):
+			if not self._lazy:
+				a.__serialized__ = d
+			self._loaded_activities.add( a, skip_checks=True )
+			self._loaded_index.add( a )
+			self._shard_of[a.id] = key
+		self._loaded_shards.add( key )
+
+	# all activities/index access of the base class results in loading all shards
+
+	@property
+	def _activities( self ) -> Activities:
+		self._load_shards()
+		return self._loaded_activities
+
+	@_activities.setter
+	def _activities( self, activities: Activities ) -> None:
+		self._loaded_activities = activities
+
+	@property
+	def _index( self ) -> ActivityDbIndex:
+		self._load_shards()
+		return self._loaded_index
+
+	@_index.setter
+	def _index( self, index: ActivityDbIndex ) -> None:
+		self._loaded_index = index
+
+	@property
+	def manifest( self ) -> Mapping[str, Dict]:
+		return MappingProxyType( self._manifest )
+
+	@property
+	def loaded_shards( self ) -> List[str]:
+		return sorted( self._loaded_shards )
+
+	def _candidates( self, rules: List[Rule] ) -> List[Activity]:
+		start, end = date_range( *rules )
+		start, end = start - timedelta( days=1 ) if start else None, end + timedelta( days=1 ) if end else None # allow for naive datetimes
+		self._load_shards( [ k for k, e in self._manifest.items() if _overlaps( e, start, end ) ] )
+		return list( self._loaded_activities )
+
+	def _lookup( self, plan: QueryPlan, order: Optional[str] = None ) -> List[Activity]:
+		self._candidates( plan.rules ) # loads the shards which might contain matching activities
+		return self._loaded_index.find( plan.lookups, order )
+
+	# noinspection PyMethodOverriding
+	def commit( self, do_commit: bool = True ):
+		if not do_commit:
+			return
+
+		self._refresh_columns()
+
+		# load target shards of changed activities first, as these shards will be rewritten
+		changed = [ a for a in self._loaded_activities if a.__dirty__ or a.id not in self._shard_of ]
+		for a in changed:
+			self._loaded_index.update( a ) # picks up changed start times
+		shards = { a.id: shard_key( a ) for a in changed }
+		self._load_shards( set( shards.values() ) )
+
+		current = { a.id: shards.get( a.id ) or self._shard_of[a.id] for a in self._loaded_activities }
+		keys = set( shards.values() )
+		keys.update( self._shard_of[id] for id in self._shard_of.keys() if current.get( id ) != self._shard_of[id] )
+
+		with self._writing() if keys else nullcontext():
+			for key in keys:
+				if activities := [ a for a in self._loaded_activities if current[a.id] == key ]:
+					self._manifest[key] = write_shard( key, activities, self.overlay_fs, self._format )
+				else:
+					self._manifest.pop( key, None )
+					if self.overlay_fs.exists( shard_path( key ) ):
+						self.overlay_fs.remove( shard_path( key ) )
+
+			if keys:
+				write_manifest( self._manifest, self.overlay_fs, self._format )
+		self._shard_of = current
+
+	def compact( self ):
+		self._load_shards()
+		for a in self._loaded_activities:
+			a.__dirty__ = True
+		self.commit()
+
+	def _changes( self ) -> List[str]:
+		changes = super()._changes()
+		if self.overlay_fs.exists( SHARDS_PATH ):
+			self.underlay_fs.makedirs( SHARDS_PATH, recreate=True )
+			changes.extend( p for f in self.overlay_fs.listdir( SHARDS_PATH ) if differs( p := f'{SHARDS_PATH}/{f}', self.overlay_fs, self.underlay_fs ) )
+
+		if self.underlay_fs.exists( SHARDS_PATH ):
+			for f in self.underlay_fs.listdir( SHARDS_PATH ):
+				if f.endswith( '.json' ) and f != 'manifest.json' and f[:-5] not in self._manifest:
+					changes.append( f'{SHARDS_PATH}/{f}' )
+		return changes
+
+	def replace_activities( self, activities: List[Activity] ) -> None:
+		self._load_shards()
+		super().replace_activities( activities )
+
+# ---- helper ----
+
+def _merge( activity: Activity, existing: Activity ) -> None:
+	if existing.group:
+		Activity.group_of( existing, activity, target=existing )
+	else:
+		Activity.union_of( activity, target=existing, force=True )
+
+def _resource_uid( uid: UID|str, path: Optional[str] ) -> UID:
+	if isinstance( uid, UID ):
+		return uid if not path and not uid.part else UID( uid.classifier, uid.local_id, path or uid.path )
+	else:
+		return UID( uid, path=path ) if path else UID.from_str( uid )
+
+def _base_uid( activity: Activity, resource: Resource ) -> str:
+	classifier, local_id = ( resource.uid or activity.uid ).as_tuple
+	if classifier and local_id: # same as the string form of the uid below, but without parsing it
+		return f'{classifier}:{local_id}/{basename( resource.path )}' if resource.path else f'{classifier}:{local_id}'
+	return str( UID( classifier, local_id, basename( resource.path ) if resource.path else None ) )
+
+def _sql_value( value: Any ) -> Any:
+	return float( value ) if isinstance( value, Decimal ) else value
+
+def _members( activity: Activity ) -> List[str]:
+	if activity.lazy: # avoid structuring lazy activities only because of their members
+		return [ str( m ) for m in ( activity.__raw__.get( 'metadata' ) or {} ).get( 'members', [] ) ]
+	return [ str( m ) for m in activity.metadata.members ]
+
+def _overlaps( entry: Dict, start: Optional[datetime], end: Optional[datetime] ) -> bool:
+	if entry.get( 'start' ) is None or entry.get( 'end' ) is None: # undated shard
+		return True
+	return ( end is None or datetime.fromisoformat( entry['start'] ) <= end ) and ( start is None or datetime.fromisoformat( entry['end'] ) >= start )
+
+def _add_keyed( d: Dict[str, Dict[int, Any]], key: str, item: Any ) -> None:
+	d.setdefault( key, {} )[id( item )] = item
+
+def _remove_keyed( d: Dict[str, Dict[int, Any]], key: str, item: Any ) -> None:
+	if ( bucket := d.get( key ) ) is not None and bucket.get( id( item ) ) is item:
+		del bucket[id( item )]
+		if not bucket:
+			del d[key]
+
 # ---- DB Operations ----
 
 def status_db( ctx: ApplicationContext ) -> None:
@@ -529,3 +1482,61 @@ def maintain_db( ctx: ApplicationContext, maintenance: str, **kwargs ) -> None:
 		[ctx.console.print( f ) for f in migrate_db_functions( ctx )]
 	else:
 		migrate_db( ctx, maintenance, **kwargs )
+
+def db_settings( ctx: ApplicationContext ) -> Dict[str, Any]:
+	"""
+	Returns the db settings of the configuration as keyword arguments for creating an activity db.
+	"""
+	return {
+		'journal_threshold': ctx.config.db.journal_threshold,
+		'snapshot': ctx.config.db.snapshot,
+		'lazy': ctx.config.db.lazy,
+		'staging': ctx.config.db.staging,
+		'format': ctx.config.db.format,
+		'compression': ctx.config.db.compression,
+		'columnar': ctx.config.db.columnar,
+	}
+
+def json_to_sqlite( path: Path, **kwargs ) -> None:
+	"""
+	Copies all activities from activities.json to activities.sqlite in the provided db directory. Keyword arguments are
+	passed to both dbs, see db_settings().
+	"""
+	json_db, sqlite_db = ActivityDb( path=path, **kwargs ), SqliteActivityDb( path=path, **kwargs )
+	sqlite_db.replace_activities( json_db.activities )
+	sqlite_db.commit()
+	sqlite_db.close()
+	log.info( f'copied {len( json_db.activities )} activities to {SQLITE_NAME}' )
+
+def sqlite_to_json( path: Path, **kwargs ) -> None:
+	"""
+	Copies all activities from activities.sqlite to activities.json in the provided db directory. Keyword arguments are
+	passed to both dbs, see db_settings().
+	"""
+	sqlite_db, json_db = SqliteActivityDb( path=path, **kwargs ), ActivityDb( path=path, **kwargs )
+	json_db.replace_activities( sqlite_db.activities )
+	json_db.compact()
+	json_db.save()
+	log.info( f'copied {len( sqlite_db.activities )} activities to {ACTIVITIES_NAME}' )
+
+def json_to_shards( path: Path, **kwargs ) -> None:
+	"""
+	Copies all activities from activities.json into yearly shards in the provided db directory. Keyword arguments are
+	passed to both dbs, see db_settings().
+	"""
+	json_db, sharded_db = ActivityDb( path=path, **kwargs ), ShardedActivityDb( path=path, **kwargs )
+	sharded_db.replace_activities( json_db.activities )
+	sharded_db.commit()
+	sharded_db.save()
+	log.info( f'copied {len( json_db.activities )} activities to {SHARDS_DIRNAME}' )
+
+def shards_to_json( path: Path, **kwargs ) -> None:
+	"""
+	Copies all activities from yearly shards to activities.json in the provided db directory. Keyword arguments are
+	passed to both dbs, see db_settings().
+	"""
+	sharded_db, json_db = ShardedActivityDb( path=path, **kwargs ), ActivityDb( path=path, **kwargs )
+	json_db.replace_activities( sharded_db.activities )
+	json_db.compact()
+	json_db.save()
+	log.info( f'copied {len( sharded_db.activities )} activities to {ACTIVITIES_NAME}' )
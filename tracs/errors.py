@@ -6,3 +6,10 @@ class ResourceImportException( Exception ):
 		super().__init__()
 		self.__message__ = message
 		self.__cause__ = cause
+
+class StaleDatabaseException( Exception ):
+
+	def __init__( self, message: str, loaded: int, current: int ):
+		super().__init__( message )
+		self.loaded = loaded
+		self.current = current
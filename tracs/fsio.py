@@ -1,17 +1,45 @@
+from codecs import getincrementaldecoder
+from contextlib import contextmanager
 from datetime import datetime, time, timedelta
+from fnmatch import fnmatch
+from gzip import compress as gzip_compress, decompress as gzip_decompress, GzipFile
+from hashlib import blake2b
+from itertools import count
+from json import JSONDecodeError, JSONDecoder
 from logging import getLogger
+from mmap import ACCESS_READ, mmap
+from os import chmod, close, fdopen, fsync, link, replace, stat, unlink, utime
+from os.path import basename, dirname, exists, getsize
+from pathlib import Path
+from pickle import dumps as pickle_dumps, HIGHEST_PROTOCOL, loads as pickle_loads
 from re import compile
-from typing import List, Union
+from shutil import copyfile
+from tempfile import mkstemp
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
 
 from attrs import define, field
+from attrs.validators import in_
 from cattrs.gen import make_dict_structure_fn, make_dict_unstructure_fn, override
 from cattrs.preconf.orjson import make_converter
+from dateutil.tz import UTC
 from fs.base import FS
 from fs.copy import copy_dir
+from fs.errors import NoSysPath
+from fs.multifs import MultiFS
 from fs.walk import Walker
-from orjson import dumps, loads, OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_SORT_KEYS
+from orjson import dumps, Fragment, loads, OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_SORT_KEYS
 from rich.prompt import Confirm
 
+try:
+	from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_UN
+except ImportError: # no advisory locking on windows
+	flock, LOCK_EX, LOCK_SH, LOCK_UN = None, None, None, None
+
+try:
+	from zstandard import ZstdCompressor, ZstdDecompressor
+except ImportError:
+	ZstdCompressor, ZstdDecompressor = None, None
+
 from tracs.activity import Activities, Activity, ActivityPart
 from tracs.activity_types import ActivityTypes
 from tracs.config import current_ctx as ctx
@@ -23,17 +51,118 @@ from tracs.utils import fromisoformat, str_to_timedelta, timedelta_to_str
 log = getLogger( __name__ )
 
 ORJSON_OPTIONS = OPT_APPEND_NEWLINE | OPT_INDENT_2 | OPT_SORT_KEYS
+ACTIVITY_OPTIONS = OPT_INDENT_2 | OPT_SORT_KEYS
+COMPACT_OPTIONS = OPT_APPEND_NEWLINE
+
+PRETTY, COMPACT = 'pretty', 'compact'
+GZIP, ZSTD = 'gzip', 'zstd'
+GZIP_MAGIC, ZSTD_MAGIC = b'\x1f\x8b', b'\x28\xb5\x2f\xfd'
+STREAM_CHUNK_SIZE = 1 << 20
 
 ACTIVITIES_NAME = 'activities.json'
 ACTIVITIES_PATH = f'/{ACTIVITIES_NAME}'
+LOCK_NAME = 'activities.lock'
+JOURNAL_NAME = 'activities.journal'
+JOURNAL_PATH = f'/{JOURNAL_NAME}'
+SHARDS_DIRNAME = 'activities'
+SHARDS_PATH = f'/{SHARDS_DIRNAME}'
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_PATH = f'{SHARDS_PATH}/{MANIFEST_NAME}'
+UNDATED_SHARD = 'undated'
+SNAPSHOT_NAME = 'activities.snapshot'
+SQLITE_NAME = 'activities.sqlite'
+SNAPSHOT_PATH = f'/{SNAPSHOT_NAME}'
+SNAPSHOT_VERSION = 4 # needs to be increased whenever the internal structure of activities changes
+PRETTY_DUMP_NAME = 'activities.pretty.json'
+PRETTY_DUMP_PATH = f'/{PRETTY_DUMP_NAME}'
 RESOURCES_NAME = 'resources.json'
 RESOURCES_PATH = f'/{RESOURCES_NAME}'
 SCHEMA_NAME = 'schema.json'
 SCHEMA_PATH = f'/{SCHEMA_NAME}'
+BACKUP_OBJECTS_DIRNAME = 'objects'
+BACKUP_MANIFESTS_DIRNAME = 'manifests'
+BACKUP_MANIFESTS_PATH = f'/{BACKUP_MANIFESTS_DIRNAME}'
+BACKUP_EXCLUDES = [ LOCK_NAME, SNAPSHOT_NAME, '.*' ] # lock, snapshot (only a cache) and temporary files of atomic writes
+BACKUP_COMPRESSION_RATIO = 0.9 # objects are stored compressed when compression saves at least 10%
 
 RESOURCE_CONVERTER = make_converter()
 SCHEMA_CONVERTER = make_converter()
 
+# json format
+
+def _check_compression( instance, attribute, value ) -> None:
+	if value == ZSTD and ZstdCompressor is None:
+		raise ValueError( 'zstd compression requires the zstandard package to be installed' )
+
+@define( frozen=True )
+class JsonFormat:
+	"""
+	Format of the json files of a db: pretty files are indented and have sorted keys, compact files are minified and
+	keep the key order. Both can be compressed additionally. Reading does not depend on the format, as compression is
+	detected from the file content.
+	"""
+
+	name: str = field( default=PRETTY, validator=in_( [ PRETTY, COMPACT ] ) )
+	compression: Optional[str] = field( default=None, validator=[ in_( [ None, GZIP, ZSTD ] ), _check_compression ] )
+
+	@property
+	def pretty( self ) -> bool:
+		return self.name == PRETTY
+
+	@property
+	def options( self ) -> int:
+		return ORJSON_OPTIONS if self.pretty else COMPACT_OPTIONS
+
+	def serialize( self, obj: Dict ) -> bytes:
+		"""
+		Serializes an activity dict, the result can be used as item fragment when dumping a list of activities.
+		"""
+		return dumps( obj, option=ACTIVITY_OPTIONS ).replace( b'\n', b'\n  ' ) if self.pretty else dumps( obj )
+
+	def dump( self, obj: Any ) -> bytes:
+		return compress( dumps( obj, option=self.options ), self.compression )
+
+PRETTY_FORMAT = JsonFormat()
+
+def compress( content: bytes, compression: Optional[str] ) -> bytes:
+	if compression == GZIP:
+		return gzip_compress( content, mtime=0 ) # no timestamp, unchanged content results in unchanged files
+	elif compression == ZSTD:
+		return ZstdCompressor().compress( content )
+	return content
+
+def decompress( content: bytes|memoryview ) -> bytes|memoryview:
+	if ( magic := bytes( content[:4] ) ).startswith( GZIP_MAGIC ):
+		return gzip_decompress( content )
+	elif magic.startswith( ZSTD_MAGIC ):
+		if ZstdDecompressor is None:
+			raise ValueError( 'unable to read zstd compressed file, the zstandard package is not installed' )
+		return ZstdDecompressor().decompressobj().decompress( content ) # also works for frames without content size
+	return content
+
+def read_json( path: str, fs: FS ) -> Any:
+	with mapped( path, fs ) as content:
+		return loads( decompress( content ) )
+
+@contextmanager
+def mapped( path: str, fs: FS ) -> Iterator[bytes|memoryview]:
+	"""
+	Provides the content of a file without copying it: files on disk are memory mapped, so concurrent readers share the
+	page cache of the os. Files without a system path (i.e. in memory or in the overlay of a multi fs) are read as bytes.
+	The content must not be accessed after leaving the context.
+	"""
+	try:
+		syspath = fs.getsyspath( path )
+	except NoSysPath:
+		syspath = None
+
+	if not syspath or not exists( syspath ) or getsize( syspath ) == 0: # empty files cannot be mapped
+		yield fs.readbytes( path )
+		return
+
+	with open( syspath, 'rb' ) as f, mmap( f.fileno(), 0, access=ACCESS_READ ) as m, memoryview( m ) as content:
+		yield content
+
 # support for structuring
 
 # resource
@@ -73,55 +202,539 @@ def load_resources( fs: FS ) -> Resources:
 	except RuntimeError:
 		log.error( f'error loading db', exc_info=True )
 
-def write_resources( resources: Resources, fs: FS ) -> None:
-	fs.writebytes( RESOURCES_PATH, RESOURCE_CONVERTER.dumps( resources.all( sort=True ), unstructure_as=List[Resource], option=ORJSON_OPTIONS ) )
+def write_resources( resources: Resources, fs: FS, fmt: JsonFormat = PRETTY_FORMAT ) -> None:
+	fs.writebytes( RESOURCES_PATH, RESOURCE_CONVERTER.dumps( resources.all( sort=True ), unstructure_as=List[Resource], option=fmt.options ) )
 	log.debug( f'wrote {len( resources )} resource entries to {RESOURCES_NAME}' )
 
 # activity handling
 
 def load_activities( fs: FS ) -> Activities:
 	try:
-		activities = Activities.from_dict( loads( fs.readbytes( ACTIVITIES_PATH ) ) )
+		activities = Activities.from_dict( read_activities( fs ) )
 		log.debug( f'loaded {len( activities )} activities from {ACTIVITIES_NAME}' )
 		return activities
 	except RuntimeError:
 		log.error( f'error loading db', exc_info=True )
 
-def write_activities( activities: Activities, fs: FS ) -> None:
-	fs.writebytes( ACTIVITIES_PATH, dumps( activities.to_dict(), option=ORJSON_OPTIONS ) )
+def read_activities( fs: FS ) -> List[Dict]:
+	"""
+	Reads the raw activity dicts from activities.json and replays the journal (if it exists) on top of them.
+	"""
+	return replay_journal( read_json( ACTIVITIES_PATH, fs ), read_journal( fs ) )
+
+def write_activities( activities: Activities, fs: FS, fmt: JsonFormat = PRETTY_FORMAT ) -> None:
+	write_atomic( ACTIVITIES_PATH, dump_activities( activities, fmt ), fs )
 	log.debug( f'wrote {len( activities )} activities to {ACTIVITIES_NAME}' )
 
+def dump_activities( activities: List[Activity], fmt: JsonFormat = PRETTY_FORMAT ) -> bytes:
+	fragments = [ Fragment( serialize_activity( a, fmt ) or a.__serialized__ ) for a in sorted( activities, key=lambda a: a.id ) ]
+	return fmt.dump( fragments )
+
+def serialize_activity( activity: Activity, fmt: JsonFormat = PRETTY_FORMAT ) -> Optional[bytes]:
+	"""
+	Serializes a dirty activity and caches the result in the activity. The serialized form is formatted as list item
+	of activities.json, so it can be reused as fragment when writing activities.json.
+
+	:param activity: activity to serialize
+	:param fmt: json format of the db
+	:return: serialized activity or None if the activity is clean and its cached form is still valid
+	"""
+	if not activity.__dirty__ and activity.__serialized__ is None and activity.lazy:
+		activity.__serialized__ = fmt.serialize( activity.__raw__ ) # untouched lazy activity, no need to structure it
+	elif not activity.__dirty__ and isinstance( activity.__serialized__, dict ):
+		activity.__serialized__ = fmt.serialize( activity.__serialized__ ) # hydrated activity, still in its persisted form
+
+	if activity.__dirty__ or activity.__serialized__ is None:
+		activity.__serialized__ = fmt.serialize( Activity.json_converter.unstructure( activity ) )
+		activity.__dirty__ = False
+		return activity.__serialized__
+	return None
+
+def serialize_dict( activity: Dict, fmt: JsonFormat = PRETTY_FORMAT ) -> bytes:
+	return fmt.serialize( activity )
+
+# streaming
+
+@contextmanager
+def open_stream( path: str, fs: FS ) -> Iterator[BinaryIO]:
+	"""
+	Opens a file for streaming reads, compressed files are decompressed on the fly.
+	"""
+	with fs.openbin( path ) as f:
+		magic = f.read( 4 )
+		f.seek( 0 )
+		if magic.startswith( GZIP_MAGIC ):
+			with GzipFile( fileobj=f, mode='rb' ) as g:
+				yield g
+		elif magic.startswith( ZSTD_MAGIC ):
+			if ZstdDecompressor is None:
+				raise ValueError( 'unable to read zstd compressed file, the zstandard package is not installed' )
+			with ZstdDecompressor().stream_reader( f ) as z:
+				yield z
+		else:
+			yield f
+
+def detect_format( path: str, fs: FS ) -> JsonFormat:
+	"""
+	Detects the format of an existing json file, empty arrays are considered to be pretty.
+	"""
+	with fs.openbin( path ) as f:
+		magic = f.read( 4 )
+	compression = GZIP if magic.startswith( GZIP_MAGIC ) else ZSTD if magic.startswith( ZSTD_MAGIC ) else None
+	with open_stream( path, fs ) as f:
+		head = f.read( 2 )
+	return JsonFormat( name=COMPACT if head.startswith( b'[' ) and head not in [ b'[\n', b'[]' ] else PRETTY, compression=compression )
+
+def iter_json_array( f: BinaryIO, chunk_size: int = STREAM_CHUNK_SIZE ) -> Iterator[Any]:
+	"""
+	Iterates over the items of a json array without reading the complete array into memory. The file is read in chunks,
+	items are decoded one by one from the current chunk, so memory usage only depends on the chunk size and the size of
+	the largest item.
+
+	:param f: binary file to read from
+	:param chunk_size: number of bytes to read at once
+	"""
+	decoder, text = JSONDecoder(), getincrementaldecoder( 'utf-8' )()
+	buf, pos, more, state = '', 0, True, '['
+
+	while True:
+		while pos < len( buf ) and buf[pos] in ' \t\r\n':
+			pos += 1
+		if pos == len( buf ):
+			if not more:
+				raise ValueError( 'unexpected end of json array' )
+			chunk = f.read( chunk_size )
+			buf, pos, more = buf[pos:] + text.decode( chunk, final=not chunk ), 0, bool( chunk )
+			continue
+
+		if state == '[':
+			if buf[pos] != '[':
+				raise ValueError( f'expected json array, but found {buf[pos]!r}' )
+			pos, state = pos + 1, 'first'
+		elif buf[pos] == ']' and state in [ 'first', 'next' ]:
+			return
+		elif state == 'next':
+			if buf[pos] != ',':
+				raise ValueError( f'expected , or ] in json array, but found {buf[pos]!r}' )
+			pos, state = pos + 1, 'item'
+		else:
+			try:
+				item, end = decoder.raw_decode( buf, pos )
+			except JSONDecodeError:
+				if not more:
+					raise
+				end = len( buf ) # item is incomplete, read the next chunk
+			if end == len( buf ) and more: # item might continue in the next chunk
+				chunk = f.read( chunk_size )
+				buf, pos, more = buf[pos:] + text.decode( chunk, final=not chunk ), 0, bool( chunk )
+				continue
+			yield item
+			pos, state = end, 'next'
+
+@define
+class JsonArrayWriter:
+	"""
+	Writes the items of a json array one by one, resulting in the same (uncompressed) content as JsonFormat.dump.
+	"""
+
+	f: BinaryIO = field()
+	fmt: JsonFormat = field( default=PRETTY_FORMAT )
+	count: int = field( default=0 ) # number of items already written, allows to continue a partially written array
+
+	def write( self, item: Any ) -> None:
+		if self.count == 0:
+			self.f.write( b'[\n  ' if self.fmt.pretty else b'[' )
+		else:
+			self.f.write( b',\n  ' if self.fmt.pretty else b',' )
+		self.f.write( self.fmt.serialize( item ) )
+		self.count += 1
+
+	def close( self ) -> None:
+		if self.count == 0:
+			self.f.write( b'[]\n' )
+		else:
+			self.f.write( b'\n]\n' if self.fmt.pretty else b']\n' )
+
+# journal handling
+
+def read_journal( fs: FS ) -> List[Dict]:
+	if not fs.exists( JOURNAL_PATH ):
+		return []
+	entries = [ loads( line ) for line in fs.readbytes( JOURNAL_PATH ).splitlines() if line.strip() ]
+	log.debug( f'read {len( entries )} entries from {JOURNAL_NAME}' )
+	return entries
+
+def append_journal( entries: List[Dict], fs: FS ) -> None:
+	"""
+	Appends the provided entries to the journal, one json document per line. Each entry has an op (insert, update
+	or remove) and either the complete activity (insert/update) or the id of the removed activity.
+	"""
+	with fs.open( JOURNAL_PATH, 'ab' ) as f:
+		f.write( b''.join( dumps( e, option=OPT_APPEND_NEWLINE | OPT_SORT_KEYS ) for e in entries ) )
+	log.debug( f'appended {len( entries )} entries to {JOURNAL_NAME}' )
+
+def journal_size( fs: FS ) -> int:
+	return fs.getsize( JOURNAL_PATH ) if fs.exists( JOURNAL_PATH ) else 0
+
+def remove_journal( fs: FS ) -> None:
+	if fs.exists( JOURNAL_PATH ):
+		fs.remove( JOURNAL_PATH )
+
+def replay_journal( activities: List[Dict], entries: List[Dict] ) -> List[Dict]:
+	if not entries:
+		return activities
+
+	activity_map = { a.get( 'id' ): a for a in activities }
+	for e in entries:
+		if e.get( 'op' ) in [ 'insert', 'update' ]:
+			activity_map[e['activity'].get( 'id' )] = e['activity']
+		elif e.get( 'op' ) == 'remove':
+			activity_map.pop( e.get( 'id' ), None )
+		else:
+			log.warning( f'ignoring invalid journal entry {e}' )
+
+	return sorted( activity_map.values(), key=lambda a: a.get( 'id' ) or 0 )
+
 def write_activities_as_list( activities: Activities ) -> List:
 	return activities.to_dict()
 
+# shard handling
+
+def shard_key( activity: Activity ) -> str:
+	"""
+	Returns the key of the shard an activity belongs to, this is the year of its (UTC) start time.
+	"""
+	return str( activity.starttime.astimezone( UTC ).year ) if activity.starttime else UNDATED_SHARD
+
+def shard_path( key: str ) -> str:
+	return f'{SHARDS_PATH}/{key}.json'
+
+def read_manifest( fs: FS ) -> Dict[str, Dict]:
+	"""
+	Reads the shard manifest, which maps shard keys to the number of activities and the earliest/latest start time
+	of the activities contained in a shard.
+	"""
+	return read_json( MANIFEST_PATH, fs ) if fs.exists( MANIFEST_PATH ) else {}
+
+def write_manifest( manifest: Dict[str, Dict], fs: FS, fmt: JsonFormat = PRETTY_FORMAT ) -> None:
+	fs.makedirs( SHARDS_PATH, recreate=True )
+	write_atomic( MANIFEST_PATH, dumps( manifest, option=fmt.options ), fs )
+
+def read_shard( key: str, fs: FS ) -> List[Dict]:
+	activities = read_json( shard_path( key ), fs )
+	log.debug( f'read {len( activities )} activities from shard {key}' )
+	return activities
+
+def write_shard( key: str, activities: List[Activity], fs: FS, fmt: JsonFormat = PRETTY_FORMAT ) -> Dict:
+	"""
+	Writes a shard and returns its manifest entry.
+	"""
+	fs.makedirs( SHARDS_PATH, recreate=True )
+	write_atomic( shard_path( key ), dump_activities( activities, fmt ), fs )
+	log.debug( f'wrote {len( activities )} activities to shard {key}' )
+
+	times = [ t.astimezone( UTC ) for a in activities for t in [ a.starttime, a.starttime_local ] if t ]
+	return {
+		'count': len( activities ),
+		'start': min( times ).isoformat() if times else None,
+		'end': max( times ).isoformat() if times else None,
+	}
+
+# pretty dump
+
+def pretty_dump( activities: List[Activity], fs: FS ) -> None:
+	"""
+	Writes a human-readable copy of the provided activities to activities.pretty.json, regardless of the db format.
+	"""
+	activities = sorted( activities, key=lambda a: a.id )
+	fs.writebytes( PRETTY_DUMP_PATH, PRETTY_FORMAT.dump( [ a.__raw__ if a.lazy else Activity.json_converter.unstructure( a ) for a in activities ] ) )
+	log.debug( f'wrote {len( activities )} activities to {PRETTY_DUMP_NAME}' )
+
+# snapshot handling
+
+def snapshot_key( fs: FS, schema_version: int, fmt: JsonFormat = PRETTY_FORMAT ) -> Tuple:
+	"""
+	Calculates the key of a snapshot, consisting of snapshot version, schema version, json format and size/hash of
+	activities.json and the journal. A snapshot is only valid when its key matches the key of the current db files.
+	The format is part of the key, as the snapshot contains activities serialized in that format.
+	"""
+	return SNAPSHOT_VERSION, schema_version, fmt.name, _fingerprint( fs, ACTIVITIES_PATH ), _fingerprint( fs, JOURNAL_PATH )
+
+def _fingerprint( fs: FS, path: str ) -> Optional[Tuple[int, str]]:
+	if not fs.exists( path ):
+		return None
+	with mapped( path, fs ) as content:
+		return len( content ), blake2b( content, digest_size=16 ).hexdigest()
+
+def load_snapshot( fs: FS, key: Tuple ) -> Optional[Activities]:
+	if not fs.exists( SNAPSHOT_PATH ):
+		return None
+
+	try:
+		with mapped( SNAPSHOT_PATH, fs ) as content:
+			snapshot = pickle_loads( content )
+	except Exception: # snapshot is only a cache, so anything going wrong here results in rebuilding it
+		log.debug( f'unable to read snapshot from {SNAPSHOT_NAME}', exc_info=True )
+		return None
+
+	if snapshot.get( 'key' ) != key:
+		log.debug( f'ignoring stale snapshot {SNAPSHOT_NAME}' )
+		return None
+
+	activities = Activities( lst=snapshot.get( 'activities' ), skip_checks=True )
+	log.debug( f'loaded {len( activities )} activities from {SNAPSHOT_NAME}' )
+	return activities
+
+def write_snapshot( activities: Activities, key: Tuple, fs: FS ) -> None:
+	write_atomic( SNAPSHOT_PATH, pickle_dumps( { 'key': key, 'activities': list( activities ) }, protocol=HIGHEST_PROTOCOL ), fs )
+	log.debug( f'wrote {len( activities )} activities to {SNAPSHOT_NAME}' )
+
 # schema handling
 
 @define
 class Schema:
 
 	version: int = field( default=None )
+	generation: int = field( default=0 ) # increased with every save, allows to detect changes by other processes
 
 def load_schema( fs: FS ) -> Schema:
 	schema = SCHEMA_CONVERTER.loads( fs.readbytes( SCHEMA_PATH ), Schema )
-	log.debug( f'loaded database schema from {SCHEMA_PATH}, schema version = {schema.version}' )
+	log.debug( f'loaded database schema from {SCHEMA_PATH}, schema version = {schema.version}, generation = {schema.generation}' )
 	return schema
 
+def write_schema( schema: Schema, fs: FS ) -> None:
+	write_atomic( SCHEMA_PATH, SCHEMA_CONVERTER.dumps( schema, option=ORJSON_OPTIONS ), fs )
+
+# locking
+
+@contextmanager
+def lock( path: Optional[Path], exclusive: bool = False ) -> Iterator[None]:
+	"""
+	Holds an advisory lock on a db directory, shared for reading and exclusive for writing. Locks are held on the file
+	activities.lock, which is created if necessary. Dbs without a directory (i.e. in memory), directories which do not
+	allow to create the lock file and platforms without flock are not locked.
+
+	:param path: db directory
+	:param exclusive: acquire an exclusive lock instead of a shared one
+	"""
+	try:
+		f = open( Path( path, LOCK_NAME ), 'ab' ) if path and flock and Path( path ).is_dir() else None
+	except OSError:
+		log.debug( f'unable to create lock file in {path}, continuing without lock', exc_info=True )
+		f = None
+
+	if f is None:
+		yield
+		return
+
+	with f:
+		flock( f.fileno(), LOCK_EX if exclusive else LOCK_SH )
+		try:
+			yield
+		finally:
+			flock( f.fileno(), LOCK_UN )
+
+# saving
+
+def write_atomic( path: str, content: bytes, fs: FS ) -> None:
+	"""
+	Writes content to a temporary file next to the target, which is fsynced and renamed to the target afterward. This way
+	the target is either completely written or left untouched. File systems without system paths (i.e. memory) and
+	multi file systems, which write to their overlay, are written to directly.
+	"""
+	if isinstance( fs, MultiFS ) or not fs.hassyspath( path ):
+		fs.writebytes( path, content )
+		return
+
+	syspath = fs.getsyspath( path )
+	fd, tmp = mkstemp( dir=dirname( syspath ), prefix=f'.{basename( syspath )}.' )
+	try:
+		with fdopen( fd, 'wb' ) as f:
+			f.write( content )
+			f.flush()
+			fsync( f.fileno() )
+		if exists( syspath ):
+			chmod( tmp, stat( syspath ).st_mode )
+		replace( tmp, syspath )
+	except BaseException:
+		if exists( tmp ):
+			unlink( tmp )
+		raise
+
+def differs( path: str, src_fs: FS, dst_fs: FS ) -> bool:
+	return _fingerprint( src_fs, path ) != _fingerprint( dst_fs, path )
+
 # backup & restore
 
-def backup_db( db_fs: FS, backup_fs: FS ) -> None:
-	backup_folder = datetime.utcnow().strftime( '%y%m%d_%H%M%S' )
-	walker = Walker( filter=[ '*.json' ], exclude_dirs=[ '*' ], max_depth=0 )
-	copy_dir( db_fs, '/', backup_fs, backup_folder, walker=walker, preserve_time=True )
-	ctx().console.print( f'created database backup in {backup_fs.getsyspath( backup_folder )}' )
+def backup_db( db_fs: FS, backup_fs: FS, incremental: bool = True ) -> Optional[str]:
+	"""
+	Creates a backup of the db directory. Incremental backups cover the complete directory including all resources:
+	files are stored once by content hash in the object store of the backup directory, each backup consists of a
+	manifest only. Files with unchanged size and modification time are not read again. Non-incremental backups copy all
+	db files (without resources) into a new folder.
+
+	:param db_fs: fs of the db directory
+	:param backup_fs: fs of the backup directory
+	:param incremental: create an incremental backup
+	:return: name of the created backup
+	"""
+	name = datetime.utcnow().strftime( '%y%m%d_%H%M%S' )
+	if not incremental:
+		walker = Walker( filter=[ '*.json', '*.journal' ], exclude_dirs=[ '*' ], max_depth=0 )
+		copy_dir( db_fs, '/', backup_fs, name, walker=walker, preserve_time=True )
+		ctx().console.print( f'created database backup in {backup_fs.getsyspath( name )}' )
+		return name
+
+	db_path, backup_path = Path( db_fs.getsyspath( '/' ) ), Path( backup_fs.getsyspath( '/' ) )
+	previous = ( read_backup_manifest( backup_fs, names[-1] ) if ( names := list_backups( backup_fs ) ) else {} ).get( 'files', {} )
+	name = next( n for i in count() if ( n := f'{name}_{i}' if i else name ) not in names ) # more than one backup per second
+	files, stored = {}, 0
+
+	with lock( db_path ): # no changes while the db files are read
+		for path in _backup_files( db_path ):
+			key, info = path.relative_to( db_path ).as_posix(), path.stat()
+			entry = previous.get( key )
+			if not entry or entry['size'] != info.st_size or entry['mtime'] != info.st_mtime_ns or not _object_path( backup_path, entry['hash'] ):
+				content = path.read_bytes()
+				entry = { 'hash': blake2b( content, digest_size=20 ).hexdigest(), 'size': info.st_size, 'mtime': info.st_mtime_ns }
+				stored += _store_object( backup_path, entry['hash'], content )
+			files[key] = entry
+
+	backup_fs.makedirs( BACKUP_MANIFESTS_PATH, recreate=True )
+	manifest = { 'created': datetime.now( UTC ).isoformat(), 'files': files }
+	write_atomic( f'{BACKUP_MANIFESTS_PATH}/{name}.json', dumps( manifest, option=COMPACT_OPTIONS ), backup_fs )
+	ctx().console.print( f'created database backup {name} in {backup_path} ({len( files )} files, {stored} new objects)' )
+	return name
+
+def restore_db( db_fs: FS, backup_fs: FS, force: bool = False, name: Optional[str] = None ) -> None:
+	"""
+	Restores the db directory from the backup with the provided name or from the latest backup. Files are hard linked
+	from the object store if possible, files which have not been changed since the backup are skipped. Db files which
+	are not part of the backup (like the journal or shards created later) are removed. Resources which are not part of
+	the backup are kept, as they are never referenced by the restored activities and might have been hard to obtain.
+
+	:param db_fs: fs of the db directory
+	:param backup_fs: fs of the backup directory
+	:param force: do not ask for confirmation
+	:param name: name of the backup to restore, defaults to the latest one
+	"""
+	if not ( names := list_backups( backup_fs ) ):
+		return _restore_folder( db_fs, backup_fs, force )
+
+	if ( name := name or names[-1] ) not in names:
+		ctx().console.print( f'backup {name} does not exist, available backups: {", ".join( names )}' )
+		return
+
+	db_path, backup_path = Path( db_fs.getsyspath( '/' ) ), Path( backup_fs.getsyspath( '/' ) )
+	if force or Confirm.ask( f'Restore database from backup {name}? The current state will be overwritten.' ):
+		files = read_backup_manifest( backup_fs, name ).get( 'files', {} )
+		with lock( db_path, exclusive=True ):
+			for key in _db_files( db_path ):
+				if key not in files: # i.e. a journal of the current state must not be replayed on top of the backup
+					Path( db_path, key ).unlink()
+			restored = sum( _restore_object( backup_path, entry, Path( db_path, key ), _replaced_atomically( key ) ) for key, entry in files.items() )
+		ctx().console.print( f'database restored from backup {name} ({restored} of {len( files )} files restored)' )
+
+def list_backups( backup_fs: FS ) -> List[str]:
+	"""
+	Returns the names of all incremental backups, sorted by creation time.
+	"""
+	if not backup_fs.exists( BACKUP_MANIFESTS_PATH ):
+		return []
+	return sorted( f[:-5] for f in backup_fs.listdir( BACKUP_MANIFESTS_PATH ) if f.endswith( '.json' ) )
+
+def read_backup_manifest( backup_fs: FS, name: str ) -> Dict:
+	return read_json( f'{BACKUP_MANIFESTS_PATH}/{name}.json', backup_fs )
+
+def _backup_files( db_path: Path ) -> List[Path]:
+	return sorted( p for p in db_path.rglob( '*' ) if p.is_file() and not any( fnmatch( p.name, x ) for x in BACKUP_EXCLUDES ) )
+
+def _db_files( db_path: Path ) -> List[str]:
+	"""
+	Returns the db files (without resources) of the db directory, relative to the directory.
+	"""
+	shards = [ f'{SHARDS_DIRNAME}/{p.name}' for p in Path( db_path, SHARDS_DIRNAME ).glob( '*.json' ) ]
+	return [ key for key in [ ACTIVITIES_NAME, SCHEMA_NAME, JOURNAL_NAME, SQLITE_NAME, *shards ] if Path( db_path, key ).is_file() ]
+
+def _object_path( backup_path: Path, digest: str ) -> Optional[Path]:
+	path = Path( backup_path, BACKUP_OBJECTS_DIRNAME, digest[:2], digest )
+	return next( ( p for p in [ path, path.with_suffix( '.gz' ) ] if p.exists() ), None )
+
+def _store_object( backup_path: Path, digest: str, content: bytes ) -> int:
+	"""
+	Stores content in the object store, compressed if this saves space. Objects are stored read-only, restored files
+	which are hard links to them are made writable again, but are only ever replaced and not modified in place.
+
+	:return: 1 if the object has been stored, 0 if it already existed
+	"""
+	if _object_path( backup_path, digest ):
+		return 0
+
+	path = Path( backup_path, BACKUP_OBJECTS_DIRNAME, digest[:2], digest )
+	if len( compressed := gzip_compress( content, mtime=0 ) ) < len( content ) * BACKUP_COMPRESSION_RATIO:
+		path, content = path.with_suffix( '.gz' ), compressed
+
+	path.parent.mkdir( parents=True, exist_ok=True )
+	fd, tmp = mkstemp( dir=path.parent, prefix=f'.{path.name}.' )
+	with fdopen( fd, 'wb' ) as f:
+		f.write( content )
+	chmod( tmp, 0o444 )
+	replace( tmp, path )
+	return 1
+
+def _replaced_atomically( key: str ) -> bool:
+	# only files written via write_atomic() are never modified in place: the journal is appended to, the sqlite file is
+	# written in place and resources might be written in place by plugins
+	return key in [ ACTIVITIES_NAME, SCHEMA_NAME ] or ( key.startswith( f'{SHARDS_DIRNAME}/' ) and key.endswith( '.json' ) and key.count( '/' ) == 1 )
+
+def _restore_object( backup_path: Path, entry: Dict, target: Path, hard_link: bool = False ) -> int:
+	"""
+	Restores a single file, uncompressed objects are hard linked if allowed and possible.
+
+	:return: 1 if the file has been restored, 0 if it was unchanged
+	"""
+	if target.is_file() and ( info := target.stat() ).st_size == entry['size'] and info.st_mtime_ns == entry['mtime']:
+		return 0
+
+	if ( source := _object_path( backup_path, entry['hash'] ) ) is None:
+		log.error( f'unable to restore {target}, object {entry["hash"]} is missing in the backup' )
+		return 0
+
+	target.parent.mkdir( parents=True, exist_ok=True )
+	fd, tmp = mkstemp( dir=target.parent, prefix=f'.{target.name}.' )
+	try:
+		if source.suffix == '.gz':
+			with fdopen( fd, 'wb' ) as f:
+				f.write( gzip_decompress( source.read_bytes() ) )
+			chmod( tmp, 0o644 ) # mkstemp creates files only readable by the owner
+		else:
+			close( fd )
+			try:
+				if not hard_link:
+					raise OSError
+				unlink( tmp )
+				link( source, tmp )
+				chmod( tmp, 0o644 ) # write_atomic() copies the mode of the target, so saved files would be read-only otherwise
+			except OSError: # not allowed, different devices or no hard link support
+				copyfile( source, tmp )
+				chmod( tmp, 0o644 )
+		utime( tmp, ns=( entry['mtime'], entry['mtime'] ) )
+		replace( tmp, target )
+	except BaseException:
+		if exists( tmp ):
+			unlink( tmp )
+		raise
+	return 1
 
-def restore_db( db_fs: FS, backup_fs: FS, force: bool = False ) -> None:
+def _restore_folder( db_fs: FS, backup_fs: FS, force: bool = False ) -> None:
 	try:
 		rx = compile( r'/\d{6}_\d{6}' )
 		dirs = list( Walker( max_depth=0 ).dirs( backup_fs, '/' ) )
 		dirs = sorted( [ d for d in dirs if rx.fullmatch( d ) ] )
 		backup_folder = dirs[-1]
 		if force or Confirm.ask( f'Restore database from {backup_fs.getsyspath( backup_folder )}? The current state will be overwritten.' ):
-			walker = Walker( filter=['*.json'], exclude_dirs=['*'], max_depth=0 )
+			remove_journal( db_fs ) # a journal of the current state must not be replayed on top of the backup
+			walker = Walker( filter=['*.json', '*.journal'], exclude_dirs=['*'], max_depth=0 )
 			copy_dir( backup_fs, backup_folder, db_fs, '/', walker=walker, preserve_time=True )
 			ctx().console.print( f'database restored from {backup_fs.getsyspath( backup_folder )}' )
 	except RuntimeError:
@@ -7,6 +7,7 @@ from tracs.activity import Activity
 from tracs.config import ApplicationContext, console
 from tracs.pluginmgr import PluginManager
 from tracs.registry import Registry
+from tracs.rules import QueryPlan
 from tracs.ui.utils import style
 
 def inspect_activities( activities: [Activity] ) -> None:
@@ -72,6 +73,13 @@ def inspect_registry( registry: Registry ) -> None:
 
 	console.print( table )
 
+def inspect_plan( ctx: ApplicationContext, plan: QueryPlan ) -> None:
+	table = Table( box=box.MINIMAL, show_header=True, show_footer=False )
+	table.add_column( '[bold bright_blue]step[/bold bright_blue]' )
+	table.add_column( '[bold bright_blue]expression[/bold bright_blue]' )
+	[ table.add_row( step, expression ) for step, expression in plan.describe() ]
+	ctx.console.print( table )
+
 def inspect_keywords( ctx: ApplicationContext, as_json: bool ) -> None:
 	keywords = sorted( ctx.registry.keywords.items() )
 	if as_json:
@@ -18,12 +18,14 @@ from tracs.utils import fmt, red
 log = getLogger( __name__ )
 
 # noinspection PyTestUnpassedFixture
-def list_activities( activities: List[Activity], sort: str = None, reverse: bool = False, format_name: str = False, fields: str = None, ctx: ApplicationContext = None ) -> None:
+def list_activities( activities: List[Activity], sort: str = None, reverse: bool = False, format_name: str = False, fields: str = None, presorted: bool = False, ctx: ApplicationContext = None ) -> None:
 	sort = sort or 'starttime'
 	fields = fields or []
 
 	try:
-		activities = sorted( activities, key=lambda act: ( ( att := getattr( act, sort, None ) ) is None, att ) )
+		if not presorted: # activities might come sorted from the db already
+			column = Activity.materialize( activities, sort )[sort]
+			activities = [ activities[i] for i in sorted( range( len( activities ) ), key=lambda i: ( column[i] is None, column[i] ) ) ]
 	except (AttributeError, TypeError):
 		log.warning( f'unable to sort for field "{sort}", falling back to "starttime"' )
 		activities = sorted( activities, key=lambda act: getattr( act, "starttime" ) )
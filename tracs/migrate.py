@@ -1,13 +1,25 @@
 from datetime import datetime
+from gzip import GzipFile
 from logging import getLogger
+from os import fsync, replace
+from pathlib import Path
 from re import compile as rxcompile
-from sys import maxsize, modules
-from typing import List
+from shutil import copyfileobj
+from sys import modules
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional
 
-from orjson import dumps, loads, OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_SORT_KEYS
-from rich.pretty import pprint
+from attrs import define, field
+from fs.base import FS
+from orjson import dumps, OPT_APPEND_NEWLINE, OPT_INDENT_2, OPT_SORT_KEYS
+
+try:
+	from zstandard import ZstdCompressor
+except ImportError:
+	ZstdCompressor = None
 
 from tracs.config import ApplicationContext
+from tracs.fsio import ACTIVITIES_PATH, detect_format, GZIP, iter_json_array, journal_size, JsonArrayWriter, JsonFormat, load_schema
+from tracs.fsio import lock, open_stream, read_json, read_manifest, shard_path, write_atomic, write_schema, ZSTD
 
 log = getLogger( __name__ )
 
@@ -16,6 +28,11 @@ FN_REGEX = rxcompile( f'{FN_PREFIX}[a-z_]+' )
 
 ORJSON_OPTIONS = OPT_APPEND_NEWLINE | OPT_INDENT_2 | OPT_SORT_KEYS
 
+GROUPS_NAME = 'activities2.json'
+PROGRESS_NAME = 'migration.json'
+PROGRESS_PATH = f'/{PROGRESS_NAME}'
+CHECKPOINT_INTERVAL = 1000 # number of records after which the progress of a migration is recorded
+
 def migrate_db( ctx: ApplicationContext, function_name: str, **kwargs ):
 	full_function_name = f'{FN_PREFIX}{function_name}'
 #	try:
@@ -26,68 +43,254 @@ def migrate_db( ctx: ApplicationContext, function_name: str, **kwargs ):
 
 def migrate_db_functions( ctx: ApplicationContext ) -> List[str]:
 	functions = [fn for fn in dir( modules[__name__] )]
-	return sorted( [f.lstrip( FN_PREFIX ) for f in functions if FN_REGEX.fullmatch( f )] )
+	return sorted( [f[len( FN_PREFIX ):] for f in functions if FN_REGEX.fullmatch( f )] )
+
+# schema migrations
+
+@define
+class Migration:
+	"""
+	A single migration step, which transforms activity records into the schema with the provided version. Steps which
+	need to look up other records can provide an index function: it is called with all records before the
+	transformation starts, its result is passed to each call of transform.
+	"""
+
+	version: int = field()
+	name: str = field()
+	transform: Callable[[Dict, Any, ApplicationContext], Dict] = field()
+	index: Optional[Callable[[Iterator[Dict], ApplicationContext], Any]] = field( default=None )
+
+MIGRATIONS: Dict[int, Migration] = {}
+
+def migration( version: int, index: Optional[Callable[[Iterator[Dict], ApplicationContext], Any]] = None ):
+	"""
+	Decorator for registering a record transformation as migration step to the provided schema version.
+	"""
+	def register( fn: Callable[[Dict, Any, ApplicationContext], Dict] ):
+		MIGRATIONS[version] = Migration( version=version, name=fn.__name__.lstrip( '_' ), transform=fn, index=index )
+		return fn
+	return register
+
+def pending_migrations( current: int, target: int ) -> List[Migration]:
+	return [ MIGRATIONS[v] for v in sorted( MIGRATIONS.keys() ) if current < v <= target ]
+
+def migrate_schema( ctx: ApplicationContext, fs: FS, target: Optional[int] = None, steps: Optional[List[Migration]] = None ) -> int:
+	"""
+	Migrates the activities of the db in fs to the target schema version by applying all pending migration steps in
+	order. Each step streams all activity files of the db through its transformation, the progress is recorded
+	regularly, so an interrupted migration continues where it stopped when it is run again.
+
+	:param ctx: context
+	:param fs: fs of the db directory
+	:param target: target schema version, defaults to the current schema version
+	:param steps: steps to apply regardless of the schema version of the db
+	:return: schema version after migration
+	"""
+	from tracs.db import SCHEMA_VERSION
+	target = target or SCHEMA_VERSION
+
+	with lock( Path( fs.getsyspath( '/' ) ) if fs.hassyspath( '/' ) else None, exclusive=True ):
+		if journal_size( fs ):
+			ctx.console.print( 'unable to migrate database with pending journal entries, run maintenance function compact first' )
+			return load_schema( fs ).version
+
+		schema, progress = load_schema( fs ), read_json( PROGRESS_PATH, fs ) if fs.exists( PROGRESS_PATH ) else {}
+		steps = steps if steps is not None else pending_migrations( schema.version, target )
+		for step in steps:
+			log.info( f'migrating database to schema version {step.version} using {step.name}' )
+			_run_migration( step, ctx, fs, progress if progress.get( 'version' ) == step.version else {} )
+			schema.version, schema.generation = max( schema.version, step.version ), schema.generation + 1
+			write_schema( schema, fs )
+			fs.remove( PROGRESS_PATH )
+			progress = {}
+			ctx.console.print( f'migrated database to schema version {step.version} ({step.name})' )
+
+	return schema.version
+
+def _activity_files( fs: FS ) -> List[str]:
+	return ( [ ACTIVITIES_PATH ] if fs.exists( ACTIVITIES_PATH ) else [] ) + [ shard_path( key ) for key in sorted( read_manifest( fs ).keys() ) ]
+
+def _partial_path( path: str ) -> str:
+	parent, name = path.rsplit( '/', 1 )
+	return f'{parent}/.{name}.migrating'
+
+def _records( files: List[str], fs: FS ) -> Iterator[Dict]:
+	for path in files:
+		with open_stream( path, fs ) as f:
+			yield from iter_json_array( f )
+
+def _run_migration( step: Migration, ctx: ApplicationContext, fs: FS, progress: Dict ) -> None:
+	"""
+	Applies a single migration step to all activity files. Each file is transformed into a partial file next to it,
+	all files are replaced after all partial files have been completed. This way the input of a step stays untouched
+	until the step is finished, which allows to rebuild indexes when resuming.
+	"""
+	files = _activity_files( fs )
+	progress = progress or { 'version': step.version, 'done': [], 'commit': False }
+
+	if not progress['commit']:
+		index = step.index( _records( files, fs ), ctx ) if step.index else None
+		for path in [ f for f in files if f not in progress['done'] ]:
+			fmt = detect_format( path, fs )
+			_migrate_file( step, index, ctx, fs, path, fmt, progress )
+			progress.update( done=progress['done'] + [ path ], current=None, records=0, offset=0 )
+			write_atomic( PROGRESS_PATH, dumps( progress ), fs )
+			if fmt.compression: # partial files are written uncompressed, as this allows to continue them
+				_compress( fs, _partial_path( path ), fmt.compression )
+		progress['commit'] = True
+		write_atomic( PROGRESS_PATH, dumps( progress ), fs )
+
+	for path in files:
+		if fs.exists( partial := _partial_path( path ) ):
+			_commit_file( fs, partial, path )
+
+def _migrate_file( step: Migration, index: Any, ctx: ApplicationContext, fs: FS, path: str, fmt: JsonFormat, progress: Dict ) -> None:
+	partial = _partial_path( path )
+	resume = progress.get( 'current' ) == path and fs.exists( partial )
+	skip, offset = ( progress.get( 'records', 0 ), progress.get( 'offset', 0 ) ) if resume else ( 0, 0 )
+	if skip:
+		log.info( f'resuming migration of {path} after {skip} records' )
+
+	with open_stream( path, fs ) as src, fs.openbin( partial, 'r+b' if resume else 'wb' ) as dst:
+		dst.seek( offset )
+		dst.truncate() # drop everything written after the last checkpoint
+		writer = JsonArrayWriter( dst, JsonFormat( name=fmt.name ), count=skip )
+		for number, record in enumerate( iter_json_array( src ), start=1 ):
+			if number <= skip:
+				continue
+			writer.write( step.transform( record, index, ctx ) )
+			if number % CHECKPOINT_INTERVAL == 0:
+				_checkpoint( dst, fs, progress, path, number )
+		writer.close()
+		_checkpoint( dst, fs, progress, path, writer.count )
+
+def _checkpoint( f: BinaryIO, fs: FS, progress: Dict, path: str, records: int ) -> None:
+	f.flush()
+	if fs.hassyspath( path ):
+		fsync( f.fileno() )
+	progress.update( current=path, records=records, offset=f.tell() )
+	write_atomic( PROGRESS_PATH, dumps( progress ), fs )
+
+def _compress( fs: FS, path: str, compression: str ) -> None:
+	with fs.openbin( path ) as src, fs.openbin( f'{path}.tmp', 'wb' ) as dst:
+		if compression == GZIP:
+			with GzipFile( fileobj=dst, mode='wb', mtime=0 ) as g:
+				copyfileobj( src, g )
+		elif compression == ZSTD:
+			with ZstdCompressor().stream_writer( dst, size=fs.getsize( path ), closefd=False ) as z: # size goes into the frame header
+				copyfileobj( src, z )
+	fs.move( f'{path}.tmp', path, overwrite=True )
+
+def _commit_file( fs: FS, partial: str, path: str ) -> None:
+	if fs.hassyspath( partial ):
+		replace( fs.getsyspath( partial ), fs.getsyspath( path ) )
+	else:
+		fs.move( partial, path, overwrite=True )
+
+# maintenance functions
+
+def _mdb_migrate( ctx: ApplicationContext, **kwargs ) -> None:
+	migrate_schema( ctx, ctx.db_fs )
 
 def _mdb_consolidate_activity_ids( ctx: ApplicationContext, **kwargs ) -> None:
-	activities = sorted( ctx.db.activities, key=lambda activity: activity.starttime )
-	ctx.db.activity_map.clear()
-	for a, index in zip( activities, range( 1, maxsize ) ):
-		ctx.db.activity_map[index] = a
+	# renumbers activities by start time, undated activities go last, groups refer to their members by uid, not by id
+	activities = sorted( ctx.db.activities, key=lambda a: ( a.starttime is None, a.starttime.timestamp() if a.starttime else 0, a.id or 0 ) )
+	for index, a in enumerate( activities, start=1 ):
+		a.id = index
+	ctx.db.replace_activities( activities )
 	ctx.db.commit()
 
+def _mdb_compact( ctx: ApplicationContext, **kwargs ) -> None:
+	ctx.db.compact()
+
+def _mdb_json_to_sqlite( ctx: ApplicationContext, **kwargs ) -> None:
+	from tracs.db import db_settings, json_to_sqlite
+	json_to_sqlite( ctx.db_dir_path, **db_settings( ctx ) )
+
+def _mdb_sqlite_to_json( ctx: ApplicationContext, **kwargs ) -> None:
+	from tracs.db import db_settings, sqlite_to_json
+	sqlite_to_json( ctx.db_dir_path, **db_settings( ctx ) )
+
+def _mdb_json_to_shards( ctx: ApplicationContext, **kwargs ) -> None:
+	from tracs.db import db_settings, json_to_shards
+	json_to_shards( ctx.db_dir_path, **db_settings( ctx ) )
+
+def _mdb_shards_to_json( ctx: ApplicationContext, **kwargs ) -> None:
+	from tracs.db import db_settings, shards_to_json
+	shards_to_json( ctx.db_dir_path, **db_settings( ctx ) )
+
+def _mdb_pretty_dump( ctx: ApplicationContext, **kwargs ) -> None:
+	from tracs.fsio import pretty_dump, PRETTY_DUMP_NAME
+	pretty_dump( ctx.db.activities, ctx.db_fs )
+	ctx.console.print( f'wrote human-readable copy of {len( ctx.db.activities )} activities to {PRETTY_DUMP_NAME}' )
+
 def _mdb_groups( ctx: ApplicationContext, **kwargs ) -> None:
-	json = loads( ctx.db_fs.readbytes( 'activities.json' ) )
-	activities = []
-	for j in json:
-		uid, uids = j.get( 'uid' ), j.get( 'uids' )
-		if not uid and uids:
-			if len( uids ) == 1:
-				j['uid'] = j['uids'][0]
-				del j['uids']
-			elif len( uids ) > 1:
-				dt = datetime.fromisoformat( j.get( 'starttime' ) )
-				j['uid'] = f'group:{dt.strftime( "%y%m%d%H%M%S" )}'
-		activities.append( j )
-
-	ctx.db_fs.writebytes( 'activities2.json', dumps( activities, option=ORJSON_OPTIONS ) )
+	# writes the migrated activities to a separate file for review, the db itself and its schema are not touched
+	activities = [ _groups( a, None, ctx ) for a in _records( [ ACTIVITIES_PATH ], ctx.db_fs ) ]
+	write_atomic( f'/{GROUPS_NAME}', dumps( activities, option=ORJSON_OPTIONS ), ctx.db_fs )
+	ctx.console.print( f'wrote {len( activities )} migrated activities to {GROUPS_NAME}' )
 
 def _mdb_schema( ctx: ApplicationContext, **kwargs ) -> None:
-	activities = loads( ctx.db_fs.readbytes( 'activities.json' ) )
-	stages = [a for a in activities if a.get( 'resources' ) == []]
-	multiparts = [a for a in activities if a.get( 'parts' )]
-
-	for a in stages:
-		if a.get( 'uid' ).endswith( '.gpx' ) or a.get( 'uid' ).endswith( '.tcx' ):
-			a['uids'] = [ a['uid'] ]
-		for uid in a.get( 'uids' ):
-			uid, path = uid.split( '/' )
-			a['resources'].append(
-				{
-					'path': f'{ctx.registry.services["polar"].path_for_uid( uid )}/{path}',
-					'type': "application/gpx+xml" if path.endswith( '.gpx' ) else "application/tcx+xml"
-				}
-			)
-		if a['uid'].startswith( 'group:' ):
-			a['uid'] = f'polar:{datetime.fromisoformat( a["starttime"] ).strftime( "%y%m%d%H%M%S" )}'
-
-		del a['uids']
-
-	for a in multiparts:
+	migrate_schema( ctx, ctx.db_fs, steps=[ MIGRATIONS[14] ] )
+
+# migration steps
+
+@migration( version=13 )
+def _groups( a: Dict, index: Any, ctx: ApplicationContext ) -> Dict:
+	uid, uids = a.get( 'uid' ), a.get( 'uids' )
+	if not uid and uids:
+		if len( uids ) == 1:
+			a['uid'] = a['uids'][0]
+			del a['uids']
+		elif len( uids ) > 1:
+			dt = datetime.fromisoformat( a.get( 'starttime' ) )
+			a['uid'] = f'group:{dt.strftime( "%y%m%d%H%M%S" )}'
+	return a
+
+def _is_stage( a: Dict ) -> bool:
+	return a.get( 'resources' ) == []
+
+def _stage( a: Dict, ctx: ApplicationContext ) -> Dict:
+	"""
+	Converts the uids of a stage into resources and replaces group uids by polar uids.
+	"""
+	uids = [ a['uid'] ] if a.get( 'uid' ).endswith( '.gpx' ) or a.get( 'uid' ).endswith( '.tcx' ) else a.get( 'uids' )
+	for uid in uids:
+		uid, path = uid.split( '/' )
+		a['resources'].append( {
+			'path': f'{ctx.registry.services["polar"].path_for_uid( uid )}/{path}',
+			'type': "application/gpx+xml" if path.endswith( '.gpx' ) else "application/tcx+xml"
+		} )
+	if a['uid'].startswith( 'group:' ):
+		a['uid'] = f'polar:{datetime.fromisoformat( a["starttime"] ).strftime( "%y%m%d%H%M%S" )}'
+	a.pop( 'uids', None )
+	return a
+
+def _stage_index( activities: Iterator[Dict], ctx: ApplicationContext ) -> Dict[str, str]:
+	"""
+	Maps the resource paths of all stages to the (migrated) stage uids, replaces a scan over all stages for each part.
+	"""
+	index = {}
+	for a in filter( _is_stage, activities ):
+		stage = _stage( a, ctx )
+		for r in stage['resources']:
+			index.setdefault( r['path'], stage['uid'] ) # the first stage containing a resource wins
+	return index
+
+@migration( version=14, index=_stage_index )
+def _schema( a: Dict, stages: Dict[str, str], ctx: ApplicationContext ) -> Dict:
+	if _is_stage( a ):
+		a = _stage( a, ctx )
+
+	if a.get( 'parts' ):
 		a['resources'] = [ r for r in a['resources'] if not ( r['path'].endswith( '.gpx' ) or r['path'].endswith( '.tcx' ) ) ]
 		for p in a['parts']:
 			uid, path = p['uids'][0].split( '/' )
 			rid = f'{ctx.registry.services["polar"].path_for_uid( uid )}/{path}'
-			stage = None
-			for s in stages:
-				stage_resources = [ u['path'] for u in s.get( 'resources', [] ) ]
-				if rid in stage_resources:
-					stage = s
-					break
-
-			if not stage:
-				pprint( f'rid not found: {rid}' )
+			if ( stage_uid := stages.get( rid ) ) is None:
+				log.warning( f'rid not found: {rid}' )
 			else:
-				p['uid'] = stage['uid']
+				p['uid'] = stage_uid
 				del p['uids']
 
-	ctx.db_fs.writebytes( 'activities.json', dumps( activities, option=ORJSON_OPTIONS ) )
+	return a
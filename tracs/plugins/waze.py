@@ -11,7 +11,6 @@ from dateutil.tz import gettz, tzlocal, UTC
 from fs.base import FS
 from fs.path import dirname, frombase, parts, relpath
 from gpxpy.gpx import GPX, GPXTrack, GPXTrackPoint, GPXTrackSegment
-from more_itertools import unique
 from more_itertools.more import first, last
 
 from tracs.activity import Activities, Activity
@@ -495,7 +494,7 @@ class Waze( Service ):
 
 		# check if activity files are already known
 		activity_files = sorted( [ f for f in src_fs.walk.files( '/', filter=[ ACTIVITY_FILE ] ) ] )
-		known_files = list( unique( [ r.source for r in self.db.resources if r.source is not None ] ) )
+		known_files = self.db.resource_sources
 		known_files = [ frombase( self.name, kf ) for kf in known_files if parts( relpath( kf ) )[1] == self.name ]
 
 		if not self.ctx.force:
@@ -118,13 +118,12 @@ class Resource:
 	"""Secondary field as companion to raw, might contain another form of structured data, i.e. a dataclass in parallel to a json"""
 
 	__parents__: List = field( factory=list, repr=False, init=False, alias='__parents__' )
-	__dict__: Dict = field( factory=dict, repr=False, init=False ) # property cache
 
 	def __attrs_post_init__( self ):
 		# move path information from uid to resource, we may change this later
 		if not self.path and self.uid:
 			self.path = self.uid.path
-			self.uid.path = None # always remove path in UID
+			self.uid = UID( self.uid.classifier, self.uid.local_id, part=self.uid.part ) # always remove path in UID
 
 		if self.uid and self.uid.denotes_activity() and self.path is None:
 			raise AttributeError( 'resource UID may not denote an activity without having a path' )
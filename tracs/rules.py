@@ -1,21 +1,28 @@
 
 from __future__ import annotations
 
-from attrs import define, field
-from datetime import datetime, time
+from attrs import define, field, fields_dict, has
+from collections import OrderedDict
+from copy import copy
+from datetime import date, datetime, time
 from decimal import Decimal, InvalidOperation
+from functools import lru_cache, partial, reduce
 from logging import getLogger
+from operator import attrgetter
 from re import compile as rx_compile, match
 from sys import maxsize
-from typing import Any, Dict, List, Literal, Tuple, Type, Union
+from typing import Any, Callable, Dict, FrozenSet, List, Literal, Optional, Tuple, Type, Union
 
 from arrow import Arrow, get as getarrow
 from dateutil.tz import UTC
 from rule_engine import Context, resolve_attribute, Rule, RuleSyntaxError, SymbolResolutionError
+from rule_engine.ast import ArrayExpression, BooleanExpression, ComparisonExpression, ContainsExpression, DatetimeExpression, FloatExpression
+from rule_engine.ast import GetAttributeExpression, LogicExpression, NullExpression, Statement, StringExpression, SymbolExpression
 
 from tracs.activity import Activity
-from tracs.core import Keyword, Normalizer
-from tracs.utils import floor_ceil_from
+from tracs.core import Keyword, Normalizer, VirtualFields, VirtualFieldsBase
+from tracs.uid import UID
+from tracs.utils import floor_ceil_from, fromisoformat
 
 log = getLogger( __name__ )
 
@@ -55,20 +62,42 @@ FUZZY_TIME_PATTERN = '^(?P<hour>[0-1]\d|2[0-4])(:(?P<minute>[0-5]\d)(:(?P<second
 SHORT_RULE_PATTERN = r'^(\w+)(:|=)([\w\"\.].+)$' # short version: id=10 or id:10 for convenience, value must begin with alphanum or "
 RULE_PATTERN = '^(\w+)(==|!=|=~|!~|>=|<=|>|<|=|:)([\w\"\.].+)*$'
 
+# fields which denote the start of an activity, used to calculate date ranges of rules
+DATE_RANGE_FIELDS = [ 'starttime', 'starttime_local' ]
+
+RULE_CACHE_SIZE = 1 << 10 # maximum number of cached rules
+
 # type hints to be able to parse certain string correctly (i.e. 2022 as date, not as int)
 RESOLVER_TYPES: Dict[str, Type] = {
 	'date': datetime,
 	'time': time,
 }
 
+# resolvers per type and symbol name, a resolver returns the value of a symbol for a thing
+RESOLVERS: Dict[Tuple[Type, str], Callable[[Any], Any]] = {}
+
 def resolve_custom_attribute( thing: Any, name: str ) -> Any:
-	try:
-		return resolve_attribute( thing, name )
-	except SymbolResolutionError:
-		try:
-			return getattr( thing.vf, name )
-		except AttributeError:
-			raise SymbolResolutionError( thing=thing, symbol_name=name )
+	if ( resolver := RESOLVERS.get( ( cls := type( thing ), name ) ) ) is None:
+		resolver = RESOLVERS[cls, name] = _resolver( cls, name )
+	return resolver( thing )
+
+def _resolver( cls: Type, name: str ) -> Callable[[Any], Any]:
+	"""
+	Determines how to resolve a symbol for things of the provided type: fields and properties are read directly,
+	virtual fields (exposed or not) are computed and everything else is left to rule engine.
+	"""
+	if ( has( cls ) and name in fields_dict( cls ) ) or isinstance( getattr( cls, name, None ), property ):
+		return attrgetter( name )
+	elif issubclass( cls, VirtualFieldsBase ):
+		return partial( _resolve_virtual_field, cls.__vf__, name )
+	else:
+		return partial( resolve_attribute, name=name )
+
+def _resolve_virtual_field( vfs: VirtualFields, name: str, thing: Any ) -> Any:
+	# virtual fields are looked up on each call, as they might be registered or replaced later on
+	if vf := vfs.get( name ):
+		return thing.vf_value( vf )
+	return resolve_attribute( thing, name )
 
 # this should also work ...
 def resolve_custom_attribute_2( thing: Any, name: str ) -> Any:
@@ -88,6 +117,10 @@ class RuleParser:
 	keywords: Dict[str, Keyword] = field( factory=dict )
 	normalizers: Dict[str, Normalizer] = field( factory=dict )
 
+	# normalized rules, keyed by the raw rule, valid for one day only
+	_normalized: OrderedDict[str, str] = field( factory=OrderedDict, init=False, eq=False, repr=False, alias='_normalized' )
+	_day: Optional[date] = field( default=None, init=False, eq=False, repr=False, alias='_day' )
+
 	def _rule_normalizer_type( self, name: str ) -> Any:
 		return n.type if ( n := self.normalizers.get( name ) ) else Activity.field_type( name )
 
@@ -95,10 +128,21 @@ class RuleParser:
 		return [self.parse_rule( r ) for r in rules]
 
 	def parse_rule( self, rule: str ) -> Rule:
-
-		rule: str = self.normalize( rule ) # normalize rule, used for preprocessing special cases
-		rule: str = self.preprocess( rule ) # preprocess, not used at the moment
-		rule: Rule = self.process( rule )
+		# keywords like today or thisweek expand relative to the current date, so normalized rules are cached per day
+		if self._day != ( today := date.today() ):
+			self._normalized.clear()
+			self._day = today
+
+		if ( normalized := self._normalized.get( rule ) ) is None:
+			normalized: str = self.normalize( rule ) # normalize rule, used for preprocessing special cases
+			normalized: str = self.preprocess( normalized ) # preprocess, not used at the moment
+			self._normalized[rule] = normalized
+			if len( self._normalized ) > RULE_CACHE_SIZE:
+				self._normalized.popitem( last=False )
+		else:
+			self._normalized.move_to_end( rule )
+
+		rule: Rule = self.process( normalized )
 		rule: Rule = self.postprocess( rule ) # create and postprocess parsed rule
 
 		return rule
@@ -205,12 +249,12 @@ class RuleParser:
 
 	def process( self, rule: str ) -> Rule:
 		"""
-		Creates a rule from a normalized and preprocessed rule string.
+		Creates a rule from a normalized and preprocessed rule string. Compiled rules are cached and shared.
 
 		:param rule: rule string to use for rule creation
-		:return: newly created rule
+		:return: compiled rule
 		"""
-		return Rule( rule, CONTEXT )
+		return _compile( rule )
 
 	def postprocess( self, rule: Rule ) -> Rule:
 		"""
@@ -226,6 +270,10 @@ class RuleParser:
 
 		return postprocessed_rule
 
+@lru_cache( maxsize=RULE_CACHE_SIZE )
+def _compile( rule: str ) -> Rule:
+	return Rule( rule, CONTEXT )
+
 # helper
 
 def parse_number_range( s: str ) -> Tuple[str, str]:
@@ -292,3 +340,268 @@ def ceil( a: Arrow, frame: TIME_FRAMES ) -> str:
 
 def floor( a: Arrow, frame: TIME_FRAMES ) -> str:
 	return f'd"{a.floor( frame ).isoformat()}"'
+
+# date ranges of rules
+
+def date_range( *rules: Rule ) -> Tuple[Optional[datetime], Optional[datetime]]:
+	"""
+	Calculates the range of start times activities matching all provided rules can have. None denotes an open end.
+	The result is conservative: expressions which are not understood do not restrict the range.
+
+	:param rules: rules to analyze
+	:return: tuple of earliest and latest start time
+	"""
+	ranges = [ _date_range( r.statement.expression ) for r in rules ]
+	return _intersect( [ r[0] for r in ranges ], max ), _intersect( [ r[1] for r in ranges ], min )
+
+def _date_range( e: Any ) -> Tuple[Optional[datetime], Optional[datetime]]:
+	if isinstance( e, LogicExpression ):
+		( left_from, left_to ), ( right_from, right_to ) = _date_range( e.left ), _date_range( e.right )
+		if e.type == 'and':
+			return _intersect( [ left_from, right_from ], max ), _intersect( [ left_to, right_to ], min )
+		else:
+			return _union( [ left_from, right_from ], min ), _union( [ left_to, right_to ], max )
+
+	if isinstance( e, ComparisonExpression ) and isinstance( e.left, SymbolExpression ):
+		if e.left.name in DATE_RANGE_FIELDS and isinstance( e.right, DatetimeExpression ):
+			value = e.right.value if e.right.value.tzinfo else e.right.value.replace( tzinfo=UTC )
+			return { 'eq': ( value, value ), 'ge': ( value, None ), 'gt': ( value, None ), 'le': ( None, value ), 'lt': ( None, value ) }.get( e.type, ( None, None ) )
+		elif e.left.name == 'year' and e.type == 'eq' and isinstance( e.right, FloatExpression ):
+			return datetime( int( e.right.value ), 1, 1, tzinfo=UTC ), datetime( int( e.right.value ), 12, 31, 23, 59, 59, tzinfo=UTC )
+
+	return None, None
+
+def _intersect( values: List[Optional[datetime]], fn ) -> Optional[datetime]:
+	return fn( v ) if ( v := [ v for v in values if v is not None ] ) else None
+
+def _union( values: List[Optional[datetime]], fn ) -> Optional[datetime]:
+	return None if None in values else fn( values )
+
+# query planning
+
+COMPARISON_OPERATORS = { 'eq': '==', 'ne': '!=', 'ge': '>=', 'gt': '>', 'le': '<=', 'lt': '<', 'eq_fzm': '=~', 'eq_fzs': '=~~', 'ne_fzm': '!~', 'ne_fzs': '!~~' }
+
+def classifiers_of( activity: Activity ) -> List[str]:
+	"""
+	Returns the classifiers of an activity like Activity.classifiers does, but without structuring lazy activities.
+	Multiparts do not have classifiers.
+	"""
+	if not activity.lazy:
+		return ( activity.classifiers or [] ) if activity.uid else []
+
+	members = ( activity.__raw__.get( 'metadata' ) or {} ).get( 'members' ) or []
+	if len( members ) > 1:
+		return sorted( { UID( m ).classifier for m in members } )
+	elif activity.__raw__.get( 'parts' ):
+		return []
+	return [ activity.uid.classifier ] if activity.uid else []
+
+def starttime_of( activity: Activity, name: str = 'starttime' ) -> Optional[datetime]:
+	"""
+	Returns the (timezone-aware) value of starttime or starttime_local of an activity, without structuring lazy activities.
+	"""
+	try:
+		value = object.__getattribute__( activity, name ) # bypasses hydration, fails for fields of lazy activities which have not been set
+	except AttributeError:
+		if isinstance( value := activity.__raw__.get( name ), str ):
+			try:
+				value = datetime.fromisoformat( value )
+			except ValueError:
+				value = fromisoformat( value )
+	return _aware( value )
+
+def _aware( dt: Optional[datetime] ) -> Optional[datetime]:
+	return dt.replace( tzinfo=CONTEXT.default_timezone ) if dt and not dt.tzinfo else dt # same as rule_engine does
+
+# fields which can be used in predicates, mapped to a function returning the value of the field
+PREDICATE_FIELDS: Dict[str, Callable[[Activity], Any]] = {
+	'id': lambda a: a.id,
+	'uid': lambda a: str( a.uid ) if a.uid else None,
+	'classifier': classifiers_of,
+	'type': lambda a: a.type.name if a.type else None,
+	'starttime': lambda a: starttime_of( a, 'starttime' ),
+	'starttime_local': lambda a: starttime_of( a, 'starttime_local' ),
+}
+
+@define
+class Predicate:
+	"""
+	Part of a rule which can be answered without rule_engine, either by an index lookup or by comparing a single field of
+	an activity. A predicate restricts a field to a set of values and/or a range. The classifier predicate matches when
+	any of the classifiers of an activity is contained in its values. Null values never match, rule_engine raises an
+	error when comparing them with a range.
+	"""
+
+	name: str = field()
+	values: Optional[FrozenSet] = field( default=None )
+	lower: Any = field( default=None )
+	upper: Any = field( default=None )
+	lower_strict: bool = field( default=False )
+	upper_strict: bool = field( default=False )
+
+	def __str__( self ) -> str:
+		if self.name == 'classifier':
+			return ' or '.join( f'"{v}" in classifiers' for v in sorted( self.values ) )
+		terms, values = [], [ _literal( v ) for v in sorted( self.values or [] ) ]
+		if self.values is not None:
+			terms.append( f'{self._field} == {values[0]}' if len( values ) == 1 else f'{self._field} in [{", ".join( values )}]' )
+		if self.lower is not None:
+			terms.append( f'{self._field} {">" if self.lower_strict else ">="} {_literal( self.lower )}' )
+		if self.upper is not None:
+			terms.append( f'{self._field} {"<" if self.upper_strict else "<="} {_literal( self.upper )}' )
+		return ' and '.join( terms )
+
+	@property
+	def _field( self ) -> str:
+		return 'type.name' if self.name == 'type' else self.name
+
+	@property
+	def is_range( self ) -> bool:
+		return self.values is None
+
+	def accepts( self, value: Any ) -> bool:
+		if value is None or ( self.values is not None and value not in self.values ):
+			return False
+		if self.lower is not None and ( value < self.lower or ( self.lower_strict and value == self.lower ) ):
+			return False
+		if self.upper is not None and ( value > self.upper or ( self.upper_strict and value == self.upper ) ):
+			return False
+		return True
+
+	def matches( self, activity: Activity ) -> bool:
+		if self.name == 'classifier':
+			return any( c in self.values for c in classifiers_of( activity ) )
+		return self.accepts( PREDICATE_FIELDS[self.name]( activity ) )
+
+	def merge( self, other: Predicate ) -> Predicate:
+		"""
+		Merges two range predicates on the same field into a single range.
+		"""
+		lower, lower_strict = max( [ ( self.lower, self.lower_strict ), ( other.lower, other.lower_strict ) ], key=lambda b: ( b[0] is not None, b[0], b[1] ) )
+		upper, upper_strict = min( [ ( self.upper, self.upper_strict ), ( other.upper, other.upper_strict ) ], key=lambda b: ( b[0] is None, b[0], not b[1] ) )
+		return Predicate( self.name, lower=lower, upper=upper, lower_strict=lower_strict, upper_strict=upper_strict )
+
+@define
+class QueryPlan:
+	"""
+	Plan for finding the activities matching a list of rules: lookups are answered by indexes of a db, filters compare
+	single fields of the remaining candidates and the residual rules are evaluated by rule_engine.
+	"""
+
+	rules: List[Rule] = field( factory=list )
+	lookups: List[Predicate] = field( factory=list )
+	filters: List[Predicate] = field( factory=list )
+	residual: List[Rule] = field( factory=list )
+
+	def describe( self ) -> List[Tuple[str, str]]:
+		steps = [ ( 'lookup', str( p ) ) for p in self.lookups ] or [ ( 'scan', 'all activities' ) ]
+		return steps + [ ( 'filter', str( p ) ) for p in self.filters ] + [ ( 'rule', r.text ) for r in self.residual ]
+
+def plan_query( rules: List[Rule], indexed: Callable[[Predicate], bool] = lambda p: False ) -> QueryPlan:
+	"""
+	Creates a query plan for the provided rules. The top level conjunctions of all rules are inspected for predicates on
+	id, uid, classifier, type and start time, which are turned into lookups (when indexed) or filters. Everything else
+	remains as residual rule.
+
+	:param rules: rules to plan
+	:param indexed: function telling whether a predicate can be answered by an index
+	:return: query plan
+	"""
+	predicates, residual = [], []
+	for r in rules:
+		conjuncts = _conjuncts( r.statement.expression )
+		found = [ ( c, _predicate( c ) ) for c in conjuncts ]
+		predicates.extend( p for c, p in found if p )
+		if len( rest := [ c for c, p in found if p is None ] ) == len( conjuncts ):
+			residual.append( r )
+		elif rest:
+			residual.append( _residual_rule( r, rest ) )
+
+	merged: List[Predicate] = []
+	for p in predicates:
+		if p.is_range and ( m := next( ( m for m in merged if m.is_range and m.name == p.name ), None ) ):
+			merged[merged.index( m )] = m.merge( p )
+		else:
+			merged.append( p )
+
+	return QueryPlan(
+		rules=list( rules ),
+		lookups=[ p for p in merged if indexed( p ) ],
+		filters=[ p for p in merged if not indexed( p ) ],
+		residual=residual,
+	)
+
+def _conjuncts( e: Any ) -> List[Any]:
+	if isinstance( e, LogicExpression ) and e.type == 'and':
+		return _conjuncts( e.left ) + _conjuncts( e.right )
+	return [ e ]
+
+def _residual_rule( rule: Rule, expressions: List[Any] ) -> Rule:
+	residual = copy( rule )
+	residual.statement = Statement( rule.context, reduce( lambda left, right: LogicExpression( rule.context, 'and', left, right ), expressions ) )
+	residual.text = ' and '.join( _text( e ) for e in expressions )
+	return residual
+
+def _predicate( e: Any ) -> Optional[Predicate]:
+	if isinstance( e, ContainsExpression ):
+		if _is_symbol( e.member, 'id' ) and isinstance( e.container, ArrayExpression ) and e.container.value and all( isinstance( v, FloatExpression ) for v in e.container.value ):
+			return Predicate( 'id', values=frozenset( _number( v.value ) for v in e.container.value ) )
+		elif _is_symbol( e.container, 'classifiers' ) and isinstance( e.member, StringExpression ):
+			return Predicate( 'classifier', values=frozenset( [ e.member.value ] ) )
+
+	elif isinstance( e, ComparisonExpression ) and e.type in [ 'eq', 'ge', 'gt', 'le', 'lt' ]:
+		if _is_symbol( e.left, 'id' ) and isinstance( e.right, FloatExpression ):
+			return _comparison( 'id', e.type, _number( e.right.value ) )
+		elif _is_symbol( e.left, 'uid' ) and isinstance( e.right, StringExpression ) and e.type == 'eq':
+			return Predicate( 'uid', values=frozenset( [ e.right.value ] ) )
+		elif isinstance( e.left, GetAttributeExpression ) and _is_symbol( e.left.object, 'type' ) and e.left.name == 'name' and isinstance( e.right, StringExpression ) and e.type == 'eq':
+			return Predicate( 'type', values=frozenset( [ e.right.value ] ) )
+		elif isinstance( e.left, SymbolExpression ) and e.left.name in DATE_RANGE_FIELDS and isinstance( e.right, DatetimeExpression ):
+			return _comparison( e.left.name, e.type, _aware( e.right.value ) )
+
+	return None
+
+def _comparison( name: str, op: str, value: Any ) -> Predicate:
+	if op == 'eq':
+		return Predicate( name, values=frozenset( [ value ] ) )
+	elif op in [ 'ge', 'gt' ]:
+		return Predicate( name, lower=value, lower_strict=op == 'gt' )
+	else:
+		return Predicate( name, upper=value, upper_strict=op == 'lt' )
+
+def _is_symbol( e: Any, name: str ) -> bool:
+	return isinstance( e, SymbolExpression ) and e.name == name and e.scope is None
+
+def _number( value: Decimal ) -> int|Decimal:
+	return int( value ) if value == value.to_integral_value() else value
+
+def _literal( value: Any ) -> str:
+	if isinstance( value, str ):
+		return f'"{value}"'
+	elif isinstance( value, datetime ):
+		return f'd"{value.isoformat()}"'
+	return str( value )
+
+def _text( e: Any ) -> str:
+	"""
+	Returns the text of an expression, used to display residual rules.
+	"""
+	if isinstance( e, LogicExpression ):
+		return ' {} '.format( e.type ).join( f'( {_text( x )} )' if isinstance( x, LogicExpression ) and x.type != e.type else _text( x ) for x in [ e.left, e.right ] )
+	elif isinstance( e, ComparisonExpression ) and e.type in COMPARISON_OPERATORS:
+		return f'{_text( e.left )} {COMPARISON_OPERATORS[e.type]} {_text( e.right )}'
+	elif isinstance( e, ContainsExpression ):
+		return f'{_text( e.member )} in {_text( e.container )}'
+	elif isinstance( e, SymbolExpression ):
+		return e.name
+	elif isinstance( e, GetAttributeExpression ):
+		return f'{_text( e.object )}.{e.name}'
+	elif isinstance( e, ArrayExpression ):
+		return f'[{", ".join( _text( v ) for v in e.value )}]'
+	elif isinstance( e, NullExpression ):
+		return 'null'
+	elif isinstance( e, BooleanExpression ):
+		return 'true' if e.value else 'false'
+	elif isinstance( e, ( StringExpression, DatetimeExpression, FloatExpression ) ):
+		return _literal( e.value )
+	return repr( e )
@@ -286,11 +286,8 @@ class Service( Plugin ):
 				else:
 					log.info( f'skipping import of resource {r}, file already exists, use option -f/--force to force overwrite' )
 
-			# insert / upsert newly created activities
-			if self.ctx.db.contains_activity( a.uid ):
-				self.ctx.db.upsert( a )
-			else:
-				self.ctx.db.insert( a )
+		# insert / upsert newly created activities
+		self.ctx.db.upsert_many( activities )
 
 		# commit changes to db
 		self.ctx.db.commit()
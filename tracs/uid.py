@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from functools import lru_cache
 from typing import Callable, ClassVar, List, Optional, Tuple
 from urllib.parse import SplitResult, urlsplit, urlunsplit
 
@@ -7,8 +8,14 @@ from attrs import define, field
 from cattrs import Converter, GenConverter
 from fs.path import basename
 
-@define( eq=False, order=False, repr=False )
+UID_CACHE_SIZE = 1 << 16 # maximum number of interned uids
+
+@define( eq=False, order=False, repr=False, frozen=True )
 class UID:
+	"""
+	Immutable identifier of services, activities and resources. String form, hash, head and base are calculated once
+	during construction. Use UID.from_str() to obtain interned instances.
+	"""
 
 	converter: ClassVar[Converter] = GenConverter()
 
@@ -21,14 +28,26 @@ class UID:
 	part: int = field( default=None )
 	"""Part number of an activity. Example: uid = polar:101#2, part = 2."""
 
+	__uid__: str = field( default=None, init=False, alias='__uid__' )
+	__hashvalue__: int = field( default=None, init=False, alias='__hashvalue__' )
+	__head__: str = field( default=None, init=False, alias='__head__' )
+	__base__: UID = field( default=None, init=False, alias='__base__' )
+
 	def __attrs_post_init__( self ):
 		# always parse classifier
 		classifier, local_id, path, part = self._uidparse( self.classifier )
 		# overwrite fields depending on provided and parsed values
-		self.classifier = classifier # always
-		self.local_id = self.local_id if self.local_id else local_id
-		self.path = self.path if self.path else path
-		self.part = self.part if self.part else part
+		object.__setattr__( self, 'classifier', classifier ) # always
+		object.__setattr__( self, 'local_id', self.local_id if self.local_id else local_id )
+		object.__setattr__( self, 'path', self.path if self.path else path )
+		object.__setattr__( self, 'part', self.part if self.part else part )
+
+		# calculate derived values once
+		object.__setattr__( self, '__uid__', self._as_str() )
+		object.__setattr__( self, '__hashvalue__', hash( self.__uid__ ) )
+		object.__setattr__( self, '__head__', f'{self.classifier}:{self.local_id}' if self.local_id else self.classifier )
+		has_base = self.path is None or basename( self.path ) == self.path
+		object.__setattr__( self, '__base__', self if has_base else UID( self.classifier, self.local_id, basename( self.path ), self.part ) )
 
 	# noinspection PyMethodMayBeStatic
 	def _urlsplit( self, url: str ) -> SplitResult:
@@ -52,10 +71,12 @@ class UID:
 		return classifier, local_id, path, part
 
 	def __eq__( self, other ):
-		return self.uid == other.uid if isinstance( other, UID ) else self.uid == other
+		if self is other:
+			return True
+		return self.__uid__ == other.__uid__ if isinstance( other, UID ) else self.__uid__ == other
 
 	def __hash__( self ) -> int:
-		return hash( self.uid )
+		return self.__hashvalue__
 
 	def __lt__( self, other: [UID|str] ):
 		return self.uid < other.uid if isinstance( other, UID ) else self.uid < other
@@ -64,18 +85,18 @@ class UID:
 		return self.uid > other.uid if isinstance( other, UID ) else self.uid > other
 
 	def __str__( self ) -> str:
-		return self.uid
+		return self.__uid__
 
 	def __repr__( self ) -> str:
 		return self.__str__()
 
 	@property
 	def uid( self ):
-		return self.as_str
+		return self.__uid__
 
 	@property
 	def head( self ) -> str:
-		return f'{self.classifier}:{self.local_id}' if self.local_id else self.classifier
+		return self.__head__
 
 	@property
 	def tail( self ) -> Optional[str]:
@@ -90,13 +111,16 @@ class UID:
 
 	@property
 	def base( self ) -> UID:
-		return UID( self.classifier, self.local_id, basename( self.path ), self.part )
+		return self.__base__
 
 	def resolve( self, fn: Callable ) -> UID:
 		return UID( self.classifier, self.local_id, fn( self.local_id, basename( self.path ) ), self.part )
 
 	@property
 	def as_str( self ) -> str:
+		return self.__uid__
+
+	def _as_str( self ) -> str:
 		if self.classifier and not self.local_id:
 			return urlunsplit( ['', '', self.classifier, self.path or '', self.part or ''] )
 		else:
@@ -136,17 +160,21 @@ class UID:
 	# serialization
 
 	def to_str( self ):
-		return UID.converter.unstructure( self )
+		return self.__uid__
 
 	@staticmethod
 	def from_str( obj: str ) -> UID:
-		return UID.converter.structure( obj, UID )
+		return _intern( obj ) if isinstance( obj, str ) else UID.converter.structure( obj, UID )
 
 	@staticmethod
 	def from_strs( objs: List[str] ) -> List[UID]:
-		return [UID.converter.structure( u, UID ) for u in objs]
+		return [ UID.from_str( u ) for u in objs ]
+
+@lru_cache( maxsize=UID_CACHE_SIZE )
+def _intern( uid: str ) -> UID:
+	return UID( uid )
 
 # setup converter
 
 UID.converter.register_unstructure_hook( UID, lambda u: str( u ) )
-UID.converter.register_structure_hook( UID, lambda u, v: UID( u ) )
+UID.converter.register_structure_hook( UID, lambda u, v: UID.from_str( u ) if isinstance( u, str ) else UID( u ) )